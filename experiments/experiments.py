@@ -88,12 +88,26 @@ FACET_DEFAULT_PARAMS = {
     "facet_sd": 0.01,
     "facet_intersect_order": "Axes",
     "facet_verbose": False,
-    "facet_search": "BitVector",  # Linear
+    "facet_search": "BitVector",  # Linear, BestFirst, RTree
     "facet_smart_weight": True,
+    "facet_batch_size": 64,
+    "facet_workers": 1,  # worker processes which enumerate the rects and build the per class bit vector indexes
+    "facet_prune_contained": False,  # remove enumerated rects which lie inside another rect of the same class
+    "facet_merge_rects": False,  # merge touching rects of the same class whose bounding box is certified to be that class
+    "facet_merge_candidates": 16,
     "rbv_initial_radius": 0.01,
     "rbv_radius_step": 0.01,
-    "rbv_radius_growth": "Linear",
+    "rbv_radius_growth": "Linear",  # Exponential, Auto
     "rbv_num_interval": 16,
+    "rbv_memory_budget": None,  # bytes of bit vectors, chooses the intervals of each dimension in place of rbv_num_interval
+    "rbv_max_interval": 64,
+    "rbv_rebalance_skew": 2.0,
+    "rbv_backend": "BitArray",  # WordArray, Compressed
+    "rbv_max_cells": 64,
+    "rbv_cache_size": 0,
+    "rbv_shards": 1,  # split each class's index into shards searched in parallel by worker processes
+    "rbv_trace": False,  # record a per query search trace, written to a _trace.csv by execute_run
+    "rtree_node_size": 16,
     "gbc_intersection": "MinimalWorstGuess",  # "CompleteEnsemble"
 }
 
@@ -269,6 +283,16 @@ def execute_run(dataset_name: str, explainer: str, params: dict, output_path: st
         "{}_{}_{}{:03d}_x.csv".format(dataset_name, explainer.lower(), run_ext, iteration)
     x_df.to_csv(x_path, index=False)
 
+    # store the search trace of each explained sample's queries
+    if explainer == "FACET" and params["FACET"].get("rbv_trace"):
+        trace_df = pd.DataFrame(manager.explainer.search_trace())
+        if trace_df.shape[0] > 0:
+            trace_df["x_idx"] = np.array(idx_explain)[trace_df["x_idx"]]
+            trace_df = trace_df[["x_idx"] + [col for col in trace_df.columns if col != "x_idx"]]
+        trace_path = output_path + \
+            "{}_{}_{}{:03d}_trace.csv".format(dataset_name, explainer.lower(), run_ext, iteration)
+        trace_df.to_csv(trace_path, index=False)
+
     per_valid = percent_valid(explanations)
 
     # handle special mace int encoding
@@ -321,6 +345,18 @@ def execute_run(dataset_name: str, explainer: str, params: dict, output_path: st
         "sample_time": sample_time,
         "n_explain": n_explain,
     }
+    # report how many of the samples enumerated had the same leaves as an earlier sample
+    if explainer == "FACET" and params["FACET"].get("facet_enumerate", "PointBased") == "PointBased":
+        results["nsamples_enumerated"] = manager.explainer.nsamples_enumerated
+        results["nsamples_collapsed"] = manager.explainer.nsamples_collapsed
+    # report how much merging and pruning the enumerated rects shrank the index
+    if explainer == "FACET" and (params["FACET"].get("facet_merge_rects") or params["FACET"].get("facet_prune_contained")):
+        if params["FACET"].get("facet_merge_rects"):
+            counts = manager.explainer.merge_counts
+        else:
+            counts = manager.explainer.prune_counts
+        results["nrects_enumerated"] = sum([before for before, _ in counts])
+        results["nrects_indexed"] = sum([len(rects) for rects in manager.explainer.index])
 
     with open(output_path + "{}_{}_{}{:03d}_result.json".format(dataset_name, explainer.lower(), run_ext, iteration), "w") as f:
         json_text = json.dumps(results, indent=4)
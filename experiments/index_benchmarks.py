@@ -0,0 +1,551 @@
+import copy
+import os
+import random
+import time
+
+import numpy as np
+import pandas as pd
+from bitarray import bitarray
+from sklearn.model_selection import train_test_split
+from tqdm.auto import tqdm
+
+from dataset import load_data
+from explainers.bit_vector import BIT_ORDER, LOWER, UPPER, BitVectorIndex, bitmap_to_ids
+from manager import MethodManager
+
+from .experiments import (FACET_DEFAULT_PARAMS, FACET_TUNED_M, FACET_TUNED_NRECTS, RF_DEFAULT_PARAMS, TUNED_FACET_SD,
+                          execute_run)
+
+
+def synthetic_rects(nrects: int, ndims: int, p_unbounded: float = 0.5, random_state: int = None) -> list[np.ndarray]:
+    '''
+    Generates a list of random hyper-rectangles in the unit hypercube for index benchmarking. Each rectangle edge is left unbounded (+/- inf) with probability `p_unbounded`, mimicking the mostly unbounded rectangles produced by FACET's enumeration
+    '''
+    rng = np.random.default_rng(random_state)
+    corners = rng.uniform(low=0.0, high=1.0, size=(nrects, ndims, 2))
+    rects = np.sort(corners, axis=2)
+    rects[:, :, LOWER][rng.uniform(size=(nrects, ndims)) < p_unbounded] = -np.inf
+    rects[:, :, UPPER][rng.uniform(size=(nrects, ndims)) < p_unbounded] = np.inf
+    return list(rects)
+
+
+def legacy_build_bit_vectors(rbv_index: BitVectorIndex, rects: np.ndarray) -> list[list[list[bitarray]]]:
+    '''
+    The original triple loop construction of the redundant bit vectors, kept as a reference point for benchmarking BitVectorIndex.build_bit_vectors
+    '''
+    rbv = [[[bitarray(endian=BIT_ORDER) for _ in range(rbv_index.dim_m[dim])] for _ in range(2)]
+           for dim in range(rbv_index.ndimensions)]
+    for dim in range(rbv_index.ndimensions):
+        if rbv_index.indexed_dimensions[dim]:
+            for i in range(rbv_index.dim_m[dim]):
+                lb_bit_vec = [False for _ in range(rbv_index.nrects)]
+                ub_bit_vec = [False for _ in range(rbv_index.nrects)]
+                for j in range(rbv_index.nrects):
+                    lb_bit_vec[j] = rects[j][dim][UPPER] >= rbv_index.intervals[dim][i][LOWER]
+                    ub_bit_vec[j] = rects[j][dim][LOWER] < rbv_index.intervals[dim][i][UPPER]
+                rbv[dim][LOWER][i].extend(lb_bit_vec)
+                rbv[dim][UPPER][i].extend(ub_bit_vec)
+    return rbv
+
+
+def bench_build_bit_vectors(nrects: list[int] = [1_000, 10_000, 50_000], ms: list[int] = [4, 16, 24],
+                            ndims: list[int] = [6, 10, 41], iterations: list[int] = [0], fmod: str = None,
+                            skip_legacy: bool = False):
+    '''
+    Benchmark the time to build the redundant bit vectors of a BitVectorIndex as the number of hyper-rectangles, number of intervals, and number of dimensions vary. Compares the vectorized build against the legacy loop based build and checks that both produce identical bit vectors
+
+    Args:
+        nrects (list[int], optional): the number of hyper-rectangles to index
+        ms (list[int], optional): the number of intervals per dimension
+        ndims (list[int], optional): the dimensionality of the hyper-rectangles
+        iterations (list[int], optional): random seeds to run as iterations
+        fmod (str, optional): file path extension to move results
+        skip_legacy (bool, optional): only time the vectorized build, the legacy build is very slow for large nrects
+    '''
+    print("Benchmarking bit vector construction:")
+    print("\tnrects:", nrects)
+    print("\tms:", ms)
+    print("\tndims:", ndims)
+    print("\titerations:", iterations)
+
+    if fmod is not None:
+        csv_path = "./results/bench_build_" + fmod + ".csv"
+    else:
+        csv_path = "./results/bench_build.csv"
+    if not os.path.isdir("./results/"):
+        os.makedirs("./results/")
+
+    params = {"FACET": dict(FACET_DEFAULT_PARAMS)}
+
+    total_runs = len(nrects) * len(ms) * len(ndims) * len(iterations)
+    progress_bar = tqdm(total=total_runs, desc="Overall Progress", position=0, disable=False)
+    for iter in iterations:
+        for nr in nrects:
+            for nd in ndims:
+                rects = synthetic_rects(nrects=nr, ndims=nd, random_state=iter)
+                for m in ms:
+                    params["FACET"]["rbv_num_interval"] = m
+                    rbv_index = BitVectorIndex(rects=rects, explainer=None, hyperparameters=params)
+
+                    start = time.time()
+                    rbv = rbv_index.build_bit_vectors(rbv_index.rects)
+                    build_time = time.time() - start
+
+                    legacy_time = np.nan
+                    matches_legacy = np.nan
+                    if not skip_legacy:
+                        start = time.time()
+                        legacy_rbv = legacy_build_bit_vectors(rbv_index, rbv_index.rects)
+                        legacy_time = time.time() - start
+                        matches_legacy = (rbv == legacy_rbv)
+
+                    df_item = {
+                        "n_rects": nr,
+                        "m": m,
+                        "n_dims": nd,
+                        "n_indexed_dims": sum(rbv_index.indexed_dimensions),
+                        "iteration": iter,
+                        "build_time": build_time,
+                        "legacy_build_time": legacy_time,
+                        "speedup": legacy_time / build_time,
+                        "matches_legacy": matches_legacy,
+                    }
+                    experiment_results = pd.DataFrame([df_item])
+                    if not os.path.exists(csv_path):
+                        experiment_results.to_csv(csv_path, index=False)
+                    else:
+                        experiment_results.to_csv(csv_path, index=False, mode="a", header=False)
+                    progress_bar.update()
+    progress_bar.close()
+    print("Finished benchmarking bit vector construction")
+
+
+def bench_bitmap_backends(nrects: list[int] = [1_000, 10_000, 100_000], ndims: list[int] = [6, 10, 41],
+                          m: int = 16, nqueries: int = 200, query_width: float = 0.2, p_unbounded: float = 0.5, iterations: list[int] = [0],
+                          fmod: str = None, backends: list[str] = ["BitArray", "WordArray", "Compressed"]):
+    '''
+    Benchmark the bitmap stage of BitVectorIndex queries for each bitmap backend. For a set of random query rectangles this times finding the intervals of each query, combining the selected interval vectors, and extracting the ids of the matching rectangles, and checks that every backend matches the same rectangles. Also records the memory used by each backend's bit vectors
+
+    Args:
+        nrects (list[int], optional): the number of hyper-rectangles to index
+        ndims (list[int], optional): the dimensionality of the hyper-rectangles
+        m (int, optional): the number of intervals per dimension
+        nqueries (int, optional): the number of random query rectangles to run
+        query_width (float, optional): the width of each query rectangle along every axis
+        p_unbounded (float, optional): the probability that each rectangle edge is unbounded
+        iterations (list[int], optional): random seeds to run as iterations
+        fmod (str, optional): file path extension to move results
+        backends (list[str], optional): the rbv_backend values to compare
+    '''
+    print("Benchmarking bitmap backends:")
+    print("\tnrects:", nrects)
+    print("\tndims:", ndims)
+    print("\tbackends:", backends)
+    print("\titerations:", iterations)
+
+    if fmod is not None:
+        csv_path = "./results/bench_backend_" + fmod + ".csv"
+    else:
+        csv_path = "./results/bench_backend.csv"
+    if not os.path.isdir("./results/"):
+        os.makedirs("./results/")
+
+    params = {"FACET": dict(FACET_DEFAULT_PARAMS)}
+    params["FACET"]["rbv_num_interval"] = m
+
+    total_runs = len(nrects) * len(ndims) * len(iterations)
+    progress_bar = tqdm(total=total_runs, desc="Overall Progress", position=0, disable=False)
+    for iter in iterations:
+        for nr in nrects:
+            for nd in ndims:
+                rects = synthetic_rects(nrects=nr, ndims=nd, p_unbounded=p_unbounded, random_state=iter)
+                rng = np.random.default_rng(iter)
+                centers = rng.uniform(low=0.0, high=1.0, size=(nqueries, nd))
+                query_rects = np.stack([centers - query_width / 2, centers + query_width / 2], axis=2)
+
+                df_item = {
+                    "n_rects": nr,
+                    "m": m,
+                    "n_dims": nd,
+                    "n_queries": nqueries,
+                    "p_unbounded": p_unbounded,
+                    "iteration": iter,
+                }
+                reference_ids = None
+                matches_reference = True
+                for backend in backends:
+                    params["FACET"]["rbv_backend"] = backend
+                    rbv_index = BitVectorIndex(rects=rects, explainer=None, hyperparameters=params)
+
+                    start = time.time()
+                    lower_intervals, upper_intervals = rbv_index.interval_ids(query_rects)
+                    matching_bits = rbv_index.match_intervals_batch(lower_intervals, upper_intervals)
+                    match_ids = [bitmap_to_ids(matching_bits[j]) for j in range(nqueries)]
+                    query_time = time.time() - start
+
+                    if reference_ids is None:
+                        reference_ids = match_ids
+                    else:
+                        matches_reference &= all(np.array_equal(a, b) for a, b in zip(reference_ids, match_ids))
+                    df_item[backend + "_time"] = query_time
+                    df_item[backend + "_bytes"] = rbv_index.vector_bytes()
+                    df_item[backend + "_avg_matches"] = np.mean([len(ids) for ids in match_ids])
+                df_item["matches_reference"] = matches_reference
+
+                experiment_results = pd.DataFrame([df_item])
+                if not os.path.exists(csv_path):
+                    experiment_results.to_csv(csv_path, index=False)
+                else:
+                    experiment_results.to_csv(csv_path, index=False, mode="a", header=False)
+                progress_bar.update()
+    progress_bar.close()
+    print("Finished benchmarking bitmap backends")
+
+
+def bench_insert(nrects: list[int] = [10_000, 100_000], ndims: list[int] = [6, 41], m: int = 16, ninserts: int = 10,
+                 insert_size: int = 1_000, p_unbounded: float = 0.5, iterations: list[int] = [0], fmod: str = None,
+                 backends: list[str] = ["BitArray", "WordArray", "Compressed"]):
+    '''
+    Benchmark adding hyper-rectangles to a built BitVectorIndex for each bitmap backend. Grows an index of nrects rectangles by ninserts batches of insert_size rectangles, timing the inserts against rebuilding the bit vectors from scratch, and checks that the grown index's bit vectors equal a fresh build of all the rectangles using the same intervals
+
+    Args:
+        nrects (list[int], optional): the number of hyper-rectangles in the index before growing it
+        ndims (list[int], optional): the dimensionality of the hyper-rectangles
+        m (int, optional): the number of intervals per dimension
+        ninserts (int, optional): the number of batches of rectangles to insert
+        insert_size (int, optional): the number of rectangles in each inserted batch
+        p_unbounded (float, optional): the probability that each rectangle edge is unbounded
+        iterations (list[int], optional): random seeds to run as iterations
+        fmod (str, optional): file path extension to move results
+        backends (list[str], optional): the rbv_backend values to compare
+    '''
+    print("Benchmarking inserts:")
+    print("\tnrects:", nrects)
+    print("\tndims:", ndims)
+    print("\tbackends:", backends)
+    print("\titerations:", iterations)
+
+    if fmod is not None:
+        csv_path = "./results/bench_insert_" + fmod + ".csv"
+    else:
+        csv_path = "./results/bench_insert.csv"
+    if not os.path.isdir("./results/"):
+        os.makedirs("./results/")
+
+    params = {"FACET": dict(FACET_DEFAULT_PARAMS)}
+    params["FACET"]["rbv_num_interval"] = m
+
+    total_runs = len(nrects) * len(ndims) * len(backends) * len(iterations)
+    progress_bar = tqdm(total=total_runs, desc="Overall Progress", position=0, disable=False)
+    for iter in iterations:
+        for nr in nrects:
+            for nd in ndims:
+                rects = synthetic_rects(nrects=nr + ninserts * insert_size, ndims=nd, p_unbounded=p_unbounded, random_state=iter)
+                for backend in backends:
+                    params["FACET"]["rbv_backend"] = backend
+                    rbv_index = BitVectorIndex(rects=rects[:nr], explainer=None, hyperparameters=params)
+
+                    insert_time = 0.0
+                    matches_fresh_build = True
+                    for start in range(nr, nr + ninserts * insert_size, insert_size):
+                        begin = time.time()
+                        rbv_index.insert(rects[start:start + insert_size])
+                        insert_time += time.time() - begin
+                        # rebuild the same index from scratch with the intervals it has after the insert
+                        fresh_index = copy.copy(rbv_index)
+                        begin = time.time()
+                        fresh_index.build_vectors()
+                        rebuild_time = time.time() - begin
+                        matches_fresh_build &= equal_vectors(rbv_index, fresh_index)
+
+                    df_item = {
+                        "n_rects": nr,
+                        "m": m,
+                        "n_dims": nd,
+                        "backend": backend,
+                        "n_inserts": ninserts,
+                        "insert_size": insert_size,
+                        "p_unbounded": p_unbounded,
+                        "iteration": iter,
+                        "avg_insert_time": insert_time / ninserts,
+                        "rebuild_time": rebuild_time,
+                        "vector_bytes": rbv_index.vector_bytes(),
+                        "matches_fresh_build": matches_fresh_build,
+                    }
+                    experiment_results = pd.DataFrame([df_item])
+                    if not os.path.exists(csv_path):
+                        experiment_results.to_csv(csv_path, index=False)
+                    else:
+                        experiment_results.to_csv(csv_path, index=False, mode="a", header=False)
+                    progress_bar.update()
+    progress_bar.close()
+    print("Finished benchmarking inserts")
+
+
+def equal_vectors(rbv_index: BitVectorIndex, other_index: BitVectorIndex) -> bool:
+    '''
+    Checks whether two indexes with the same backend and intervals have identical bit vectors
+    '''
+    if rbv_index.backend == "WordArray":
+        return np.array_equal(rbv_index.rbv_words, other_index.rbv_words)
+    elif rbv_index.backend == "Compressed":
+        return np.array_equal(rbv_index.rbv_compressed.to_words(), other_index.rbv_compressed.to_words())
+    else:
+        return rbv_index.rbv == other_index.rbv
+
+
+def bench_search_types(ds_names: list[str], facet_searches: list[str] = ["BitVector", "RTree"], iterations: list[int] = [0],
+                       fmod: str = None, ntrees: int = 10, max_depth: int = 5):
+    '''
+    Benchmark FACET's explanation time using each of its index search types on the given datasets. Each search type explains the same samples using the same model and enumerated hyper-rectangles
+
+    Args:
+        ds_names (list[str]): list of dataset name strings
+        facet_searches (list[str], optional): the facet_search types to compare
+        iterations (list[int], optional): random seeds to run as iterations
+        fmod (str, optional): file path extension to move results
+        ntrees (int, optional): number of trees to use in the ensemble being explained
+        max_depth (int, optional): the maximum depth of the ensemble being explained
+    '''
+    print("Benchmarking search types:")
+    print("\tds_names:", ds_names)
+    print("\tfacet_searches:", facet_searches)
+    print("\titerations:", iterations)
+
+    if fmod is not None:
+        csv_path = "./results/bench_search_" + fmod + ".csv"
+        experiment_path = "./results/bench-search-" + fmod + "/"
+    else:
+        csv_path = "./results/bench_search.csv"
+        experiment_path = "./results/bench-search/"
+
+    explainer = "FACET"
+    params = {
+        "RandomForest": copy.deepcopy(RF_DEFAULT_PARAMS),
+        "FACET": copy.deepcopy(FACET_DEFAULT_PARAMS),
+    }
+    params["RandomForest"]["rf_ntrees"] = ntrees
+    params["RandomForest"]["rf_maxdepth"] = max_depth
+
+    total_runs = len(ds_names) * len(facet_searches) * len(iterations)
+    progress_bar = tqdm(total=total_runs, desc="Overall Progress", position=0, disable=False)
+    for iter in iterations:
+        for ds in ds_names:
+            params["FACET"]["facet_sd"] = TUNED_FACET_SD[ds]
+            params["FACET"]["rbv_num_interval"] = FACET_TUNED_M[ds]
+            params["FACET"]["facet_nrects"] = FACET_TUNED_NRECTS[ds]
+            for search in facet_searches:
+                params["FACET"]["facet_search"] = search
+                run_result = execute_run(
+                    dataset_name=ds,
+                    explainer=explainer,
+                    params=params,
+                    output_path=experiment_path,
+                    iteration=iter,
+                    test_size=0.2,
+                    n_explain=20,
+                    random_state=iter,
+                    preprocessing="Normalize",
+                    run_ext="{}_".format(search.lower())
+                )
+                df_item = {
+                    "dataset": ds,
+                    "explainer": explainer,
+                    "n_trees": ntrees,
+                    "max_depth": max_depth,
+                    "facet_search": search,
+                    "iteration": iter,
+                    **run_result
+                }
+                experiment_results = pd.DataFrame([df_item])
+                if not os.path.exists(csv_path):
+                    experiment_results.to_csv(csv_path, index=False)
+                else:
+                    experiment_results.to_csv(csv_path, index=False, mode="a", header=False)
+                progress_bar.update()
+    progress_bar.close()
+    print("Finished benchmarking search types")
+
+
+def bench_grow_index(ds_names: list[str], facet_searches: list[str] = ["BitVector", "BestFirst", "RTree"], nshards: list[int] = [1, 2],
+                     nrects: int = 5_000, n_explain: int = 50, iterations: list[int] = [0], fmod: str = None, ntrees: int = 10,
+                     max_depth: int = 5):
+    '''
+    Benchmark growing FACET's built search indexes by enumerating hyper-rectangles from more samples after prepare. Each search type grows its indexes in place using the testing samples, then the indexes are rebuilt from scratch over the same rectangles. Times the enumeration and growth and the rebuild, and checks that the grown and rebuilt indexes give the same explanation regions
+
+    Args:
+        ds_names (list[str]): list of dataset name strings
+        facet_searches (list[str], optional): the facet_search types to compare
+        nshards (list[int], optional): the rbv_shards values to compare for the BitVector search, other searches are unsharded
+        nrects (int, optional): the number of hyper-rectangles to enumerate before growing the index
+        n_explain (int, optional): the number of samples to explain
+        iterations (list[int], optional): random seeds to run as iterations
+        fmod (str, optional): file path extension to move results
+        ntrees (int, optional): number of trees to use in the ensemble being explained
+        max_depth (int, optional): the maximum depth of the ensemble being explained
+    '''
+    print("Benchmarking index growth:")
+    print("\tds_names:", ds_names)
+    print("\tfacet_searches:", facet_searches)
+    print("\tnshards:", nshards)
+    print("\titerations:", iterations)
+
+    if fmod is not None:
+        csv_path = "./results/bench_grow_" + fmod + ".csv"
+    else:
+        csv_path = "./results/bench_grow.csv"
+    if not os.path.isdir("./results/"):
+        os.makedirs("./results/")
+
+    params = {
+        "RandomForest": copy.deepcopy(RF_DEFAULT_PARAMS),
+        "FACET": copy.deepcopy(FACET_DEFAULT_PARAMS),
+    }
+    params["RandomForest"]["rf_ntrees"] = ntrees
+    params["RandomForest"]["rf_maxdepth"] = max_depth
+    params["FACET"]["facet_nrects"] = nrects
+
+    configs = [(search, shards if search == "BitVector" else 1) for search in facet_searches
+               for shards in (nshards if search == "BitVector" else [1])]
+    total_runs = len(ds_names) * len(configs) * len(iterations)
+    progress_bar = tqdm(total=total_runs, desc="Overall Progress", position=0, disable=False)
+    for iter in iterations:
+        for ds in ds_names:
+            x, y, ds_info = load_data(ds, True, True, False)
+            xtrain, xtest, ytrain, ytest = train_test_split(x, y, test_size=0.2, shuffle=True, random_state=iter)
+            params["FACET"]["facet_sd"] = TUNED_FACET_SD[ds]
+            params["FACET"]["rbv_num_interval"] = FACET_TUNED_M[ds]
+            for search, shards in configs:
+                params["FACET"]["facet_search"] = search
+                params["FACET"]["rbv_shards"] = shards
+                random.seed(iter)
+                np.random.seed(iter)
+                manager = MethodManager(explainer="FACET", hyperparameters=params, random_state=iter)
+                manager.train(xtrain, ytrain)
+                manager.explainer.prepare_dataset(x, y, ds_info)
+                manager.prepare(xtrain=xtrain, ytrain=ytrain)
+                facet = manager.explainer
+                x_explain = xtest[:n_explain]
+                explain_preds = manager.predict(x_explain)
+                nrects_before = sum(len(rects) for rects in facet.index)
+
+                # grow the built indexes with the rectangles of the testing samples
+                start = time.time()
+                facet.index_rectangles(xtest)
+                grow_time = time.time() - start
+                _, grown_regions = facet.explain(x_explain, explain_preds, return_regions=True)
+
+                # rebuild the indexes from scratch over the same rectangles
+                for rbv in facet.rbvs or []:
+                    if hasattr(rbv, "close"):
+                        rbv.close()
+                start = time.time()
+                if search == "RTree":
+                    facet.build_rtreeindex()
+                else:
+                    facet.build_bitvectorindex()
+                rebuild_time = time.time() - start
+                _, rebuilt_regions = facet.explain(x_explain, explain_preds, return_regions=True)
+                for rbv in facet.rbvs or []:
+                    if hasattr(rbv, "close"):
+                        rbv.close()
+
+                df_item = {
+                    "dataset": ds,
+                    "n_trees": ntrees,
+                    "max_depth": max_depth,
+                    "facet_search": search,
+                    "n_shards": shards,
+                    "iteration": iter,
+                    "n_rects_before": nrects_before,
+                    "n_rects_after": sum(len(rects) for rects in facet.index),
+                    "grow_time": grow_time,
+                    "rebuild_time": rebuild_time,
+                    "matches_rebuild": np.array_equal(grown_regions, rebuilt_regions),
+                }
+                experiment_results = pd.DataFrame([df_item])
+                if not os.path.exists(csv_path):
+                    experiment_results.to_csv(csv_path, index=False)
+                else:
+                    experiment_results.to_csv(csv_path, index=False, mode="a", header=False)
+                progress_bar.update()
+    progress_bar.close()
+    print("Finished benchmarking index growth")
+
+
+def bench_shards(ds_names: list[str], nshards: list[int] = [1, 2, 4, 8], nrects: int = 100_000, n_explain: int = 200,
+                 iterations: list[int] = [0], fmod: str = None, ntrees: int = 10, max_depth: int = 5):
+    '''
+    Benchmark FACET's explanation throughput when each class's bit vector index is split into a number of shards searched in parallel by worker processes. Each shard count explains the same samples using the same model and enumerated hyper-rectangles
+
+    Args:
+        ds_names (list[str]): list of dataset name strings
+        nshards (list[int], optional): the rbv_shards values to compare, 1 searches a single unsharded index
+        nrects (int, optional): the number of hyper-rectangles to enumerate
+        n_explain (int, optional): the number of samples to explain
+        iterations (list[int], optional): random seeds to run as iterations
+        fmod (str, optional): file path extension to move results
+        ntrees (int, optional): number of trees to use in the ensemble being explained
+        max_depth (int, optional): the maximum depth of the ensemble being explained
+    '''
+    print("Benchmarking shards:")
+    print("\tds_names:", ds_names)
+    print("\tnshards:", nshards)
+    print("\tnrects:", nrects)
+    print("\titerations:", iterations)
+
+    if fmod is not None:
+        csv_path = "./results/bench_shards_" + fmod + ".csv"
+        experiment_path = "./results/bench-shards-" + fmod + "/"
+    else:
+        csv_path = "./results/bench_shards.csv"
+        experiment_path = "./results/bench-shards/"
+
+    explainer = "FACET"
+    params = {
+        "RandomForest": copy.deepcopy(RF_DEFAULT_PARAMS),
+        "FACET": copy.deepcopy(FACET_DEFAULT_PARAMS),
+    }
+    params["RandomForest"]["rf_ntrees"] = ntrees
+    params["RandomForest"]["rf_maxdepth"] = max_depth
+    params["FACET"]["facet_search"] = "BitVector"
+    params["FACET"]["facet_nrects"] = nrects
+
+    total_runs = len(ds_names) * len(nshards) * len(iterations)
+    progress_bar = tqdm(total=total_runs, desc="Overall Progress", position=0, disable=False)
+    for iter in iterations:
+        for ds in ds_names:
+            params["FACET"]["facet_sd"] = TUNED_FACET_SD[ds]
+            params["FACET"]["rbv_num_interval"] = FACET_TUNED_M[ds]
+            for shards in nshards:
+                params["FACET"]["rbv_shards"] = shards
+                run_result = execute_run(
+                    dataset_name=ds,
+                    explainer=explainer,
+                    params=params,
+                    output_path=experiment_path,
+                    iteration=iter,
+                    test_size=0.2,
+                    n_explain=n_explain,
+                    random_state=iter,
+                    preprocessing="Normalize",
+                    run_ext="shards{}_".format(shards)
+                )
+                df_item = {
+                    "dataset": ds,
+                    "explainer": explainer,
+                    "n_trees": ntrees,
+                    "max_depth": max_depth,
+                    "n_rects": nrects,
+                    "n_shards": shards,
+                    "iteration": iter,
+                    **run_result
+                }
+                experiment_results = pd.DataFrame([df_item])
+                if not os.path.exists(csv_path):
+                    experiment_results.to_csv(csv_path, index=False)
+                else:
+                    experiment_results.to_csv(csv_path, index=False, mode="a", header=False)
+                progress_bar.update()
+    progress_bar.close()
+    print("Finished benchmarking shards")
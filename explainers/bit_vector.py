@@ -1,7 +1,11 @@
 # handle circular imports that result from typehinting
 from __future__ import annotations
 
-import bisect
+import hashlib
+import heapq
+import struct
+import time
+from collections import OrderedDict
 from typing import TYPE_CHECKING
 
 import numpy as np
@@ -13,6 +17,249 @@ if TYPE_CHECKING:  # circular import avoidance
 
 LOWER = 0
 UPPER = 1
+# bit order used to pack the bit vectors, bit i of byte j corresponds to rectangle 8*j + i
+BIT_ORDER = "little"
+# the maximum number of (instance, hyper-rectangle) pairs to fit and measure in one block during batched queries
+MAX_CANDIDATE_PAIRS = 2 ** 16
+
+# the "Auto" radius growth starts at this quantile of the sampled distances to the nearest rect and steps to reach the final quantile in the target number of steps
+AUTO_INITIAL_QUANTILE = 0.25
+AUTO_FINAL_QUANTILE = 0.9
+AUTO_TARGET_STEPS = 8
+
+# the number of interval cells best-first search pops from its queue between candidate evaluations
+CELL_BATCH_SIZE = 32
+
+# the number of set bits in each byte value, used to count the bits of word array bitmaps
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# word type of the WordArray backend, little-endian so that bit i of word j corresponds to rectangle 64*j + i
+WORD_DTYPE = np.dtype("<u8")
+
+# the storage of each vector of the Compressed backend, dense words or a list of the bytes which differ from a background of all zeros or all ones
+VECTOR_DENSE = 0
+VECTOR_LISTED = 1
+
+# per instance statistics recorded by a traced point query, the counts of searched rects and time in seconds of each stage of the radius search
+TRACE_COUNTS = ["radius_iterations", "rects_matched", "rects_within_radius"]
+TRACE_TIMES = ["rect_query_time", "trim_time", "fit_time", "distance_time"]
+
+# on-disk layout of a saved index, a fixed size header followed by 64 byte aligned array sections
+FILE_MAGIC = b"FACETRBV"
+FILE_VERSION = 2
+# magic, version, reserved, nrects, ndim, max intervals per dimension, bytes per bit vector (padded to whole words)
+FILE_HEADER = struct.Struct("<8sIIQQQQ")
+FILE_ALIGNMENT = 64
+
+
+class TopK():
+    '''
+    The k nearest hyper-rectangles found so far by a query, kept as a bounded max-heap of (dist, rect_id) pairs so that the furthest of the k is always at the root. Candidates further than the current k-th distance or max_dist are discarded as soon as they are scored, so the memory used is O(k) no matter how many rects the query checks. Ties are broken by rect id, giving the same result as sorting every scored pair
+    '''
+
+    def __init__(self, k: int, max_dist: float = np.inf):
+        '''
+        Parameters
+        ----------
+        k: the number of rects to keep, if None keep every rect within max_dist
+        max_dist: the maximum distance of a kept rect
+        '''
+        self.k = k
+        self.max_dist = max_dist
+        # entries are (-dist, -rect_id) so that the root of python's min-heap is the worst kept pair
+        self.heap: list[tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def full(self) -> bool:
+        '''
+        Returns true iff k rects have been found
+        '''
+        return self.k is not None and len(self.heap) >= self.k
+
+    def bound(self) -> float:
+        '''
+        Returns the distance beyond which a rect can no longer enter the top-k, the k-th distance once k rects are found and max_dist until then
+        '''
+        if self.full():
+            return min(-self.heap[0][0], self.max_dist)
+        return self.max_dist
+
+    def push(self, dists: np.ndarray, rect_ids: np.ndarray) -> None:
+        '''
+        Offers the given scored rects to the top-k, keeping those which are nearer than the current k-th rect
+
+        Parameters
+        ----------
+        dists: a numpy array of the distance to each rect
+        rect_ids: a numpy array of the ids of the rects
+        '''
+        keep = dists <= self.bound()
+        for dist, rect_id in zip(dists[keep].tolist(), rect_ids[keep].tolist()):
+            if self.full():
+                heapq.heappushpop(self.heap, (-dist, -rect_id))
+            else:
+                heapq.heappush(self.heap, (-dist, -rect_id))
+
+    def rect_ids(self) -> np.ndarray:
+        '''
+        Returns the ids of the kept rects ordered by increasing distance
+        '''
+        return np.array([-rect_id for _, rect_id in sorted(self.heap, reverse=True)], dtype=int)
+
+    def dists(self) -> np.ndarray:
+        '''
+        Returns the distances of the kept rects ordered by increasing distance, matching the order of rect_ids
+        '''
+        return np.array([-dist for dist, _ in sorted(self.heap, reverse=True)], dtype=float)
+
+    def furthest(self) -> float:
+        '''
+        Returns the distance of the furthest kept rect, inf if none have been kept
+        '''
+        if len(self.heap) == 0:
+            return np.inf
+        return -self.heap[0][0]
+
+
+class CompressedVectors():
+    '''
+    A set of equal length bit vectors compressed in the manner of Roaring bitmap containers. Each vector is stored either densely as words, or if most of its bytes are all zeros or all ones, as that background byte and a sorted list of the (position, value) of the bytes which differ from it. Redundant bit vectors are nested prefix and suffix sets, so the vectors of the first and last intervals of an axis on which most rects are unbounded are nearly all ones and compress well. Bitmaps are ANDed with the vectors without decompressing them, see and_vectors
+    '''
+
+    def __init__(self, words: np.ndarray):
+        '''
+        Parameters
+        ----------
+        words: an array of shape (nvectors, nwords) of the vectors to compress as rows of WORD_DTYPE words
+        '''
+        self.nwords = words.shape[1]
+        vector_bytes = np.ascontiguousarray(words).view(np.uint8).reshape(words.shape[0], self.nwords * WORD_DTYPE.itemsize)
+        nzeros = (vector_bytes == 0).sum(axis=1)
+        nones = (vector_bytes == 0xFF).sum(axis=1)
+        # a listed byte costs 5 bytes against 1 byte in a dense vector, list a vector's bytes if it saves memory
+        self.backgrounds = np.where(nones > nzeros, 0xFF, 0).astype(np.uint8)
+        nlisted = vector_bytes.shape[1] - np.maximum(nzeros, nones)
+        self.kinds = np.where(5 * nlisted < vector_bytes.shape[1], VECTOR_LISTED, VECTOR_DENSE).astype(np.uint8)
+
+        # the row of each dense vector in self.dense, and the range of each listed vector's bytes in self.byte_ids and self.byte_values
+        is_dense = (self.kinds == VECTOR_DENSE)
+        self.slots = np.full(shape=(words.shape[0],), fill_value=-1, dtype=np.int64)
+        self.slots[is_dense] = np.arange(is_dense.sum())
+        self.dense = np.ascontiguousarray(words[is_dense])
+        listed = ~is_dense[:, np.newaxis] & (vector_bytes != self.backgrounds[:, np.newaxis])
+        vector_ids, byte_ids = np.nonzero(listed)  # in order of vector then byte
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(vector_ids, minlength=words.shape[0]))])
+        self.byte_ids = byte_ids.astype(np.uint32)
+        self.byte_values = vector_bytes[vector_ids, byte_ids]
+
+    @property
+    def nbytes(self) -> int:
+        '''
+        The memory used to store the compressed vectors in bytes
+        '''
+        return (self.kinds.nbytes + self.backgrounds.nbytes + self.slots.nbytes + self.dense.nbytes + self.starts.nbytes
+                + self.byte_ids.nbytes + self.byte_values.nbytes)
+
+    def listed_bytes(self, vector_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Gathers the listed bytes of each of the given listed vectors
+
+        Returns
+        -------
+        (rows, byte_ids, byte_values): for each listed byte the index of its vector in vector_ids, its position in the vector, and its value
+        '''
+        counts = self.starts[vector_ids + 1] - self.starts[vector_ids]
+        rows = np.repeat(np.arange(vector_ids.shape[0]), counts)
+        # the ith listed byte of row r is at self.starts[vector_ids[r]] + i
+        offsets = np.repeat(self.starts[vector_ids] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+        return rows, self.byte_ids[offsets], self.byte_values[offsets]
+
+    def to_words(self) -> np.ndarray:
+        '''
+        Decompresses the vectors into an array of shape (nvectors, nwords)
+        '''
+        vector_bytes = np.repeat(self.backgrounds[:, np.newaxis], self.nwords * WORD_DTYPE.itemsize, axis=1)
+        listed_ids = np.flatnonzero(self.kinds == VECTOR_LISTED)
+        rows, byte_ids, byte_values = self.listed_bytes(listed_ids)
+        vector_bytes[listed_ids[rows], byte_ids] = byte_values
+        words = vector_bytes.view(WORD_DTYPE)
+        words[self.kinds == VECTOR_DENSE] = self.dense
+        return words
+
+    def extend(self, words: np.ndarray, first_word: int) -> None:
+        '''
+        Grows the vectors by ORing the given words into them starting at word first_word, such as the bits of newly added rects whose first word continues the last partially filled word of the vectors. The words before first_word are left compressed as they are, and each vector keeps its kind and background, unless a listed vector grows to list too many bytes to save memory, in which case the vectors are recompressed
+
+        Parameters
+        ----------
+        words: an array of shape (nvectors, nnew_words) of WORD_DTYPE words, where words[:, 0] is ORed into word first_word of each vector and the rest are appended
+        first_word: the position of the first word to OR into, at most nwords
+        '''
+        nvectors = self.kinds.shape[0]
+        is_dense = (self.kinds == VECTOR_DENSE)
+        first_byte = first_word * WORD_DTYPE.itemsize
+        words = words.copy()
+        if first_word < self.nwords:
+            # decompress the partially filled word the new words continue
+            partial_bytes = np.repeat(self.backgrounds[:, np.newaxis], WORD_DTYPE.itemsize, axis=1)
+            listed_ids = np.flatnonzero(~is_dense)
+            rows, byte_ids, byte_values = self.listed_bytes(listed_ids)
+            in_word = (byte_ids >= first_byte) & (byte_ids < first_byte + WORD_DTYPE.itemsize)
+            partial_bytes[listed_ids[rows[in_word]], byte_ids[in_word] - first_byte] = byte_values[in_word]
+            partial_words = partial_bytes.view(WORD_DTYPE)[:, 0]
+            partial_words[is_dense] = self.dense[:, first_word]
+            words[:, 0] |= partial_words
+        self.nwords = first_word + words.shape[1]
+        self.dense = np.ascontiguousarray(np.concatenate([self.dense[:, :first_word], words[is_dense]], axis=1))
+
+        # keep the listed bytes before first_byte and list the bytes of the new words which differ from each vector's background
+        vector_bytes = words.view(np.uint8).reshape(nvectors, words.shape[1] * WORD_DTYPE.itemsize)
+        old_vectors = np.repeat(np.arange(nvectors), np.diff(self.starts))
+        kept = self.byte_ids < first_byte
+        new_vectors, new_byte_ids = np.nonzero(~is_dense[:, np.newaxis] & (vector_bytes != self.backgrounds[:, np.newaxis]))
+        vector_ids = np.concatenate([old_vectors[kept], new_vectors])
+        # a stable sort by vector keeps each vector's old bytes before its new bytes, so the bytes stay in order of position
+        order = np.argsort(vector_ids, kind="stable")
+        self.byte_ids = np.concatenate([self.byte_ids[kept], (new_byte_ids + first_byte).astype(np.uint32)])[order]
+        self.byte_values = np.concatenate([self.byte_values[kept], vector_bytes[new_vectors, new_byte_ids]])[order]
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(vector_ids, minlength=nvectors))])
+
+        nlisted = np.diff(self.starts)
+        if (~is_dense & (5 * nlisted >= self.nwords * WORD_DTYPE.itemsize)).any():
+            self.__init__(self.to_words())
+
+    def and_vectors(self, words: np.ndarray, vector_ids: np.ndarray) -> np.ndarray:
+        '''
+        ANDs each of a batch of bitmaps with a set of the vectors. Dense vectors are ANDed word by word, while ANDing with a listed vector only touches its listed bytes, or with a zeros background clears everything else, so the all ones vectors of unbounded axes cost nothing
+
+        Parameters
+        ----------
+        words: an array of shape (nbitmaps, nwords) of the bitmaps to AND into, such as the live vector of each query
+        vector_ids: an integer array of shape (nbitmaps, nvectors_per_bitmap) of the vectors to AND with each bitmap
+
+        Returns
+        -------
+        matching_words: an array of shape (nbitmaps, nwords)
+        '''
+        matching_words = words.copy()
+        matching_bytes = matching_words.view(np.uint8)
+        for j in range(vector_ids.shape[1]):
+            kinds = self.kinds[vector_ids[:, j]]
+            is_dense = (kinds == VECTOR_DENSE)
+            if is_dense.any():
+                matching_words[is_dense] &= self.dense[self.slots[vector_ids[is_dense, j]]]
+            listed = np.flatnonzero(kinds == VECTOR_LISTED)
+            if listed.shape[0] > 0:
+                rows, byte_ids, byte_values = self.listed_bytes(vector_ids[listed, j])
+                zeros_background = (self.backgrounds[vector_ids[listed, j]] == 0)
+                if zeros_background.any():
+                    # keep only the listed bytes of bitmaps whose vector is mostly zeros
+                    kept = matching_bytes[listed[rows], byte_ids]
+                    matching_bytes[listed[zeros_background]] = 0
+                    matching_bytes[listed[rows], byte_ids] = kept
+                matching_bytes[listed[rows], byte_ids] &= byte_values
+        return matching_words
 
 
 class BitVectorIndex():
@@ -37,11 +284,22 @@ class BitVectorIndex():
         self.ndimensions = self.rects.shape[1]
 
         # select the partition values for each interval
-        self.intervals, self.interval_dividers, self.indexed_dimensions = self.generate_intervals(self.rects)
-        if self.verbose:
-            print("N Indexed Dimensions:", sum(self.indexed_dimensions))
-        self.rbv = self.build_bit_vectors(self.rects)
+        self.set_intervals(self.rects)
+        # rectangles are deleted by clearing their bit in the live vector, their ids stay reserved
+        self.live: bitarray = bitzeros(self.nrects, endian=BIT_ORDER)
+        self.live.setall(1)
+        # the bit vectors are stored in self.rbv for the BitArray backend, self.rbv_words for the WordArray backend, and self.rbv_compressed for the Compressed backend
+        self.rbv: list[list[list[bitarray]]] = None
+        self.rbv_words: np.ndarray = None
+        self.rbv_compressed: CompressedVectors = None
+        # least recently used point query results, emptied whenever the indexed rects change
+        self.query_cache: OrderedDict = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.build_vectors()
         self.search_log = []  # for experiments store the # of rects search for each sample explained
+        self.cell_log = []  # for experiments store the # of cells visited by each best first search
+        self.trace_log = []  # when tracing, a dict of search statistics for each point query, see _point_query_batch
 
     def point_query(self, instance: np.ndarray,
                     constraints: np.ndarray = None,
@@ -73,274 +331,739 @@ class BitVectorIndex():
         -------
         `closest-rect`: the nearest hyper-rectangle subject to the user considerations, array of shape (ndim, 2)
         '''
-        # create a hyper-sphere around the point and indentify which intervals it covers. We do this by creating a hyper-sphere with the initial radius, converting it to a hyper-rectangle, and searching for records in that rect
-        closest_rect = None
-        closest_dist = np.inf
-        solution_found = False
-        search_complete = False  # we have searched the entire constraint range
+        return self.point_query_batch(instance[np.newaxis, :], constraints, weights, 1, max_dist, min_robust, min_widths)[0]
+
+    def k_point_query(self, instance: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None, return_ids: bool = False) -> np.ndarray:
+        '''
+        Uses the bit vector index to the k nearest hyper-rectangles to the given point subject to user considerations
+
+        Parameters
+        ----------
+        instance: a numpy array of shape (ndim,) to search around
+        `constraints`: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis
+        `weights`: a numpy array of shape (ndim) representing the user's willingness to change each feature with higher weight indicating more willing to change
+        `max_dist`: a float value indicating the maximum weighted radial distance to search s.t. d(x,x') <= max_dist
+        `min_robust`      : the minimum radial robustness an explanation must meet, applied to all features
+        `min_widths`      : array of shape (features,) where min_widths[i] is the min required robustness of xprime[i]
+        `return_ids`      : if true also return the ids of the nearest hyper-rectangles
+
+
+        Returns
+        -------
+        `closeset_rects`: a list of of arrays of shape (ndim, 2) of the nearest hyper-rectangles. Can return [0, nrecords] elements depending on the parmaterization of k. If return_ids is true, a tuple (rect_ids, rects) of the ids and an array of shape (nfound, ndim, 2) of the hyper-rectangles instead
+        '''
+        return self.point_query_batch(instance[np.newaxis, :], constraints, weights, k, max_dist, min_robust, min_widths, return_ids)[0]
+
+    def point_query_batch(self, instances: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None, return_ids: bool = False) -> list:
+        '''
+        Uses the bit vector index to find the nearest hyper-rectangle(s) to each of the given points subject to the same user considerations. Gives the same results as calling point_query once per instance, but all instances grow their search radius in lock step so that the interval lookups, candidate filtering, and distance computations of each radius step are shared across the batch. If cache_size is nonzero, queries whose results are in the least recently used query cache are answered from it and only the rest are searched
+
+        Parameters
+        ----------
+        instances: a numpy array of shape (ninstances, ndim) of the points to search around
+        `constraints`: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis
+        `weights`: a numpy array of shape (ndim) representing the user's willingness to change each feature with higher weight indicating more willing to change
+        `k`: the number of hyper-rectangles to find for each instance, if None find all rects within max_dist
+        `max_dist`: a float value indicating the maximum weighted radial distance to search s.t. d(x,x') <= max_dist
+        `min_robust`      : the minimum radial robustness an explanation must meet, applied to all features
+        `min_widths`      : array of shape (features,) where min_widths[i] is the min required robustness of xprime[i]
+        `return_ids`      : for k != 1, if true return the ids of the nearest hyper-rectangles along with them
+
+        Returns
+        -------
+        `results`: a list of length ninstances where results[i] is the point_query result for instances[i]. For k=1 this is the nearest hyper-rectangle of shape (ndim, 2) or None, otherwise a list of the nearest hyper-rectangles, or a tuple (rect_ids, rects) if return_ids is true
+        '''
+        if self.cache_size == 0:
+            return self._point_query_batch(instances, constraints, weights, k, max_dist, min_robust, min_widths, return_ids)
+
+        results = [None for _ in range(instances.shape[0])]
+        # the instances of each query which isn't cached, repeats of a query within the batch are searched once
+        pending: dict[bytes, list[int]] = {}
+        for i in range(instances.shape[0]):
+            key = query_key(instances[i], constraints, weights, k, max_dist, min_robust, min_widths, return_ids)
+            if key in self.query_cache:
+                self.query_cache.move_to_end(key)
+                results[i] = copy_result(self.query_cache[key])
+            else:
+                pending.setdefault(key, []).append(i)
+        self.cache_misses += len(pending)
+        self.cache_hits += instances.shape[0] - len(pending)
+
+        ntraced = len(self.trace_log)
+        first_ids = np.array([ids[0] for ids in pending.values()], dtype=int)
+        if len(pending) > 0:
+            searched = self._point_query_batch(instances[first_ids], constraints, weights, k, max_dist, min_robust, min_widths, return_ids)
+            for (key, ids), result in zip(pending.items(), searched):
+                self.query_cache[key] = result
+                for i in ids:
+                    results[i] = copy_result(result)
+            # evict the least recently used results
+            while len(self.query_cache) > self.cache_size:
+                self.query_cache.popitem(last=False)
+
+        if self.tracing:
+            # number the traces of the searched instances by their position in this batch and add one for each instance answered from the cache
+            for row in self.trace_log[ntraced:]:
+                row["instance"] = int(first_ids[row["instance"]])
+            searched_ids = set(first_ids.tolist())
+            self.trace_log.extend({"instance": i, "cache_hit": True} for i in range(instances.shape[0]) if i not in searched_ids)
+            self.trace_log[ntraced:] = sorted(self.trace_log[ntraced:], key=lambda row: row["instance"])
+        return results
+
+    def _point_query_batch(self, instances: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None, return_ids: bool = False, shared_bounds: np.ndarray = None, return_dists: bool = False) -> list:
+        '''
+        Implements point_query_batch without the query cache. For k=1 return_ids gives a tuple (rect_ids, rects) of the zero or one nearest hyper-rectangles. If return_dists is also true the tuple is (rect_ids, rects, dists) with the distance the search found to each rect, for merging the results of several searches without fitting the instance to the rects again. If shared_bounds is given, an array of shape (ninstances,) shared with searches of other indexes of the same class, each instance's search stops growing its radius beyond shared_bounds[i] and lowers it to the k-th distance found so far, such that all rects within the final bound are found. Any bound written is the k-th distance of some search's results, so concurrent unsynchronized updates only loosen the bound, never invalidate it. If tracing is enabled a dict of search statistics is appended to trace_log for each instance, with its position in the batch, the number of radius iterations and final search radius, the number of rects matched by the rect queries and how many of those were within the search radius of the step (the rest are index false positives), the time spent in the rect queries, trimming candidates to the constraints, fitting the instance to them, and computing distances, and the final distance
+        '''
+        # create a hyper-sphere around each point and indentify which intervals it covers. We do this by creating a hyper-sphere with the initial radius, converting it to a hyper-rectangle, and searching for records in that rect
+        ninstances = instances.shape[0]
+        single = (k == 1)
 
         # construct the minimum robustness for each featuer if provided
         if min_robust is not None and min_widths is None:
-            min_widths = np.tile(min_robust, instance.shape[0])
+            min_widths = np.tile(min_robust, self.ndimensions)
         elif min_robust is not None and min_widths is not None:
             min_widths = np.maximum(min_robust, min_widths)
+        # only rects in the constraints region which are wide enough to satisfy the robustness requirements are searched
+        searchable, nsearchable = self.searchable_bitmap(min_widths, constraints)
 
-        # bit vector for the rects we have already checked the distance to
-        searched_bits = bitzeros(self.nrects)
-        n_searched_rects = 0
-        search_radius = self.initial_radius
-        while not solution_found and not search_complete:
-            # convert the query hypersphere into a hyperrectangle
-            query_rect = np.zeros(shape=(self.ndimensions, 2))
-            if weights is not None:
-                query_rect[:, LOWER] = (instance - weights * search_radius)
-                query_rect[:, UPPER] = (instance + weights * search_radius)
-            else:
-                query_rect[:, LOWER] = (instance - search_radius)
-                query_rect[:, UPPER] = (instance + search_radius)
+        # the search state of each instance
+        searching = np.ones(shape=(ninstances,), dtype=bool)  # neither a solution was found nor is the search complete
+        search_complete = np.zeros(shape=(ninstances,), dtype=bool)  # we have searched the entire constraint range
+        if k is None and max_dist < np.inf:
+            search_radii = np.tile(float(max_dist), ninstances)
+        else:
+            search_radii = np.tile(float(self.initial_radius), ninstances)
+        # bit vectors for the rects we have already checked the distance to
+        searched_bits = self.empty_bitmaps(ninstances)
+        n_searched_rects = np.zeros(shape=(ninstances,), dtype=int)
+        search_steps = np.tile(float(self.radius_step), ninstances)
+        # for k=1 the best solution so far, otherwise the k nearest searched hyper-rects
+        closest_rects = [None for _ in range(ninstances)]
+        closest_ids = np.zeros(shape=(ninstances,), dtype=int)
+        closest_dists = np.tile(np.inf, ninstances)
+        top_ks = [TopK(k, max_dist) for _ in range(ninstances)]
+        tracing = self.tracing
+        if tracing:
+            trace_counts = {field: np.zeros(shape=(ninstances,), dtype=int) for field in TRACE_COUNTS}
+            trace_times = {field: np.zeros(shape=(ninstances,)) for field in TRACE_TIMES}
+            trace_radii = np.zeros(shape=(ninstances,))
+
+        while searching.any():
+            batch_ids = np.flatnonzero(searching)
+            radii = search_radii[batch_ids]
+            solution_found = np.zeros(shape=(batch_ids.shape[0],), dtype=bool)
+            found_new_rects = np.zeros(shape=(batch_ids.shape[0],), dtype=bool)
+            limits = np.tile(float(max_dist), batch_ids.shape[0])
+            if shared_bounds is not None:
+                # other searches have found results this near, no further rect can be among the nearest
+                limits = np.minimum(limits, shared_bounds[batch_ids])
+            # if we've exceeded the max_dist, do final pass then exit
+            if not single:
+                exceeded = radii > limits
+                search_complete[batch_ids[exceeded]] = True
+                radii[exceeded] = limits[exceeded]
+
+            if tracing:
+                trace_counts["radius_iterations"][batch_ids] += 1
+                trace_radii[batch_ids] = radii
+                step_start = time.perf_counter()
 
-            empty_query_region = False
+            # convert the query hyperspheres into hyperrectangles
+            query_rects = self.query_rects(instances[batch_ids], radii, weights)
+
+            empty_query_region = np.zeros(shape=(batch_ids.shape[0],), dtype=bool)
             # if applicable restrict the search radius to the user provided constraints
             if constraints is not None:
-                if have_intersection(query_rect, constraints):
-                    # take intersection of query_rect and constraints if possible
-                    query_rect[:, LOWER] = np.maximum(query_rect[:, LOWER], constraints[:, LOWER])  # raise lower bounds
-                    query_rect[:, UPPER] = np.minimum(query_rect[:, UPPER], constraints[:, UPPER])  # lower upper bounds
-                    # check if the search area encloses the entire constrained region
-                    search_complete = search_complete or (query_rect == constraints).all()
-                else:  # the constraints and search radius result have no overlap, so the query region is empty
-                    empty_query_region = True  # skip the search this iteration
-                    # jump radius to nearest point in constraints region so the next iteration has a nonempty region
-                    test_instance = self.explainer.fit_to_rectangle(instance, constraints)
-                    if test_instance is not None:
-                        dist = self.explainer.distance_fn(instance, test_instance, weights)
-                        search_radius = dist
-                    else:  # the constraints region has no valid instances (e.g. enforces invalid one-hot encoding)
-                        search_radius = np.inf
-                        search_complete = True
-            if search_radius > max_dist:
-                search_complete = True
-                search_radius = max_dist
-
-            if not empty_query_region:
-                # get the set of hyper-rect records in the query rectangle
-                matching_bits = self.rect_query(query_rect)
+                # take intersection of query_rect and constraints if possible
+                empty_query_region = ~have_intersections(query_rects, constraints)
+                query_rects[:, :, LOWER] = np.maximum(query_rects[:, :, LOWER], constraints[:, LOWER])  # raise lower bounds
+                query_rects[:, :, UPPER] = np.minimum(query_rects[:, :, UPPER], constraints[:, UPPER])  # lower upper bounds
+                # check if the search area encloses the entire constrained region
+                encloses = (query_rects == constraints).all(axis=(1, 2)) & ~empty_query_region
+                search_complete[batch_ids[encloses]] = True
+                # the constraints and search radius result have no overlap, so the query region is empty, skip the search this iteration and jump radius to nearest point in constraints region so the next iteration has a nonempty region
+                if empty_query_region.any():
+                    jump_ids = batch_ids[empty_query_region]
+                    jump_constraints = np.broadcast_to(constraints, (jump_ids.shape[0],) + constraints.shape)
+                    test_instances, valid = self.explainer.fit_to_rectangles(instances[jump_ids], jump_constraints)
+                    jump_radii = np.tile(np.inf, jump_ids.shape[0])
+                    jump_radii[valid] = self.explainer.distance_fn(instances[jump_ids][valid], test_instances[valid], weights)
+                    radii[empty_query_region] = jump_radii
+                    # the constraints region has no valid instances (e.g. enforces invalid one-hot encoding)
+                    search_complete[jump_ids[~valid]] = True
+            if single:
+                exceeded = radii > limits
+                search_complete[batch_ids[exceeded]] = True
+                radii[exceeded] = limits[exceeded]
+
+            # get the set of new hyper-rect records in each nonempty query rectangle
+            query_idxs = np.flatnonzero(~empty_query_region)
+            lower_intervals, upper_intervals = self.interval_ids(query_rects[query_idxs])
+            all_matching_bits = self.match_intervals_batch(lower_intervals, upper_intervals, searchable)
+            candidate_ids = []
+            for j, idx in enumerate(query_idxs):
+                i = batch_ids[idx]
                 # exclude rectangles which we have already checked the distance to
-                new_match_bits = (matching_bits & ~searched_bits)
-                n_new_rects = new_match_bits.count()
-                n_searched_rects += n_new_rects
+                new_match_bits = (all_matching_bits[j] & ~searched_bits[i])
+                n_new_rects = bitmap_count(new_match_bits)
+                found_new_rects[idx] = (n_new_rects > 0)
+                n_searched_rects[i] += n_new_rects
                 # check if if we've searched every hyper-rectangle
-                search_complete = search_complete or (n_searched_rects == self.nrects)
-
-                # if we have new matches, check their distance
+                if n_searched_rects[i] == nsearchable:
+                    search_complete[i] = True
+                # record the new matches as searched
                 if n_new_rects > 0:
-                    # record the new matches as searched
-                    searched_bits |= new_match_bits
-                    # expand the packed bitarry to an array of booleans
-                    new_match_slice = np.array(new_match_bits.tolist(), dtype=bool)
-                    # get the matching rectangles
-                    new_rects = self.rects[new_match_slice]
-                    # search the matching rects for the nearest rectangle within the search radius. Its possible that the matching set is non-empty due to a rectangle in an unindexed dimension that is further than the search radius, which is not guaranteed to be the nearest to the point
-                    for rect in new_rects:
-                        # if applicable only consider the rectangle if it falls within the constraints
-                        if constraints is None or have_intersection(rect, constraints):
-                            if constraints is not None:  # take only part of rect which falls in constraints
-                                rect[:, LOWER] = np.maximum(rect[:, LOWER], constraints[:, LOWER])  # raise lower bounds
-                                rect[:, UPPER] = np.minimum(rect[:, UPPER], constraints[:, UPPER])  # lower upper bounds
-                            # check that the found rectangle is larger than the robustness requiremetns
-                            if min_widths is None or ((rect[:, UPPER] - rect[:, LOWER]) >= min_widths).all():
-                                # check the distance to the found rectangle
-                                test_instance = self.explainer.fit_to_rectangle(instance, rect)
-                                if test_instance is not None:
-                                    dist = self.explainer.distance_fn(instance, test_instance, weights)
-                                    # if its closer than the best solution so far, save it
-                                    if dist < closest_dist:
-                                        closest_rect = rect
-                                        closest_dist = dist
-
-                # if the best solution falls within the search radius, exit
-                solution_found = (closest_dist <= search_radius)
-                # if we've searched the whole constraints region and found no solution, or an invalid one
-                if search_complete and (closest_dist > max_dist):
-                    closest_rect = None  # return Null
-
-            search_radius = self.grow_radius(search_radius)
+                    searched_bits[i] |= new_match_bits
+                # unpack the bitmap and get the ids of the matching rectangles
+                candidate_ids.append(bitmap_to_ids(new_match_bits))
+
+            # filter matching rects for those which fall within the constraints region and compute their dists
+            query_instances = batch_ids[query_idxs]
+            timings = None
+            if tracing:
+                # the rect queries are shared by the batch, split their time evenly
+                trace_times["rect_query_time"][batch_ids] += (time.perf_counter() - step_start) / batch_ids.shape[0]
+                ncandidates = np.array([ids.shape[0] for ids in candidate_ids], dtype=int)
+                trace_counts["rects_matched"][query_instances] += ncandidates
+                timings = {field: 0.0 for field in TRACE_TIMES}
+            # the distance beyond which a rect can no longer improve each instance's result
+            if single:
+                max_dists = np.minimum(closest_dists[query_instances], limits[query_idxs])
+            else:
+                max_dists = np.minimum([top_ks[i].bound() for i in query_instances], limits[query_idxs])
+            scored = self.evaluate_candidates(instances[query_instances], candidate_ids, constraints, weights, min_widths, timings, max_dists)
+            if tracing and ncandidates.sum() > 0:
+                # split the time of scoring the candidates by each instance's share of them
+                for field in ["trim_time", "fit_time", "distance_time"]:
+                    trace_times[field][query_instances] += timings[field] * ncandidates / ncandidates.sum()
+            for idx, i, (new_rect_ids, new_rects, new_dists) in zip(query_idxs, query_instances, scored):
+                if tracing:
+                    trace_counts["rects_within_radius"][i] += np.count_nonzero(new_dists <= radii[idx])
+                if single:
+                    if new_dists.shape[0] > 0:
+                        # argmin takes the first of any tied rects, matching a scan in order of rect id
+                        nearest = np.argmin(new_dists)
+                        # if its closer than the best solution so far, save it
+                        if new_dists[nearest] < closest_dists[i]:
+                            closest_rects[i] = new_rects[nearest]
+                            closest_ids[i] = new_rect_ids[nearest]
+                            closest_dists[i] = new_dists[nearest]
+                    # if the best solution falls within the search radius, exit
+                    solution_found[idx] = (closest_dists[i] <= radii[idx])
+                    # if we've searched the whole constraints region and found no solution, or an invalid one
+                    if search_complete[i] and (closest_dists[i] > max_dist):
+                        closest_rects[i] = None  # return Null
+                else:
+                    # record the rects which are nearer than the current k-th
+                    top_ks[i].push(new_dists, new_rect_ids)
+
+            # if the closest k rects fall within the search radius sufficent solutions were found, search complete
+            if not single and k is not None:
+                for idx, i in enumerate(batch_ids):
+                    solution_found[idx] = top_ks[i].full() and (top_ks[i].bound() <= radii[idx])
+            if shared_bounds is not None:
+                # share the k-th distance found so far with the other searches
+                if single:
+                    found_bounds = closest_dists[batch_ids]
+                else:
+                    found_bounds = np.array([top_ks[i].bound() for i in batch_ids])
+                shared_bounds[batch_ids] = np.minimum(shared_bounds[batch_ids], found_bounds)
+            if self.radius_growth == "Auto":
+                # double the step of queries whose last step found nothing new, they are in an empty part of the space
+                stalled = ~found_new_rects & ~empty_query_region
+                search_steps[batch_ids[stalled]] *= 2
+            search_radii[batch_ids] = self.grow_radius(radii, search_steps[batch_ids])
+            searching[batch_ids] = ~solution_found & ~search_complete[batch_ids]
+
+        if single:
+            results = closest_rects
+            if return_ids:
+                results = [(np.array([closest_ids[i]]), closest_rects[i][np.newaxis]) if closest_rects[i] is not None
+                           else (np.zeros(shape=(0,), dtype=int), np.zeros(shape=(0, self.ndimensions, 2))) for i in range(ninstances)]
+                if return_dists:
+                    results = [(rect_ids, rects, closest_dists[i:i + 1] if rect_ids.shape[0] > 0 else np.zeros(shape=(0,)))
+                               for i, (rect_ids, rects) in enumerate(results)]
+        else:
+            results = [top_k_rects(self.rects, top_ks[i], constraints) for i in range(ninstances)]
+            if not return_ids:
+                results = [list(closest) for _, closest in results]
+            elif return_dists:
+                results = [(rect_ids, closest, top_ks[i].dists()) for i, (rect_ids, closest) in enumerate(results)]
+
         # Experiment logging
-        nrects_searched = searched_bits.count()
-        self.search_log.append(nrects_searched)
-        if self.verbose:
-            print(nrects_searched)
+        for i in range(ninstances):
+            nrects_searched = bitmap_count(searched_bits[i])
+            self.search_log.append(nrects_searched)
+            if self.verbose:
+                print(nrects_searched)
+            if tracing:
+                row = {"instance": i, "cache_hit": False}
+                row.update({field: int(trace_counts[field][i]) for field in TRACE_COUNTS})
+                row.update({field: float(trace_times[field][i]) for field in TRACE_TIMES})
+                if row["rects_matched"] > 0:
+                    row["false_positive_rate"] = 1 - row["rects_within_radius"] / row["rects_matched"]
+                else:
+                    row["false_positive_rate"] = 0.0
+                row["final_radius"] = float(trace_radii[i])
+                if single:
+                    row["final_dist"] = float(closest_dists[i]) if closest_rects[i] is not None else np.inf
+                else:
+                    row["final_dist"] = float(top_ks[i].furthest())
+                row["nrects_searched"] = nrects_searched
+                self.trace_log.append(row)
 
-        return closest_rect
+        return results
 
-    def grow_radius(self, radius: float) -> float:
-        if self.radius_growth == "Linear":
-            return radius + self.radius_step
-        elif self.radius_growth == "Exponential":
-            return radius * self.radius_step
+    def best_first_query_batch(self, instances: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None) -> list:
+        '''
+        Runs best_first_query for each of the given instances, taking the same arguments and returning results in the same format as point_query_batch
+        '''
+        return [self.best_first_query(instance, constraints, weights, k, max_dist, min_robust, min_widths) for instance in instances]
 
-    def k_point_query(self, instance: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None) -> np.ndarray:
+    def best_first_query(self, instance: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None):
         '''
-        Uses the bit vector index to the k nearest hyper-rectangles to the given point subject to user considerations
+        Finds the nearest hyper-rectangle(s) to the given point subject to user considerations by visiting the cells of the grid formed by the intervals in order of their minimum distance to the point. A rectangle's closest point to the instance lies in one of the cells the rectangle overlaps, so once the next cell in the queue is further away than the best rectangle(s) found so far the result is exact. Cells are enumerated lazily from per-axis interval orders, so only the cells which are visited are ever created. The lower bounds assume the weighted euclidean distance used by FACET
 
         Parameters
         ----------
         instance: a numpy array of shape (ndim,) to search around
         `constraints`: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis
         `weights`: a numpy array of shape (ndim) representing the user's willingness to change each feature with higher weight indicating more willing to change
+        `k`: the number of hyper-rectangles to find, if None find all rects within max_dist
         `max_dist`: a float value indicating the maximum weighted radial distance to search s.t. d(x,x') <= max_dist
         `min_robust`      : the minimum radial robustness an explanation must meet, applied to all features
         `min_widths`      : array of shape (features,) where min_widths[i] is the min required robustness of xprime[i]
 
-
         Returns
         -------
-        `closeset_rects`: a list of of arrays of shape (ndim, 2) of the nearest hyper-rectangles. Can return [0, nrecords] elements depending on the parmaterization of k
+        `result`: for k=1 the nearest hyper-rectangle of shape (ndim, 2) or None, otherwise a list of the nearest hyper-rectangles
         '''
-        # create a hyper-sphere around the point and indentify which intervals it covers. We do this by creating a hyper-sphere with the initial radius, converting it to a hyper-rectangle, and searching for records in that rect
-        rect_dists = []  # a priority queue of the dist to each searched hyper-rect, ordered by increasing distance
-        trimmed_rects = {}  # a dict rect_id -> bool. True iff the rect was trimmed to fit in the constraints region
-        solution_found = False
-        search_complete = False  # we have searched the entire constraint range
-
+        single = (k == 1)
         # construct the minimum robustness for each featuer if provided
         if min_robust is not None and min_widths is None:
-            min_widths = np.tile(min_robust, instance.shape[0])
+            min_widths = np.tile(min_robust, self.ndimensions)
         elif min_robust is not None and min_widths is not None:
             min_widths = np.maximum(min_robust, min_widths)
+        if weights is None:
+            weights = np.ones(shape=(self.ndimensions,))
+        # only rects in the constraints region which are wide enough to satisfy the robustness requirements are searched
+        searchable, _ = self.searchable_bitmap(min_widths, constraints)
 
-        # bit vector for the rects we have already checked the distance to
-        rect_ids = np.array(range(self.nrects))  # id each rect by its location in the enumerated list
-        searched_bits = bitzeros(self.nrects)  # keep track of which rects we've already checked
-        n_searched_rects = 0
-        if k is None and max_dist < np.inf:
-            search_radius = max_dist
-        else:
-            search_radius = self.initial_radius
+        # the squared weighted distance from the instance to each interval along each axis, restricted to the constraints
+        lowers = self.intervals[:, :, LOWER].copy()
+        uppers = self.intervals[:, :, UPPER].copy()
+        lowers[~np.array(self.indexed_dimensions)] = -np.inf  # unindexed axes are one unbounded interval
+        uppers[~np.array(self.indexed_dimensions)] = np.inf
+        if constraints is not None:
+            lowers = np.maximum(lowers, constraints[:, LOWER][:, np.newaxis])
+            uppers = np.minimum(uppers, constraints[:, UPPER][:, np.newaxis])
+        gaps = np.maximum(lowers - instance[:, np.newaxis], 0) + np.maximum(instance[:, np.newaxis] - uppers, 0)
+        # changing an unchangeable (zero weight) feature has infinite cost
+        scaled_gaps = np.divide(gaps, weights[:, np.newaxis], out=np.where(gaps > 0, np.inf, 0.0), where=(weights[:, np.newaxis] != 0))
+        costs = np.square(scaled_gaps)
+        costs[lowers > uppers] = np.inf  # the interval falls outside the constraints
+        # unindexed axes have a single interval and contribute a constant cost
+        dims = np.flatnonzero(self.indexed_dimensions)
+        base_cost = costs[~np.array(self.indexed_dimensions), 0].sum()
+        # visit each axis' intervals from nearest to furthest
+        interval_orders = np.argsort(costs[dims], axis=1, kind="stable")
+        sorted_costs = np.take_along_axis(costs[dims], interval_orders, axis=1)
 
-        while not solution_found and not search_complete:
-            # if we've exceeded the max_dist, do final pass then exit
-            if search_radius > max_dist:
-                search_complete = True
-                search_radius = max_dist
-
-            # convert the query hypersphere into a hyperrectangle
-            query_rect = np.zeros(shape=(self.ndimensions, 2))
-            if weights is not None:
-                query_rect[:, LOWER] = (instance - weights * search_radius)
-                query_rect[:, UPPER] = (instance + weights * search_radius)
+        searched_bits = self.empty_bitmaps(1)[0]
+        closest_rect = None
+        closest_dist = np.inf
+        top_k = TopK(k, max_dist)
+
+        def search_threshold() -> float:
+            # the distance beyond which a rect can no longer improve the result
+            if single:
+                return min(closest_dist, max_dist)
             else:
-                query_rect[:, LOWER] = (instance - search_radius)
-                query_rect[:, UPPER] = (instance + search_radius)
+                return top_k.bound()
 
-            empty_query_region = False
-            # if applicable restrict the search radius to the user provided constraints
-            if constraints is not None:
-                if have_intersection(query_rect, constraints):
-                    # take intersection of query_rect and constraints if possible
-                    query_rect[:, LOWER] = np.maximum(query_rect[:, LOWER], constraints[:, LOWER])  # raise lower bounds
-                    query_rect[:, UPPER] = np.minimum(query_rect[:, UPPER], constraints[:, UPPER])  # lower upper bounds
-                    # check if the search area encloses the entire constrained region
-                    search_complete = search_complete or (query_rect == constraints).all()
-                else:  # the constraints and search radius result have no overlap, so the query region is empty
-                    empty_query_region = True  # skip the search this iteration
-                    # jump radius to nearest point in constraints region so the next iteration has a nonempty region
-                    test_instance = self.explainer.fit_to_rectangle(instance, constraints)
-                    if test_instance is not None:
-                        dist = self.explainer.distance_fn(instance, test_instance, weights)
-                        search_radius = dist
-                    else:  # the constraints region has no valid instances (e.g. enforces invalid one-hot encoding)
-                        search_radius = np.inf
-                        search_complete = True
-            if not empty_query_region:
-                # get the set of hyper-rect records in the query rectangle
-                matching_bits = self.rect_query(query_rect)
-                # exclude rectangles which we have already checked the distance to
-                new_match_bits = (matching_bits & ~searched_bits)
-                n_new_rects = new_match_bits.count()
-                n_searched_rects += n_new_rects
-                # check if if we've searched every hyper-rectangle
-                search_complete = search_complete or (n_searched_rects == self.nrects)
+        def check_rects(new_rect_ids: np.ndarray) -> None:
+            # filter the rects for those which satisfy the user considerations and record the closest
+            nonlocal closest_rect, closest_dist
+            new_rect_ids, new_rects, new_dists = self.evaluate_candidates(
+                instance[np.newaxis, :], [new_rect_ids], constraints, weights, min_widths, max_dists=np.array([search_threshold()]))[0]
+            if single:
+                if new_dists.shape[0] > 0:
+                    nearest = np.argmin(new_dists)
+                    if new_dists[nearest] < closest_dist:
+                        closest_rect = new_rects[nearest]
+                        closest_dist = new_dists[nearest]
+            else:
+                top_k.push(new_dists, new_rect_ids)
 
-                # if we have new matches, check their distance
-                if n_new_rects > 0:
-                    # record the new matches as searched
-                    searched_bits |= new_match_bits
-                    # expand the packed bitarry to an array of booleans
-                    new_match_slice = np.array(new_match_bits.tolist(), dtype=bool)
-                    # get the matching rectangles
-                    new_rects = self.rects[new_match_slice]
-                    new_rect_ids = rect_ids[new_match_slice]
-                    # filter matching rects for those which fall within the constraints region and compute their dists
-                    for rect, rect_id in zip(new_rects, new_rect_ids):
-                        # if applicable only consider the rectangle if it falls within the constraints
-                        if constraints is None or have_intersection(rect, constraints):
-                            if constraints is not None:  # take only part of rect which falls in constraints
-                                rect[:, LOWER] = np.maximum(rect[:, LOWER], constraints[:, LOWER])  # raise lower bounds
-                                rect[:, UPPER] = np.minimum(rect[:, UPPER], constraints[:, UPPER])  # lower upper bounds
-                                trimmed_rects[rect_id] = True
-                            # check that the found rectangle is larger than the robustness requiremetns
-                            if min_widths is None or ((rect[:, UPPER] - rect[:, LOWER]) >= min_widths).all():
-                                test_instance = self.explainer.fit_to_rectangle(instance, rect)
-                                if test_instance is not None:
-                                    dist = self.explainer.distance_fn(instance, test_instance, weights)
-                                    # record the dist to this rect on the priority queue
-                                    bisect.insort(rect_dists, (dist, rect_id))
+        # a priority queue of (squared lower bound, interval ranks, last axis incremented), each cell has a unique parent found by decrementing the last incremented axis
+        cell_queue = []
+        first_cost = base_cost + sorted_costs[:, 0].sum()
+        if np.isfinite(first_cost):
+            cell_queue.append((first_cost, (0,) * dims.shape[0], 0))
+        ncells = 0
+        while len(cell_queue) > 0 and cell_queue[0][0] <= search_threshold() ** 2 and ncells < self.max_cells:
+            # pop a block of the nearest cells and create their successors
+            cell_intervals = []
+            while len(cell_queue) > 0 and len(cell_intervals) < CELL_BATCH_SIZE and cell_queue[0][0] <= search_threshold() ** 2:
+                cost, ranks, last = heapq.heappop(cell_queue)
+                cell_intervals.append(interval_orders[np.arange(dims.shape[0]), np.array(ranks, dtype=int)])
+                for j in range(last, dims.shape[0]):
+                    if ranks[j] + 1 < self.intervals.shape[1] and np.isfinite(sorted_costs[j, ranks[j] + 1]):
+                        next_cost = cost - sorted_costs[j, ranks[j]] + sorted_costs[j, ranks[j] + 1]
+                        heapq.heappush(cell_queue, (next_cost, ranks[:j] + (ranks[j] + 1,) + ranks[j+1:], j))
+            ncells += len(cell_intervals)
+            query_intervals = np.full(shape=(len(cell_intervals), self.ndimensions), fill_value=-1, dtype=int)
+            query_intervals[:, dims] = cell_intervals
 
-            # if the closest k rects fall within the search radius sufficent solutions were found, search complete
-            if k is not None:
-                solution_found = (len(rect_dists) >= k) and (rect_dists[k-1][0] <= search_radius)
-            search_radius = self.grow_radius(search_radius)
-
-        # return the top-k closest rects, or all rects within dmax if k is None
-        # return an empty list if no rects were found
-        closest_rects: list[np.ndarray] = []
-        i = 0
-        while i < len(rect_dists) and (k is None or i < k):
-            dist, rect_id = rect_dists[i]
-            if dist <= max_dist:
-                # if only a portion of the rect falls in the constraints region
-                rect = self.rects[rect_id].copy()  # make copy to prevent modifying self.rects
-                if constraints is not None and rect_id in trimmed_rects:  # retrim the rectagle to match constraints
-                    rect[:, LOWER] = np.maximum(rect[:, LOWER], constraints[:, LOWER])  # raise lower bounds
-                    rect[:, UPPER] = np.minimum(rect[:, UPPER], constraints[:, UPPER])  # lower upper bounds
-                closest_rects.append(rect)
-            i += 1
+            # check the rects which overlap any of the cells that we haven't checked yet
+            cell_bits = self.match_intervals_batch(query_intervals, query_intervals, searchable)
+            new_match_bits = bitmap_union(cell_bits) & ~searched_bits
+            searched_bits |= new_match_bits
+            check_rects(bitmap_to_ids(new_match_bits))
+
+        # in high dimensions the number of nearby cells can explode, once the cell budget is spent check the remaining rects in order of the distance to their bounds instead. The result is still exact
+        if ncells >= self.max_cells and len(cell_queue) > 0 and cell_queue[0][0] <= search_threshold() ** 2:
+            remaining_bits = (~searched_bits) & searchable
+            remaining_ids = bitmap_to_ids(remaining_bits)
+            remaining_rects = self.rects[remaining_ids]
+            closest_points = np.clip(instance, remaining_rects[:, :, LOWER], remaining_rects[:, :, UPPER])
+            bounds = self.explainer.distance_fn(instance, closest_points, weights)
+            order = np.argsort(bounds, kind="stable")
+            nchecked = 0
+            while nchecked < order.shape[0] and bounds[order[nchecked]] <= search_threshold():
+                block = order[nchecked:nchecked + CELL_BATCH_SIZE]
+                check_rects(np.sort(remaining_ids[block]))
+                nchecked += block.shape[0]
+            searched_bits |= self.ids_to_bitmap(remaining_ids[order[:nchecked]])
 
         # Experiment logging
-        nrects_searched = searched_bits.count()
+        nrects_searched = bitmap_count(searched_bits)
         self.search_log.append(nrects_searched)
+        self.cell_log.append(ncells)
         if self.verbose:
             print(nrects_searched)
 
-        return closest_rects
+        if single:
+            return closest_rect if closest_dist <= max_dist else None
+        else:
+            return list(top_k_rects(self.rects, top_k, constraints)[1])
 
-    def rect_query(self, query_rect: np.ndarray) -> bitarray:
+    def grow_radius(self, radius: float, step: float = None) -> float:
+        if self.radius_growth == "Linear":
+            return radius + self.radius_step
+        elif self.radius_growth == "Exponential":
+            return radius * self.radius_step
+        elif self.radius_growth == "Auto":
+            # linear growth, but the step is adapted per query
+            return radius + (step if step is not None else self.radius_step)
+
+    def calibrate_radius(self, points: np.ndarray, weights: np.ndarray = None) -> None:
         '''
-        Finds the set of all record hyper-rectangles which overlap the region defined in the query rectangle
+        Chooses the initial radius and step of the "Auto" radius growth from the distribution of distances between a sample of points and their nearest indexed rectangle. The initial radius is the AUTO_INITIAL_QUANTILE of the distances and the step is chosen so the search reaches the AUTO_FINAL_QUANTILE in AUTO_TARGET_STEPS steps. During queries the step is further doubled whenever a step finds no new rectangles
 
         Parameters
         ----------
-        query_rect: a numpy array of shape (ndim, 2) representing the upper/lower bound along each axis to search in
+        points: a numpy array of shape (npoints, ndim) of representative query points, e.g. the training samples which would be explained using this index
+        weights: a numpy array of shape (ndim) of the feature weights to measure distance with
+        '''
+        # evenly subsample the points so that calibration time is bounded
+        if points.shape[0] > self.auto_samples:
+            points = points[np.linspace(0, points.shape[0] - 1, self.auto_samples).astype(int)]
+        self.set_auto_radius(self.nearest_rect_distances(points, weights))
+
+    def set_auto_radius(self, nn_dists: np.ndarray) -> None:
+        '''
+        Sets the initial radius and step of the "Auto" radius growth from the distances between the sample points and their nearest rectangle, see calibrate_radius
+
+        Parameters
+        ----------
+        nn_dists: a numpy array of shape (npoints,) of the distance from each sample point to its nearest rectangle
+        '''
+        self.nn_dists = nn_dists
+        nn_dists = self.nn_dists[np.isfinite(self.nn_dists)]
+        if nn_dists.shape[0] == 0:
+            return
+
+        self.initial_radius = np.quantile(nn_dists, AUTO_INITIAL_QUANTILE)
+        step = (np.quantile(nn_dists, AUTO_FINAL_QUANTILE) - self.initial_radius) / AUTO_TARGET_STEPS
+        if step > 0:  # otherwise keep the configured step
+            self.radius_step = step
+        if self.verbose:
+            print("Auto radius: initial {:.4f}, step {:.4f}".format(self.initial_radius, self.radius_step))
+
+    def nearest_rect_distances(self, points: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+        '''
+        Computes the distance from each point to the nearest live rectangle in the index, measured to the closest point in the rectangle's bounds without considering categorical validity
+
+        Parameters
+        ----------
+        points: a numpy array of shape (npoints, ndim)
+        weights: a numpy array of shape (ndim) of the feature weights to measure distance with
+
+        Returns
+        -------
+        nn_dists: a numpy array of shape (npoints,) of the distance to the nearest rectangle, inf if the index is empty
+        '''
+        live_rects = self.rects[bitmap_to_ids(self.live)]
+        nn_dists = np.tile(np.inf, points.shape[0])
+        if live_rects.shape[0] == 0:
+            return nn_dists
+        for i in range(points.shape[0]):
+            closest_points = np.clip(points[i], live_rects[:, :, LOWER], live_rects[:, :, UPPER])
+            nn_dists[i] = self.explainer.distance_fn(points[i], closest_points, weights).min()
+        return nn_dists
+
+    def query_rects(self, instances: np.ndarray, radii: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+        '''
+        Converts the query hypersphere of the given radius around each instance into a hyperrectangle
+
+        Parameters
+        ----------
+        instances: a numpy array of shape (ninstances, ndim)
+        radii: a numpy array of shape (ninstances,) of the search radius for each instance
+        weights: a numpy array of shape (ndim) of the user's willingness to change each feature, scales the query along each axis
+
+        Returns
+        -------
+        query_rects: a numpy array of shape (ninstances, ndim, 2)
+        '''
+        query_rects = np.zeros(shape=(instances.shape[0], self.ndimensions, 2))
+        if weights is not None:
+            query_rects[:, :, LOWER] = (instances - weights * radii[:, np.newaxis])
+            query_rects[:, :, UPPER] = (instances + weights * radii[:, np.newaxis])
+        else:
+            query_rects[:, :, LOWER] = (instances - radii[:, np.newaxis])
+            query_rects[:, :, UPPER] = (instances + radii[:, np.newaxis])
+        return query_rects
+
+    def evaluate_candidates(self, instances: np.ndarray, candidate_ids: list[np.ndarray], constraints: np.ndarray = None, weights: np.ndarray = None, min_widths: np.ndarray = None, timings: dict = None, max_dists: np.ndarray = None) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        '''
+        Checks the candidate hyper-rectangles of each instance against the user considerations and computes the distance from each instance to its valid candidates. Every candidate is trimmed to the constraints and checked against the robustness requirements once, no matter how many instances it is a candidate for, and the fit and distance for all (instance, candidate) pairs are computed together using array operations
+
+        Parameters
+        ----------
+        instances: a numpy array of shape (ninstances, ndim)
+        candidate_ids: a list of length ninstances, where candidate_ids[i] is an array of ids of the candidate hyper-rectangles for instances[i] in increasing order, drawn from the searchable_bitmap of the constraints
+        `constraints`: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis
+        `weights`: a numpy array of shape (ndim) representing the user's willingness to change each feature
+        `min_widths`: array of shape (ndim,) where min_widths[i] is the min required robustness of xprime[i]
+        `timings`: if provided, a dict to which the seconds spent trimming the candidates, fitting the instances to them, and computing distances are added under trim_time, fit_time, and distance_time
+        `max_dists`: if provided, an array of shape (ninstances,) of the distance beyond which the candidates of each instance can't improve its result, e.g. the current best or k-th best distance. When all features are numeric, candidates whose distance lower bound (see FACET.distance_lower_bounds) exceeds it are left out without being fit
+
+        Returns
+        -------
+        scored: a list of length ninstances of tuples (rect_ids, rects, dists) where rect_ids are the ids of the candidates which satisfy the user considerations, rects are copies of those candidates trimmed to fit in the constraints if provided, and dists are the distances from the instance to each of them
+        '''
+        scored = []
+        start = 0
+        while start < len(candidate_ids):
+            # take as many instances as fit in the pair budget, always at least one
+            end = start + 1
+            npairs = candidate_ids[start].shape[0]
+            while end < len(candidate_ids) and npairs + candidate_ids[end].shape[0] <= MAX_CANDIDATE_PAIRS:
+                npairs += candidate_ids[end].shape[0]
+                end += 1
+            scored.extend(self._evaluate_candidate_pairs(instances[start:end], candidate_ids[start:end], constraints, weights, min_widths, timings,
+                                                         None if max_dists is None else max_dists[start:end]))
+            start = end
+        return scored
+
+    def _evaluate_candidate_pairs(self, instances: np.ndarray, candidate_ids: list[np.ndarray], constraints: np.ndarray = None, weights: np.ndarray = None, min_widths: np.ndarray = None, timings: dict = None, max_dists: np.ndarray = None) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        '''
+        Implements evaluate_candidates for a block of instances whose candidates fit in memory at once
+        '''
+        if timings is not None:
+            stage_start = time.perf_counter()
+        # flatten the candidates into (instance, rect) pairs ordered by instance then rect id
+        pair_owners = np.repeat(np.arange(instances.shape[0]), [ids.shape[0] for ids in candidate_ids])
+        pair_ids = np.concatenate(candidate_ids)
+        unique_ids, pair_unique = np.unique(pair_ids, return_inverse=True)
+
+        rects = self.rects[unique_ids]  # advanced indexing, always a copy of self.rects
+        keep = np.ones(shape=(unique_ids.shape[0],), dtype=bool)
+        # the candidates all intersect the constraints (see searchable_bitmap), take only part of each rect which falls in them
+        if constraints is not None:
+            rects[:, :, LOWER] = np.maximum(rects[:, :, LOWER], constraints[:, LOWER])  # raise lower bounds
+            rects[:, :, UPPER] = np.minimum(rects[:, :, UPPER], constraints[:, UPPER])  # lower upper bounds
+        # check that the found rectangles are larger than the robustness requirements
+        if min_widths is not None:
+            keep &= ((rects[:, :, UPPER] - rects[:, :, LOWER]) >= min_widths).all(axis=1)
+
+        pair_keep = keep[pair_unique]
+        pair_owners = pair_owners[pair_keep]
+        pair_ids = pair_ids[pair_keep]
+        pair_rects = rects[pair_unique[pair_keep]]
+        pair_instances = instances[pair_owners]
+        # skip fitting the rects which are too far from the instance to improve its result
+        if max_dists is not None and self.explainer.ds_info.all_numeric and np.isfinite(max_dists).any():
+            near = self.explainer.distance_lower_bounds(pair_instances, pair_rects, weights) <= max_dists[pair_owners]
+            pair_owners = pair_owners[near]
+            pair_ids = pair_ids[near]
+            pair_rects = pair_rects[near]
+            pair_instances = pair_instances[near]
+        if timings is not None:
+            timings["trim_time"] += time.perf_counter() - stage_start
+            stage_start = time.perf_counter()
+        # fit each instance into each of its remaining rectangles and compute the distances
+        xprimes, fit_valid = self.explainer.fit_to_rectangles(pair_instances, pair_rects)
+        pair_owners = pair_owners[fit_valid]
+        pair_ids = pair_ids[fit_valid]
+        pair_rects = pair_rects[fit_valid]
+        if timings is not None:
+            timings["fit_time"] += time.perf_counter() - stage_start
+            stage_start = time.perf_counter()
+        pair_dists = self.explainer.distance_fn(pair_instances[fit_valid], xprimes[fit_valid], weights)
+        if timings is not None:
+            timings["distance_time"] += time.perf_counter() - stage_start
+
+        # split the pairs back up by instance
+        splits = np.cumsum(np.bincount(pair_owners, minlength=instances.shape[0]))[:-1]
+        return list(zip(np.split(pair_ids, splits), np.split(pair_rects, splits), np.split(pair_dists, splits)))
+
+    def interval_ids(self, query_rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Finds the intervals which the upper and lower edges of each query rectangle fall into along each indexed axis
+
+        Parameters
+        ----------
+        query_rects: a numpy array of shape (nqueries, ndim, 2) representing the upper/lower bound along each axis to search in
+
+        Returns
+        -------
+        lower_intervals, upper_intervals: integer arrays of shape (nqueries, ndim) with the interval of the lower and upper edge of each query along each axis, -1 for unindexed axes
+        '''
+        lower_intervals = np.full(shape=query_rects.shape[:2], fill_value=-1, dtype=int)
+        upper_intervals = np.full(shape=query_rects.shape[:2], fill_value=-1, dtype=int)
+        for dim in range(self.ndimensions):
+            if self.indexed_dimensions[dim]:
+                # searchsorted(arr, val, "right") finds the insertion position i s.t. for j=0..i arr[j] <= val
+                # an edge at inf falls on the last divider, place it in the last interval
+                dividers = np.asarray(self.interval_dividers[dim])
+                last = self.dim_m[dim] - 1
+                lower_intervals[:, dim] = np.minimum(np.searchsorted(dividers, query_rects[:, dim, LOWER], side="right") - 1, last)
+                upper_intervals[:, dim] = np.minimum(np.searchsorted(dividers, query_rects[:, dim, UPPER], side="right") - 1, last)
+        return lower_intervals, upper_intervals
+
+    def match_intervals(self, lower_intervals: np.ndarray, upper_intervals: np.ndarray, searchable: bitarray = None) -> bitarray:
+        '''
+        Finds the set of all record hyper-rectangles which overlap a query whose edges fall in the given intervals
+
+        Parameters
+        ----------
+        lower_intervals, upper_intervals: integer arrays of shape (ndim,) as returned by interval_ids for a single query
+        searchable: the bitarray of the rects to match among as returned by searchable_bitmap, by default all live rects
 
         Returns
         -------
         matching_bits: a bitarray of length nrects with each bit set to one iff the corresponding hyper-rectangle fall in the query region
         '''
-        # start with the set of all record hyper-rectangles 111...11111
-        matching_bits: bitarray = bitzeros(self.nrects)
-        matching_bits.invert()
-        # find the intervals which the upper and lower edges of the query rectangle fall into
+        # start with the set of all live record hyper-rectangles 111...11111
+        matching_bits: bitarray = (self.live if searchable is None else searchable).copy()
+        # select with the intervals which the query rects bound falls into on each axis
         for dim in range(self.ndimensions):
             if self.indexed_dimensions[dim]:
-                # bisect(arr, val) finds the insertion position i s.t. for j=0..i arr[j] <= val
-                # find the intervals which the query rects bound falls into on this axis, and select with them
-                lower_interval = bisect.bisect(self.interval_dividers[dim], query_rect[dim][LOWER]) - 1
-                matching_bits &= self.rbv[dim][LOWER][lower_interval]
-                upper_interval = bisect.bisect(self.interval_dividers[dim], query_rect[dim][UPPER]) - 1
-                matching_bits &= self.rbv[dim][UPPER][upper_interval]
+                matching_bits &= self.rbv[dim][LOWER][lower_intervals[dim]]
+                matching_bits &= self.rbv[dim][UPPER][upper_intervals[dim]]
         return matching_bits
 
+    def match_intervals_batch(self, lower_intervals: np.ndarray, upper_intervals: np.ndarray, searchable=None):
+        '''
+        Finds the set of record hyper-rectangles matching each of a batch of queries. The BitArray backend ANDs the selected bitarrays of one query at a time, while the WordArray backend ANDs the selected interval vectors of every query in the batch into a (nqueries, nwords) array with one array operation per bound. The Compressed backend ANDs the selected compressed vectors of every query in the batch chunk by chunk
+
+        Parameters
+        ----------
+        lower_intervals, upper_intervals: integer arrays of shape (nqueries, ndim) as returned by interval_ids
+        searchable: the bitmap of the rects to match among as returned by searchable_bitmap, by default all live rects
+
+        Returns
+        -------
+        matching_bits: the matching set of each query, a list of bitarrays for the BitArray backend or an array of shape (nqueries, nwords) for the WordArray and Compressed backends
+        '''
+        if self.backend == "BitArray":
+            return [self.match_intervals(lower_intervals[j], upper_intervals[j], searchable) for j in range(lower_intervals.shape[0])]
+        if searchable is None:
+            searchable = self.live_words
+        if self.backend == "Compressed":
+            # the rows of the selected lower and upper bound vectors of each query, shape (nqueries, 2 * nindexed)
+            dims = np.flatnonzero(self.indexed_dimensions)
+            vector_ids = np.concatenate([self.vector_offsets[dims, LOWER] + lower_intervals[:, dims],
+                                         self.vector_offsets[dims, UPPER] + upper_intervals[:, dims]], axis=1)
+            return self.rbv_compressed.and_vectors(np.tile(searchable, (lower_intervals.shape[0], 1)), vector_ids)
+
+        # start with the set of all searchable record hyper-rectangles for every query
+        matching_words = np.tile(searchable, (lower_intervals.shape[0], 1))
+        for dim in range(self.ndimensions):
+            if self.indexed_dimensions[dim]:
+                # select the vector of each query's interval, shape (nqueries, nwords)
+                matching_words &= self.rbv_words[self.vector_offsets[dim, LOWER] + lower_intervals[:, dim]]
+                matching_words &= self.rbv_words[self.vector_offsets[dim, UPPER] + upper_intervals[:, dim]]
+        return matching_words
+
+    def empty_bitmaps(self, n: int):
+        '''
+        Creates n empty bitmaps of the same length and format as the results of match_intervals_batch
+        '''
+        if self.backend == "BitArray":
+            return [bitzeros(len(self.live), endian=BIT_ORDER) for _ in range(n)]
+        else:
+            return np.zeros(shape=(n, self.live_words.shape[0]), dtype=WORD_DTYPE)
+
+    def ids_to_bitmap(self, rect_ids: np.ndarray):
+        '''
+        Creates a bitmap in the format of the selected backend with the bits of the given rect ids set
+        '''
+        bools = np.zeros(shape=(len(self.live),), dtype=bool)
+        bools[rect_ids] = True
+        packed = np.packbits(bools, bitorder=BIT_ORDER)
+        if self.backend == "BitArray":
+            return packed_to_bitarray(packed, len(self.live))
+        else:
+            return packed_to_words(packed)
+
+    def rect_query(self, query_rect: np.ndarray) -> bitarray:
+        '''
+        Finds the set of all record hyper-rectangles which overlap the region defined in the query rectangle
+
+        Parameters
+        ----------
+        query_rect: a numpy array of shape (ndim, 2) representing the upper/lower bound along each axis to search in
+
+        Returns
+        -------
+        matching_bits: a bitmap of length nrects with each bit set to one iff the corresponding hyper-rectangle fall in the query region, a bitarray or array of words depending on the backend
+        '''
+        lower_intervals, upper_intervals = self.interval_ids(query_rect[np.newaxis])
+        return self.match_intervals_batch(lower_intervals, upper_intervals)[0]
+
+    def contained_rects(self, chunk_size: int = 256) -> np.ndarray:
+        '''
+        Finds the live record hyper-rectangles which lie entirely inside another live record. A record contains a rect only if along every axis its lower edge is at or below the rect's lower edge and its upper edge at or above the rect's upper edge, so the bit vectors of a query whose lower edge is the rect's upper edge and whose upper edge is the rect's lower edge select a superset of the rect's containers, which are then checked exactly. Of a group of identical rects all but the one with the smallest id are reported
+
+        Parameters
+        ----------
+        chunk_size: the number of rects whose candidate containers are matched at once
+
+        Returns
+        -------
+        rect_ids: a sorted integer array of the ids of the contained rects
+        '''
+        live_ids = bitmap_to_ids(self.live)
+        contained = np.zeros(shape=(self.nrects,), dtype=bool)
+        for start in range(0, live_ids.shape[0], chunk_size):
+            chunk_ids = live_ids[start:start + chunk_size]
+            # swap each rect's edges
+            upper_intervals, lower_intervals = self.interval_ids(self.rects[chunk_ids])
+            matches = self.match_intervals_batch(lower_intervals, upper_intervals)
+            for j, rect_id in enumerate(chunk_ids):
+                candidate_ids = bitmap_to_ids(matches[j])
+                candidates = self.rects[candidate_ids]
+                rect = self.rects[rect_id]
+                contains = (candidates[:, :, LOWER] <= rect[:, LOWER]).all(axis=1) & (candidates[:, :, UPPER] >= rect[:, UPPER]).all(axis=1)
+                # every rect contains itself and its duplicates, keep the duplicate with the smallest id
+                identical = contains & (candidates == rect).all(axis=(1, 2))
+                contained[rect_id] = (contains & ~identical).any() or (identical & (candidate_ids < rect_id)).any()
+        return np.flatnonzero(contained)
+
     def build_bit_vectors(self, rects: np.ndarray) -> list[list[list[bitarray]]]:
         '''
         Generates a redundant bit vector index for the given set of hyper-rectangle records
@@ -365,76 +1088,419 @@ class BitVectorIndex():
         #     R5, R6, R7, R8                |  R8     0        1
 
         # create the empty redudant bit vectors
-        rbv = [[[bitarray() for _ in range(self.m)] for _ in range(2)] for _ in range(self.ndimensions)]
         # Dim LowerBoundVectors   UpperBoundVectors
         #  0  [P1L, P2L ... PML], [P1U, P2U ... PMU]
         #  1  [P1L, P2L ... PML], [P1U, P2U ... PMU]
         #          .......             .......
         #  D  [P1L, P2L ... PML], [P1U, P2U ... PMU]
-        # rbv[dimension][lower/upper][interval]
+        # rbv[dimension][lower/upper][interval], where dimension d has dim_m[d] intervals
+
+        packed = self.pack_bit_vectors(rects)
+        rbv = [[[packed_to_bitarray(packed[self.vector_offsets[dim, side] + i], rects.shape[0]) for i in range(self.dim_m[dim])]
+                for side in [LOWER, UPPER]] for dim in range(self.ndimensions)]
+        return rbv
+
+    def pack_bit_vectors(self, rects: np.ndarray, bit_offset: int = 0) -> np.ndarray:
+        '''
+        Computes the redundant bit vectors for the given set of hyper-rectangle records as rows of bytes packed using BIT_ORDER
 
+        Parameters
+        ----------
+        rects: a numpy array of shape (nrects, ndim, 2) corresponding to min/max values along each dimension
+        bit_offset: the number of zero bits before the bit of the first rect, used to continue a partially filled word when rects are added to the index
+
+        Returns
+        -------
+        packed: a uint8 array of shape (2 * sum(dim_m), ceil((bit_offset + nrects) / 8)) where packed[vector_offsets[i][UPPER/LOWER] + j] are the packed bits of the vector for the UPPER/LOWER bound for the jth interval of the ith dimension
+        '''
+        packed = np.zeros(shape=(2 * self.dim_m.sum(), (bit_offset + rects.shape[0] + 7) // 8), dtype=np.uint8)
         # a rectangle is above the lower bound for the interval if its upper edge along that axis is greater than or equal to the min value for the intervals range
         # i.e. if a hyper-rectangles edge falls on the boundary between two intervals, count it as in the rightmost (higher along the axis) of the two intervals
         for dim in range(self.ndimensions):  # for each dimension
             if self.indexed_dimensions[dim]:
-                for i in range(self.m):  # for each of the m intervals
-                    # build the lower bound and upper bound bit vectors
-                    lb_bit_vec = [False for _ in range(self.nrects)]
-                    ub_bit_vec = [False for _ in range(self.nrects)]
-                    for j in range(self.nrects):  # check each rectangle
-                        lb_bit_vec[j] = rects[j][dim][UPPER] >= self.intervals[dim][i][LOWER]  # r's upper edge above LB
-                        ub_bit_vec[j] = rects[j][dim][LOWER] < self.intervals[dim][i][UPPER]  # r's lower edge below UB
-                    # pack the booleans into bits of a word into using bitarray
-                    rbv[dim][LOWER][i].extend(lb_bit_vec)
-                    rbv[dim][UPPER][i].extend(ub_bit_vec)
-        return rbv
+                # compare every rectangle against every interval at once, giving arrays of shape (dim_m, nrects)
+                dim_intervals = self.intervals[dim, :self.dim_m[dim]]
+                lb_bits = rects[:, dim, UPPER][np.newaxis, :] >= dim_intervals[:, LOWER][:, np.newaxis]  # r's upper edge above LB
+                ub_bits = rects[:, dim, LOWER][np.newaxis, :] < dim_intervals[:, UPPER][:, np.newaxis]  # r's lower edge below UB
+                # pack the booleans into bits of a word, one row of bytes per interval
+                if bit_offset > 0:
+                    lb_bits = np.pad(lb_bits, ((0, 0), (bit_offset, 0)))
+                    ub_bits = np.pad(ub_bits, ((0, 0), (bit_offset, 0)))
+                lower_off, upper_off = self.vector_offsets[dim]
+                packed[lower_off:lower_off + self.dim_m[dim]] = np.packbits(lb_bits, axis=1, bitorder=BIT_ORDER)
+                packed[upper_off:upper_off + self.dim_m[dim]] = np.packbits(ub_bits, axis=1, bitorder=BIT_ORDER)
+        return packed
 
-    def generate_intervals(self, rects: np.ndarray):
+    def build_vectors(self) -> None:
+        '''
+        Builds the bit vectors of every rectangle in self.rects using the current intervals, in the storage format of the selected backend
+        '''
+        if self.backend == "WordArray":
+            self.rbv_words = packed_to_words(self.pack_bit_vectors(self.rects))
+        elif self.backend == "Compressed":
+            self.rbv_compressed = CompressedVectors(packed_to_words(self.pack_bit_vectors(self.rects)))
+        else:
+            self.rbv = self.build_bit_vectors(self.rects)
+        self.sync_live()
+
+    def vector_bytes(self) -> int:
+        '''
+        Returns the memory used by the bit vectors in the storage format of the selected backend in bytes
         '''
-        Generates a set of intervals based on the rectangles bound locations
+        if self.backend == "WordArray":
+            return self.rbv_words.nbytes
+        elif self.backend == "Compressed":
+            return self.rbv_compressed.nbytes
+        else:
+            return sum(vector.nbytes for dim_vectors in self.rbv for side_vectors in dim_vectors for vector in side_vectors)
+
+    def sync_live(self) -> None:
+        '''
+        Updates the live rectangle count and for the WordArray and Compressed backends the word array copy of the live vector, after rectangles are added or deleted
+        '''
+        self.nlive = self.live.count()
+        # the cached results may include deleted rects or miss new ones
+        self.query_cache.clear()
+        if self.backend != "BitArray":
+            self.live_words = packed_to_words(np.frombuffer(self.live.tobytes(), dtype=np.uint8))
+        # the cached searchable bitmap and rect widths may include deleted rects or miss new ones, see searchable_bitmap
+        self.searchable_filter = None
+        self.widths = None
+
+    def searchable_bitmap(self, min_widths: np.ndarray = None, constraints: np.ndarray = None) -> tuple:
+        '''
+        Finds the live rects which intersect the constraints region and are at least min_widths wide along every axis, the only rects which can be the result of a query with these user considerations. Trimming a rect to the constraints only narrows it, so narrower rects can never satisfy the robustness requirements. The rects in the constraints region are found with rect_query and then checked exactly, such that the searches need not check the candidates against the constraints again. The bitmap of the last considerations is kept, as a batch of queries and often a whole experiment share the same considerations
+
+        Parameters
+        ----------
+        min_widths: array of shape (ndim,) where min_widths[i] is the min required robustness of xprime[i], if None rects of any width are searchable
+        constraints: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis, if None rects anywhere are searchable
 
         Returns
         -------
-        intervals: an array of shape (ndim, m, 2) where intervals[i][j][0] represents the lower end of the range for interval j on dimension i and intervals[i][j][1] the upper
+        (searchable, nsearchable): the bitmap of the searchable rects in the format of the selected backend and the number of them
         '''
-        indexed_dimensions = [True for _ in range(self.ndimensions)]
-        interval_dividers = [[] for _ in range(self.ndimensions)]
-        intervals = np.zeros(shape=(self.ndimensions, self.m, 2))
+        live = self.live if self.backend == "BitArray" else self.live_words
+        if min_widths is None and constraints is None:
+            return live, self.nlive
+        key = b"".join(b"" if array is None else np.asarray(array, dtype=float).tobytes() for array in [min_widths, constraints])
+        key += bytes([min_widths is None, constraints is None])
+        if self.searchable_filter is None or self.searchable_filter[0] != key:
+            if constraints is not None:
+                rect_ids = bitmap_to_ids(self.rect_query(constraints))
+                rect_ids = rect_ids[have_intersections(self.rects[rect_ids], constraints)]
+            else:
+                rect_ids = np.arange(self.nrects)
+            if min_widths is not None:
+                # the width of each rect along each axis, only computed once robustness is required as it reads every rect
+                if self.widths is None:
+                    self.widths = self.rects[:, :, UPPER] - self.rects[:, :, LOWER]
+                rect_ids = rect_ids[(self.widths[rect_ids] >= min_widths).all(axis=1)]
+            searchable = self.ids_to_bitmap(rect_ids) & live
+            self.searchable_filter = (key, searchable, bitmap_count(searchable))
+        return self.searchable_filter[1], self.searchable_filter[2]
+
+    def insert(self, rects: list[np.ndarray]) -> np.ndarray:
+        '''
+        Adds the given hyper-rectangles to the index without rebuilding it. The new rectangles are assigned to the existing intervals and their bits are appended to the end of each bit vector, for the word array backends by packing only the new rects' bits and ORing the first of them into the partially filled last word. If the bounds of the live rectangles have become too unevenly spread across the intervals, the interval dividers are rebalanced afterwards
+
+        Parameters
+        ----------
+        rects: the list of hyperrectangle records to add, each of shape (ndim, 2)
+
+        Returns
+        -------
+        rect_ids: an array of the ids assigned to the new rectangles
+        '''
+        if len(rects) == 0:
+            return np.zeros(shape=(0,), dtype=int)
+        self.own_vectors()
+        new_rects = np.stack(rects, axis=0)
+        rect_ids = np.arange(self.nrects, self.nrects + new_rects.shape[0])
+
+        # append the bits of the new rectangles to the existing vectors
+        if self.backend == "BitArray":
+            new_rbv = self.build_bit_vectors(new_rects)
+            for dim in range(self.ndimensions):
+                for i in range(self.dim_m[dim]):
+                    self.rbv[dim][LOWER][i].extend(new_rbv[dim][LOWER][i])
+                    self.rbv[dim][UPPER][i].extend(new_rbv[dim][UPPER][i])
+        else:
+            # the new bits start part way through the last word of the vectors, which holds no rects beyond nrects
+            first_word, bit_offset = divmod(self.nrects, 8 * WORD_DTYPE.itemsize)
+            new_words = packed_to_words(self.pack_bit_vectors(new_rects, bit_offset))
+            if self.backend == "WordArray":
+                if bit_offset > 0:
+                    new_words[:, 0] |= self.rbv_words[:, first_word]
+                self.rbv_words = np.concatenate([self.rbv_words[:, :first_word], new_words], axis=1)
+            else:
+                self.rbv_compressed.extend(new_words, first_word)
+        self.rects = np.concatenate([self.rects, new_rects], axis=0)
+        self.nrects = self.rects.shape[0]
+        self.live.extend(bitarray(new_rects.shape[0] * [True], endian=BIT_ORDER))
+        self.sync_live()
+
+        if self.interval_skew() > self.rebalance_skew:
+            self.rebalance()
+        return rect_ids
+
+    def delete(self, rect_ids: np.ndarray) -> None:
+        '''
+        Removes the given hyper-rectangles from the index by marking them as deleted. The rectangles are no longer returned by queries, but their ids are not reused so the ids of all other rectangles are unchanged
+
+        Parameters
+        ----------
+        rect_ids: an array of the ids of the rectangles to delete
+        '''
+        self.own_vectors()
+        for rect_id in rect_ids:
+            self.live[int(rect_id)] = 0
+        self.sync_live()
+
+        if self.interval_skew() > self.rebalance_skew:
+            self.rebalance()
+
+    def interval_skew(self) -> float:
+        '''
+        Measures how evenly the bounds of the live rectangles are spread across the intervals. For each axis this is the number of distinct bounds in the fullest interval divided by the number in an even split, which is about 1 right after the intervals are generated. Axes which were too sparse to be indexed but now have enough distinct bounds count as infinitely skewed, unless the interval counts are chosen by a memory budget
+
+        Returns
+        -------
+        skew: the largest skew of any axis
+        '''
+        live_rects = self.rects[bitmap_to_ids(self.live)]
+        skew = 0.0
         for dim in range(self.ndimensions):
-            # get all the bounds for this dimension
-            dim_bounds = rects[:, dim].flatten()
-            # deduplicate the set of bounds
-            dim_bounds = np.unique(dim_bounds)
-            # remove +/- infinite values
+            dim_bounds = np.unique(live_rects[:, dim].flatten())
             dim_bounds = dim_bounds[np.isfinite(dim_bounds)]
+            if not self.indexed_dimensions[dim]:
+                # dimensions left unindexed by the memory budget were chosen to be, rather than too sparse
+                if self.memory_budget is None and len(dim_bounds) >= self.m:
+                    return np.inf
+            elif len(dim_bounds) > 0:
+                # a bound which falls on a divider belongs to the interval below it, as in generate_intervals
+                dividers = np.asarray(self.interval_dividers[dim])
+                interval_counts = np.bincount(np.searchsorted(dividers, dim_bounds, side="left") - 1, minlength=self.dim_m[dim])
+                skew = max(skew, interval_counts.max() / (len(dim_bounds) / self.dim_m[dim]))
+        return skew
 
-            # for m intervals we need m+1 dividers, the first is alwasy -inf and the last +inf
-            # select the remaining m-1 dividers from the dimension bounds s.t. we evenly distribute bou
-
-            if len(dim_bounds) >= self.m:  # if sufficient bounds distribute them evenly across the intervals
-                interval_dividers[dim].append(-np.inf)
-                # determine the number of bounds per each interval
-                group_size = len(dim_bounds) // (self.m)
-                extra = len(dim_bounds) % (self.m)
-                # select the min and max values for each interval
-                pos = 0
-                for i in range(self.m):
-                    new_size = group_size
-                    if extra > 0:
-                        new_size += 1
-                        extra -= 1
-                    pos = pos + new_size
-                    interval_dividers[dim].append(dim_bounds[pos-1])
-                interval_dividers[dim][-1] = np.inf
-
-                # convert m+1 dividers into m pairs of dividers
-                for i in range(self.m):
-                    intervals[dim, i, LOWER] = interval_dividers[dim][i]
-                    intervals[dim, i, UPPER] = interval_dividers[dim][i+1]
-            else:  # if not, disable indexing on this dimension
-                indexed_dimensions[dim] = False
-
-        return intervals, interval_dividers, indexed_dimensions
+    def rebalance(self) -> None:
+        '''
+        Regenerates the interval dividers from the bounds of the live rectangles and rebuilds the bit vectors using them. Deleted rectangles keep their ids and remain marked as deleted
+        '''
+        live_rects = self.rects[bitmap_to_ids(self.live)]
+        if live_rects.shape[0] == 0:
+            return
+        self.set_intervals(live_rects)
+        self.build_vectors()
+
+    def own_vectors(self) -> None:
+        '''
+        Replaces any bit vectors which are read-only views of a memory-mapped index file with writable copies trimmed to nrects bits so that the index can be modified
+        '''
+        if len(self.live) == self.nrects and not self.live.readonly:
+            return
+        self.live = self.live[:self.nrects]
+        if self.backend != "BitArray":
+            return  # the word arrays are replaced rather than modified in place
+        for dim in range(self.ndimensions):
+            for i in range(self.dim_m[dim]):
+                self.rbv[dim][LOWER][i] = self.rbv[dim][LOWER][i][:self.nrects]
+                self.rbv[dim][UPPER][i] = self.rbv[dim][UPPER][i][:self.nrects]
+
+    def save(self, path: str) -> None:
+        '''
+        Writes the index to a binary file which can be memory-mapped by BitVectorIndex.load. The file holds a versioned header followed by the rects, interval dividers, interval counts, live vector, and the packed bit vectors, each section aligned to FILE_ALIGNMENT bytes and each vector padded to a whole number of words so that either backend can map it
+
+        Parameters
+        ----------
+        path: the file to write the index to
+        '''
+        nbytes = file_vector_bytes(self.nrects)
+        width = self.intervals.shape[1]
+        nvectors = 2 * int(self.dim_m.sum())
+        dividers = np.full(shape=(self.ndimensions, width + 1), fill_value=np.nan)
+        packed_rbv = np.zeros(shape=(nvectors, nbytes), dtype=np.uint8)
+        if self.backend == "WordArray":
+            packed_rbv[:] = self.rbv_words.view(np.uint8)[:, :nbytes]
+        elif self.backend == "Compressed":
+            packed_rbv[:] = self.rbv_compressed.to_words().view(np.uint8)[:, :nbytes]
+        for dim in range(self.ndimensions):
+            dividers[dim, :len(self.interval_dividers[dim])] = self.interval_dividers[dim]
+            if self.backend == "BitArray":
+                for side in [LOWER, UPPER]:
+                    for i in range(self.dim_m[dim]):
+                        vector_bytes = np.frombuffer(self.rbv[dim][side][i].tobytes(), dtype=np.uint8)[:nbytes]
+                        packed_rbv[self.vector_offsets[dim, side] + i, :vector_bytes.shape[0]] = vector_bytes
+        packed_live = np.zeros(shape=(nbytes,), dtype=np.uint8)
+        live_bytes = np.frombuffer(self.live.tobytes(), dtype=np.uint8)[:nbytes]
+        packed_live[:live_bytes.shape[0]] = live_bytes
+        sections = [
+            np.ascontiguousarray(self.rects, dtype=np.float64),
+            dividers,
+            self.dim_m.astype(np.int64),
+            packed_live,
+            packed_rbv,
+        ]
+        offsets = file_section_offsets(self.nrects, self.ndimensions, width, nvectors)
+        with open(path, "wb") as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, 0, self.nrects, self.ndimensions, width, nbytes))
+            for offset, section in zip(offsets, sections):
+                f.write(bytes(offset - f.tell()))  # pad to the section alignment
+                f.write(section.tobytes())
+
+    @classmethod
+    def load(cls, path: str, explainer: FACET, hyperparameters: dict) -> BitVectorIndex:
+        '''
+        Loads an index written by BitVectorIndex.save. The rects and bit vectors are read-only views of the memory-mapped file rather than copies, so loading is independent of the index size and processes which load the same file share its pages. The index is copied into memory the first time it is modified by insert or delete
+
+        Parameters
+        ----------
+        path: the file to load the index from
+        explainer: the FACET explainer to use for fitting points to rectangles
+        hyperparameters: the hyperparameters controlling the search, the intervals are taken from the file
+
+        Returns
+        -------
+        rbv_index: the loaded BitVectorIndex
+        '''
+        mm = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, _, nrects, ndim, width, nbytes = FILE_HEADER.unpack(mm[:FILE_HEADER.size].tobytes())
+        if magic != FILE_MAGIC:
+            raise ValueError("{} is not a BitVectorIndex file".format(path))
+        if version != FILE_VERSION:
+            raise ValueError("Unsupported BitVectorIndex file version {}, expected {}".format(version, FILE_VERSION))
+
+        # the offset of the bit vectors depends on their number, which is read from the interval counts section before it
+        rects_off, dividers_off, dim_m_off, live_off, _ = file_section_offsets(nrects, ndim, width, 0)
+        rbv_index = cls.__new__(cls)
+        rbv_index.parse_hyperparameters(hyperparameters)
+        rbv_index.explainer = explainer
+        rbv_index.nrects = nrects
+        rbv_index.ndimensions = ndim
+        rbv_index.rects = mm[rects_off:rects_off + nrects * ndim * 2 * 8].view(np.float64).reshape(nrects, ndim, 2)
+        dividers = mm[dividers_off:dividers_off + ndim * (width + 1) * 8].view(np.float64).reshape(ndim, width + 1)
+        rbv_index.dim_m = np.array(mm[dim_m_off:dim_m_off + ndim * 8].view(np.int64), dtype=int)
+        rbv_index.indexed_dimensions = [bool(rbv_index.dim_m[dim] > 0) for dim in range(ndim)]
+        rbv_index.interval_dividers = [list(dividers[dim, :rbv_index.dim_m[dim] + 1]) if rbv_index.indexed_dimensions[dim] else []
+                                       for dim in range(ndim)]
+        rbv_index.intervals = dividers_to_intervals(rbv_index.interval_dividers, width)
+        rbv_index.vector_offsets = vector_offsets(rbv_index.dim_m)
+        nvectors = 2 * int(rbv_index.dim_m.sum())
+        rbv_off = file_section_offsets(nrects, ndim, width, nvectors)[-1]
+
+        # the vectors are padded to a whole number of words, the padding bits are zero in every vector including the live vector so they never match a query
+        def vector_view(offset: int) -> bitarray:
+            if nbytes == 0:
+                return bitarray(endian=BIT_ORDER)
+            return bitarray(buffer=mm[offset:offset + nbytes], endian=BIT_ORDER)
+
+        rbv_index.live = vector_view(live_off)
+        rbv_index.query_cache = OrderedDict()
+        rbv_index.cache_hits = 0
+        rbv_index.cache_misses = 0
+        rbv_index.rbv = None
+        rbv_index.rbv_words = None
+        rbv_index.rbv_compressed = None
+        if rbv_index.backend == "WordArray":
+            rbv_index.rbv_words = mm[rbv_off:rbv_off + nvectors * nbytes].view(WORD_DTYPE).reshape(nvectors, nbytes // 8)
+        elif rbv_index.backend == "Compressed":
+            # compressed vectors can't be mapped, they are compressed from the file into memory
+            rbv_index.rbv_compressed = CompressedVectors(mm[rbv_off:rbv_off + nvectors * nbytes].view(WORD_DTYPE).reshape(nvectors, nbytes // 8))
+        else:
+            rbv_index.rbv = [[[vector_view(rbv_off + (rbv_index.vector_offsets[dim, side] + i) * nbytes) for i in range(rbv_index.dim_m[dim])]
+                              for side in [LOWER, UPPER]] for dim in range(ndim)]
+        rbv_index.sync_live()
+        rbv_index.search_log = []
+        rbv_index.cell_log = []
+        rbv_index.trace_log = []
+        return rbv_index
+
+    def set_intervals(self, rects: np.ndarray) -> None:
+        '''
+        Generates the intervals of the given rects and the position of each dimension's vectors in the packed bit vectors
+        '''
+        self.intervals, self.interval_dividers, self.indexed_dimensions, self.dim_m = self.generate_intervals(rects)
+        self.vector_offsets = vector_offsets(self.dim_m)
+        if self.verbose:
+            print("N Indexed Dimensions:", sum(self.indexed_dimensions))
+            print("Intervals per dimension:", self.dim_m.tolist())
+
+    def generate_intervals(self, rects: np.ndarray):
+        '''
+        Generates a set of intervals based on the rectangles bound locations. Without a memory budget every dimension with at least m distinct bounds is split into m intervals, otherwise the number of intervals along each dimension is chosen by choose_interval_counts
+
+        Returns
+        -------
+        intervals: an array of shape (ndim, max interval count, 2) where intervals[i][j][0] represents the lower end of the range for interval j on dimension i and intervals[i][j][1] the upper, intervals past the dimension's interval count are (inf, inf)
+        interval_dividers: a list of the interval count + 1 dividers of each dimension, empty for unindexed dimensions
+        indexed_dimensions: a list of bools, true iff the dimension is indexed
+        dim_m: an integer array of shape (ndim,) with the number of intervals along each dimension, zero for unindexed dimensions
+        '''
+        # get the deduplicated finite bounds of each dimension
+        all_bounds = []
+        for dim in range(self.ndimensions):
+            dim_bounds = np.unique(rects[:, dim].flatten())
+            all_bounds.append(dim_bounds[np.isfinite(dim_bounds)])
+
+        if self.memory_budget is None:
+            # if sufficient bounds distribute them evenly across m intervals, if not disable indexing on this dimension
+            dim_m = np.array([self.m if len(dim_bounds) >= self.m else 0 for dim_bounds in all_bounds], dtype=int)
+        else:
+            dim_m = self.choose_interval_counts(rects, all_bounds)
+
+        interval_dividers = [even_dividers(all_bounds[dim], dim_m[dim]) if dim_m[dim] > 0 else []
+                             for dim in range(self.ndimensions)]
+        indexed_dimensions = [bool(dim_m[dim] > 0) for dim in range(self.ndimensions)]
+        intervals = dividers_to_intervals(interval_dividers, max(dim_m.max(initial=0), 1))
+        return intervals, interval_dividers, indexed_dimensions, dim_m
+
+    def choose_interval_counts(self, rects: np.ndarray, all_bounds: list[np.ndarray]) -> np.ndarray:
+        '''
+        Chooses the number of intervals along each dimension to fit the bit vectors in the memory budget. The selectivity of a split is the average fraction of the rects which overlap each of its intervals, and so match a query falling in it, and the gain of the split is -log2(selectivity), the number of halvings of the candidate set. Starting with no dimension indexed, the split of the dimension with the largest gain per added interval is repeatedly doubled, from 2 intervals up to max_interval, while the budget allows. Dimensions whose rects span most of the axis gain little from any split and are left unindexed
+
+        Parameters
+        ----------
+        rects: a numpy array of shape (nrects, ndim, 2) of the rects to index
+        all_bounds: the sorted distinct finite bounds of each dimension
+
+        Returns
+        -------
+        dim_m: an integer array of shape (ndim,) with the number of intervals along each dimension, zero for unindexed dimensions
+        '''
+        # each interval costs a lower and upper bound vector of one bit per rect
+        vector_bytes = (rects.shape[0] + 7) // 8
+        max_vectors = self.memory_budget // max(vector_bytes, 1)
+
+        # the gain of each candidate interval count of each dimension
+        candidate_gains = []
+        for dim in range(self.ndimensions):
+            gains = {0: 0.0}
+            count = 2
+            while count <= min(self.max_interval, len(all_bounds[dim])):
+                dividers = np.asarray(even_dividers(all_bounds[dim], count))
+                selectivity = interval_overlaps(rects[:, dim], dividers).mean() / rects.shape[0]
+                gains[count] = -np.log2(max(selectivity, 1 / rects.shape[0]))
+                count *= 2
+            candidate_gains.append(gains)
+
+        dim_m = np.zeros(shape=(self.ndimensions,), dtype=int)
+        nvectors = 0
+        while True:
+            best_dim, best_ratio = None, 0.0
+            for dim in range(self.ndimensions):
+                next_count = max(2 * dim_m[dim], 2)
+                if next_count not in candidate_gains[dim] or nvectors + 2 * (next_count - dim_m[dim]) > max_vectors:
+                    continue
+                ratio = (candidate_gains[dim][next_count] - candidate_gains[dim][dim_m[dim]]) / (next_count - dim_m[dim])
+                if ratio > best_ratio:
+                    best_dim, best_ratio = dim, ratio
+            if best_dim is None:
+                break
+            next_count = max(2 * dim_m[best_dim], 2)
+            nvectors += 2 * (next_count - dim_m[best_dim])
+            dim_m[best_dim] = next_count
+        return dim_m
 
     def parse_hyperparameters(self, hyperparameters: dict) -> None:
         self.hyperparameters = hyperparameters
@@ -461,6 +1527,18 @@ class BitVectorIndex():
         else:
             self.radius_growth = params.get("rbv_radius_growth")
 
+        # Number of sample points used to calibrate the Auto radius growth
+        if params.get("rbv_auto_samples") is None:
+            self.auto_samples = 100
+        else:
+            self.auto_samples = params.get("rbv_auto_samples")
+
+        # Number of cells best first search visits before checking all remaining rects
+        if params.get("rbv_max_cells") is None:
+            self.max_cells = 64
+        else:
+            self.max_cells = params.get("rbv_max_cells")
+
         # Number of intervals (m)
         if params.get("rbv_num_interval") is None:
             print("No rbv_num_interval provided, using 4")
@@ -468,6 +1546,44 @@ class BitVectorIndex():
         else:
             self.m = params.get("rbv_num_interval")
 
+        # Memory budget in bytes for the bit vectors, used to choose the number of intervals of each dimension
+        if params.get("rbv_memory_budget") is None:
+            self.memory_budget = None
+        else:
+            self.memory_budget = params.get("rbv_memory_budget")
+
+        # Largest number of intervals along one dimension when using a memory budget
+        if params.get("rbv_max_interval") is None:
+            self.max_interval = 64
+        else:
+            self.max_interval = params.get("rbv_max_interval")
+
+        # Number of point query results to keep in the least recently used cache, 0 disables the cache
+        if params.get("rbv_cache_size") is None:
+            self.cache_size = 0
+        else:
+            self.cache_size = params.get("rbv_cache_size")
+
+        # Record a trace of each point query's radius search in trace_log, can be switched at runtime by setting tracing
+        if params.get("rbv_trace") is None:
+            self.tracing = False
+        else:
+            self.tracing = params.get("rbv_trace")
+
+        # Interval skew which triggers a rebalance after inserts/deletes
+        if params.get("rbv_rebalance_skew") is None:
+            print("No rbv_rebalance_skew provided, using 2.0")
+            self.rebalance_skew = 2.0
+        else:
+            self.rebalance_skew = params.get("rbv_rebalance_skew")
+
+        # Bitmap backend, BitArray, WordArray, or Compressed
+        if params.get("rbv_backend") is None:
+            print("No rbv_backend provided, using BitArray")
+            self.backend = "BitArray"
+        else:
+            self.backend = params.get("rbv_backend")
+
         # print messages
         if params.get("facet_verbose") is None:
             self.verbose = False
@@ -486,3 +1602,217 @@ def have_intersection(rect_a: np.ndarray, rect_b: np.ndarray) -> bool:
     lowers_match = (rect_a[:, LOWER] <= rect_b[:, UPPER]).all()
     uppers_match = (rect_a[:, UPPER] >= rect_b[:, LOWER]).all()
     return lowers_match and uppers_match
+
+
+def packed_to_bitarray(packed: np.ndarray, nbits: int) -> bitarray:
+    '''
+    Converts a row of bytes packed by np.packbits using BIT_ORDER into a bitarray of length nbits
+
+    Parameters
+    ----------
+    packed: a numpy array of uint8 values as returned by np.packbits(..., bitorder=BIT_ORDER)
+    nbits: the number of valid bits in the packed row, trailing padding bits are dropped
+    '''
+    bits = bitarray(endian=BIT_ORDER)
+    bits.frombytes(packed.tobytes())
+    del bits[nbits:]
+    return bits
+
+
+def even_dividers(dim_bounds: np.ndarray, m: int) -> list[float]:
+    '''
+    Selects m+1 interval dividers which distribute the given bounds evenly across m intervals, the first divider is always -inf and the last +inf
+
+    Parameters
+    ----------
+    dim_bounds: the sorted distinct finite bounds along one dimension, at least m of them
+    m: the number of intervals
+    '''
+    dividers = [-np.inf]
+    # determine the number of bounds per each interval
+    group_size = len(dim_bounds) // m
+    extra = len(dim_bounds) % m
+    # select the max value for each interval
+    pos = 0
+    for i in range(m):
+        new_size = group_size
+        if extra > 0:
+            new_size += 1
+            extra -= 1
+        pos = pos + new_size
+        dividers.append(dim_bounds[pos-1])
+    dividers[-1] = np.inf
+    return dividers
+
+
+def vector_offsets(dim_m: np.ndarray) -> np.ndarray:
+    '''
+    Computes the row of the first lower and upper bound vector of each dimension in the packed bit vectors, which hold the lower then upper bound vectors of each dimension in order. Returns an integer array of shape (ndim, 2)
+    '''
+    starts = 2 * (np.cumsum(dim_m) - dim_m)
+    return np.stack([starts, starts + dim_m], axis=1)
+
+
+def dividers_to_intervals(interval_dividers: list[list[float]], width: int) -> np.ndarray:
+    '''
+    Converts the m+1 dividers of each dimension into m (lower, upper) pairs, returning an array of shape (ndim, width, 2). Intervals past the dimension's interval count are (inf, inf) so that nothing falls in them
+    '''
+    intervals = np.full(shape=(len(interval_dividers), width, 2), fill_value=np.inf)
+    for dim, dividers in enumerate(interval_dividers):
+        if len(dividers) == 0:
+            continue
+        intervals[dim, :len(dividers) - 1, LOWER] = dividers[:-1]
+        intervals[dim, :len(dividers) - 1, UPPER] = dividers[1:]
+    return intervals
+
+
+def interval_overlaps(dim_rects: np.ndarray, dividers: np.ndarray) -> np.ndarray:
+    '''
+    Counts the rects which overlap each interval along one dimension, in the sense used by the bit vectors that a rect overlaps [lower, upper) if its upper edge is >= lower and its lower edge is < upper
+
+    Parameters
+    ----------
+    dim_rects: a numpy array of shape (nrects, 2) of the rects' bounds along the dimension
+    dividers: a numpy array of the m+1 interval dividers
+
+    Returns
+    -------
+    counts: an integer array of shape (m,)
+    '''
+    m = dividers.shape[0] - 1
+    # each rect overlaps a contiguous run of intervals, from the one containing its lower edge to the one containing its upper edge
+    first = np.clip(np.searchsorted(dividers, dim_rects[:, LOWER], side="right") - 1, 0, m - 1)
+    last = np.clip(np.searchsorted(dividers, dim_rects[:, UPPER], side="right") - 1, 0, m - 1)
+    starts = np.bincount(first, minlength=m + 1)
+    ends = np.bincount(last + 1, minlength=m + 1)
+    return np.cumsum(starts - ends)[:m]
+
+
+def file_vector_bytes(nrects: int) -> int:
+    '''
+    The number of bytes used to store each bit vector of an index with nrects rectangles on disk, padded to a whole number of words
+    '''
+    return WORD_DTYPE.itemsize * ((nrects + 63) // 64)
+
+
+def file_section_offsets(nrects: int, ndim: int, width: int, nvectors: int) -> list[int]:
+    '''
+    Computes the byte offsets of the rects, interval dividers, interval counts, live vector, and packed bit vector sections of a saved index, each aligned to FILE_ALIGNMENT bytes. width is the largest number of intervals of any dimension and nvectors the total number of bit vectors
+    '''
+    nbytes = file_vector_bytes(nrects)
+    section_sizes = [nrects * ndim * 2 * 8, ndim * (width + 1) * 8, ndim * 8, nbytes, nvectors * nbytes]
+    offsets = []
+    pos = FILE_HEADER.size
+    for size in section_sizes:
+        pos = -(-pos // FILE_ALIGNMENT) * FILE_ALIGNMENT
+        offsets.append(pos)
+        pos += size
+    return offsets
+
+
+def top_k_rects(rects: np.ndarray, top_k: TopK, constraints: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Gathers the rects kept by a TopK, trimmed to fit in the constraints if provided
+
+    Parameters
+    ----------
+    rects: the indexed rects, a numpy array of shape (nrects, ndim, 2)
+    top_k: the TopK of a finished query
+    constraints: a numpy array of shape (ndim, 2), if provided the rects are trimmed to fit in the constraints
+
+    Returns
+    -------
+    (rect_ids, closest_rects): the ids of the nearest rects in order of increasing distance, and a single array of shape (nfound, ndim, 2) holding the trimmed rects. The rows of closest_rects are the rects returned by queries, views into one array rather than separate copies of the indexed rects
+    '''
+    rect_ids = top_k.rect_ids()
+    closest_rects = rects[rect_ids]  # advanced indexing, a copy so the indexed rects are never modified
+    if constraints is not None:  # retrim the rectagles to match constraints
+        closest_rects[:, :, LOWER] = np.maximum(closest_rects[:, :, LOWER], constraints[:, LOWER])  # raise lower bounds
+        closest_rects[:, :, UPPER] = np.minimum(closest_rects[:, :, UPPER], constraints[:, UPPER])  # lower upper bounds
+    return rect_ids, closest_rects
+
+
+def query_key(instance: np.ndarray, constraints: np.ndarray, weights: np.ndarray, k: int, max_dist: float, min_robust: float, min_widths: np.ndarray, return_ids: bool) -> bytes:
+    '''
+    Computes a canonical hash of a point query's arguments for the query cache. Arrays are hashed by their float64 values and shape, so equal arguments give equal keys regardless of their dtype, memory layout, or the sign of zeros
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    for value in [instance, constraints, weights, min_robust, min_widths]:
+        if value is None:
+            digest.update(b"N")
+        else:
+            values = np.ascontiguousarray(value, dtype=np.float64) + 0.0  # adding zero maps -0.0 to 0.0
+            digest.update(b"A" + struct.pack("<Q", values.ndim) + struct.pack("<{}Q".format(values.ndim), *values.shape))
+            digest.update(values.tobytes())
+    digest.update(repr((None if k is None else int(k), float(max_dist), bool(return_ids))).encode())
+    return digest.digest()
+
+
+def copy_result(result):
+    '''
+    Copies a point query result so that cached results are never shared with the caller
+    '''
+    if result is None:
+        return None
+    elif isinstance(result, np.ndarray):
+        return result.copy()
+    elif isinstance(result, tuple):
+        return tuple(part.copy() for part in result)
+    else:
+        return [rect.copy() for rect in result]
+
+
+def bitmap_union(bitmaps):
+    '''
+    Returns the union of a list of bitarrays or an array of word bitmaps as returned by match_intervals_batch
+    '''
+    if isinstance(bitmaps, np.ndarray):
+        return np.bitwise_or.reduce(bitmaps, axis=0)
+    union = bitmaps[0].copy()
+    for bits in bitmaps[1:]:
+        union |= bits
+    return union
+
+
+def packed_to_words(packed: np.ndarray) -> np.ndarray:
+    '''
+    Converts rows of bytes packed by np.packbits using BIT_ORDER into rows of WORD_DTYPE words, zero padding the last axis to a whole number of words
+    '''
+    pad = -packed.shape[-1] % WORD_DTYPE.itemsize
+    if pad > 0:
+        packed = np.concatenate([packed, np.zeros(shape=packed.shape[:-1] + (pad,), dtype=np.uint8)], axis=-1)
+    return np.ascontiguousarray(packed).view(WORD_DTYPE)
+
+
+def bitmap_count(bits) -> int:
+    '''
+    Returns the number of set bits in a bitmap of either backend, a bitarray or an array of words
+    '''
+    if isinstance(bits, bitarray):
+        return bits.count()
+    return int(POPCOUNT_TABLE[bits.view(np.uint8)].sum(dtype=np.int64))
+
+
+def bitmap_to_ids(bits) -> np.ndarray:
+    '''
+    Returns the indices of the set bits of a bitmap of either backend, a bitarray or an array of words, without building an intermediate python list
+    '''
+    if isinstance(bits, bitarray):
+        packed = np.frombuffer(bits.tobytes(), dtype=np.uint8)
+    else:
+        packed = bits.view(np.uint8)
+    return np.flatnonzero(np.unpackbits(packed, bitorder=BIT_ORDER))
+
+
+def have_intersections(rects: np.ndarray, rect_b: np.ndarray) -> np.ndarray:
+    '''
+    Vectorized have_intersection, returns a boolean array which is true iff the overlap between the corresponding rectangle of rects and rect_b is nonzero
+
+    Parameters
+    ----------
+    rects: numpy array of shape (nrects, ndim, 2) representing min/max values along each axis of each rectangle
+    rect_b: numpy array of shape (ndim, 2) representing min/max values along each axis
+    '''
+    lowers_match = (rects[:, :, LOWER] <= rect_b[:, UPPER]).all(axis=1)
+    uppers_match = (rects[:, :, UPPER] >= rect_b[:, LOWER]).all(axis=1)
+    return lowers_match & uppers_match
@@ -3,7 +3,9 @@ from __future__ import annotations
 
 # core python
 import bisect
+import copy
 import math
+import multiprocessing as mp
 from typing import TYPE_CHECKING
 
 # third party packages
@@ -17,8 +19,10 @@ from baselines.ocean.CounterFactualParameters import FeatureType
 from dataset import DataInfo
 from detectors.gradient_boosting_classifier import GradientBoostingClassifier
 from detectors.random_forest import RandomForest
-from explainers.bit_vector import LOWER, UPPER, BitVectorIndex
+from explainers.bit_vector import LOWER, UPPER, BitVectorIndex, bitmap_to_ids
 from explainers.explainer import Explainer
+from explainers.rtree import RTreeIndex
+from explainers.sharded import ShardedBitVectorIndex
 from utilities.metrics import dist_euclidean
 
 # for type hinting only
@@ -31,6 +35,14 @@ class FACET(Explainer):
         self.manager: MethodManager = manager
         self.model_type = manager.model_type
         self.parse_hyperparameters(hyperparameters)
+        self.trace_log = []  # the traced point queries of explain, see search_trace
+        self.pool = None  # the worker processes of prepare, see facet_workers
+
+    def __getstate__(self) -> dict:
+        # the pool of worker processes can't be sent to other processes
+        state = self.__dict__.copy()
+        state["pool"] = None
+        return state
 
     def save_tree_fig(self, t_id: int) -> None:
         plt.figure(dpi=300)
@@ -57,10 +69,17 @@ class FACET(Explainer):
             self.nclasses = model.model.n_classes_
             self.nfeatures = len(model.model.feature_importances_)
 
-        # walk each path and store their representation in an array
-        self.all_paths, self.leaf_vals = self.build_paths(trees)
+        # a pool of worker processes which enumerates the rectangles and builds the indexes
+        if self.nworkers > 1:
+            self.pool = mp.get_context("spawn").Pool(self.nworkers)
+
+        # tabulate the hyper-rectangle and value of each leaf of each tree
+        self.trees = trees
+        self.build_leaf_tables(trees)
         # convert each leaf node into its corresponding hyper-rectangle
-        self.leaf_rects = self.leaves_to_rects(self.all_paths, self.leaf_vals)
+        self.leaf_rects = self.leaves_to_rects()
+        # the paths are only needed by the graph based methods, see all_paths
+        self.built_paths = None
 
         if self.model_type == "GradientBoostingClassifier":
             self.leaf_extremes = self.find_leaf_extremes()
@@ -69,19 +88,197 @@ class FACET(Explainer):
         if self.enumeration_type == "PointBased":
             self.initialize_index()
             self.point_enumerate(data)
-
-        if self.search_type == "BitVector":
-            self.build_bitvectorindex()
-
-    def build_bitvectorindex(self):
+            if self.merge_rects:
+                self.merge_adjacent_rects()
+            if self.prune_contained:
+                self.prune_contained_rects()
+
+        if self.search_type in ["BitVector", "BestFirst"]:
+            self.build_bitvectorindex(data)
+        elif self.search_type == "RTree":
+            self.build_rtreeindex()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def build_bitvectorindex(self, data: np.ndarray = None):
         # create redundant bit vector index
         self.rbvs: list[BitVectorIndex] = []
-        self.rbvs: list[BitVectorIndex] = []
-        for class_id in range(self.nclasses):
+        if self.pool is not None and not (self.search_type == "BitVector" and self.rbv_shards > 1):
+            # build each class's index in a worker process, the indexes are returned without their explainer
+            self.rbvs = self.pool.starmap(build_index_worker, [(self.index[class_id], self.hyperparameters) for class_id in range(self.nclasses)])
+            for rbv in self.rbvs:
+                rbv.explainer = self
+        for class_id in range(len(self.rbvs), self.nclasses):
             if self.verbose:
                 print("class {}".format(class_id))
-            self.rbvs.append(BitVectorIndex(rects=self.index[class_id],
-                                            explainer=self, hyperparameters=self.hyperparameters))
+            if self.search_type == "BitVector" and self.rbv_shards > 1:
+                # split the index into shards searched in parallel by worker processes
+                self.rbvs.append(ShardedBitVectorIndex(rects=self.index[class_id],
+                                                       explainer=self, hyperparameters=self.hyperparameters))
+            else:
+                self.rbvs.append(BitVectorIndex(rects=self.index[class_id],
+                                                explainer=self, hyperparameters=self.hyperparameters))
+
+        # calibrate the Auto radius growth using the samples which would be explained by each index
+        if data is not None and any(rbv.radius_growth == "Auto" for rbv in self.rbvs):
+            preds = self.manager.predict(data)
+            for class_id in range(self.nclasses):
+                self.rbvs[class_id].calibrate_radius(data[preds != class_id], self.equal_weights)
+
+    def build_rtreeindex(self):
+        # create an STR bulk loaded R-tree of each class's hyper-rectangles
+        self.rtrees: list[RTreeIndex] = []
+        for class_id in range(self.nclasses):
+            self.rtrees.append(RTreeIndex(rects=self.index[class_id],
+                                          explainer=self, hyperparameters=self.hyperparameters))
+
+    def prune_contained_rects(self) -> None:
+        '''
+        Compacts the index by removing each hyper-rectangle which lies entirely inside another indexed rect of the same class. The containing rect is at least as near to any point, at least as wide along every axis, and intersects any constraints the contained rect does, so it satisfies every query the contained rect could. The containment check is answered by a temporary bit vector index of each class's rects, see BitVectorIndex.contained_rects. Stores the number of rects of each class before and after in prune_counts
+        '''
+        # the temporary index uses the WordArray backend to match the candidate containers of many rects at once
+        params = copy.deepcopy(self.hyperparameters)
+        params["FACET"]["rbv_backend"] = "WordArray"
+        params["FACET"]["rbv_cache_size"] = 0
+        params["FACET"]["rbv_trace"] = False
+        params["FACET"]["facet_verbose"] = False
+
+        self.prune_counts = []
+        for class_id in range(self.nclasses):
+            nrects = len(self.index[class_id])
+            if nrects > 1:
+                finder = BitVectorIndex(rects=self.index[class_id], explainer=self, hyperparameters=params)
+                contained = set(finder.contained_rects().tolist())
+                self.index[class_id] = [rect for i, rect in enumerate(self.index[class_id]) if i not in contained]
+            self.prune_counts.append((nrects, len(self.index[class_id])))
+            if self.verbose:
+                print("class {} pruned {} contained rects, {} -> {}".format(
+                    class_id, nrects - len(self.index[class_id]), nrects, len(self.index[class_id])))
+
+    def merge_adjacent_rects(self) -> None:
+        '''
+        Compacts the index by merging hyper-rectangles of the same class which overlap or share a face into their bounding box, whenever the bounding box is certified to be entirely of that class, see certify_rects. Each rect in turn is grown by merging it with the touching rect which enlarges it the least, until none of the merge_candidates least enlarging merges are certified. A merged rect absorbs every other rect it comes to contain. The touching rects are found with a temporary bit vector index of the class's enumerated rects. Stores the number of rects of each class before and after in merge_counts
+        '''
+        params = copy.deepcopy(self.hyperparameters)
+        params["FACET"]["rbv_backend"] = "WordArray"
+        params["FACET"]["rbv_cache_size"] = 0
+        params["FACET"]["rbv_trace"] = False
+        params["FACET"]["facet_verbose"] = False
+        leaf_arrays = self.leaf_arrays()
+
+        self.merge_counts = []
+        for class_id in range(self.nclasses):
+            nrects = len(self.index[class_id])
+            if nrects > 1:
+                finder = BitVectorIndex(rects=self.index[class_id], explainer=self, hyperparameters=params)
+                # the bit vectors hold the enumerated bounds, which the touching rects are then checked against exactly using their merged bounds
+                rects = finder.rects.copy()
+                live = np.ones(shape=(nrects,), dtype=bool)
+                for i in range(nrects):
+                    while live[i]:
+                        candidate_ids = bitmap_to_ids(finder.rect_query(rects[i]))
+                        candidate_ids = candidate_ids[live[candidate_ids] & (candidate_ids != i)]
+                        candidates = rects[candidate_ids]
+                        touching = ((candidates[:, :, LOWER] <= rects[i][:, UPPER]) & (candidates[:, :, UPPER] >= rects[i][:, LOWER])).all(axis=1)
+                        candidate_ids = candidate_ids[touching]
+                        if candidate_ids.shape[0] == 0:
+                            break
+                        boxes = np.stack([np.minimum(rects[candidate_ids][:, :, LOWER], rects[i][:, LOWER]),
+                                          np.maximum(rects[candidate_ids][:, :, UPPER], rects[i][:, UPPER])], axis=2)
+                        # order the merges by how far they extend the rect's edges, an edge moved to infinity is infinitely far
+                        with np.errstate(invalid="ignore"):
+                            growth = np.abs(boxes - rects[i])
+                        growth = np.nan_to_num(growth, nan=0.0, posinf=np.inf).sum(axis=(1, 2))
+                        order = np.argsort(growth, kind="stable")[:self.merge_candidates]
+                        order = np.array([j for j in order if self.one_hot_valid(boxes[j])], dtype=int)
+                        if order.shape[0] == 0:
+                            break
+                        certified = order[self.certify_rects(boxes[order], class_id, leaf_arrays)]
+                        if certified.shape[0] == 0:
+                            break
+                        rects[i] = boxes[certified[0]]
+                        # the merged rect absorbs its partner and every other rect it now contains
+                        inside = ((rects[:, :, LOWER] >= rects[i][:, LOWER]) & (rects[:, :, UPPER] <= rects[i][:, UPPER])).all(axis=1)
+                        inside[i] = False
+                        live[inside] = False
+                self.index[class_id] = list(rects[live])
+            self.merge_counts.append((nrects, len(self.index[class_id])))
+            if self.verbose:
+                print("class {} merged {} rects, {} -> {}".format(
+                    class_id, nrects - len(self.index[class_id]), nrects, len(self.index[class_id])))
+
+    def leaf_arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Gathers the leaf hyper-rectangles of every tree in the ensemble into arrays, ordered by tree, for certifying regions with certify_rects
+
+        Returns
+        -------
+        leaf_bounds: an array of shape (nleaves, nfeatures, 2) of each leaf's hyper-rectangle
+        leaf_values: an array of shape (nleaves, nclasses) of each leaf's class probabilities for random forests, or of shape (nleaves,) of each leaf's log odds for gradient boosting
+        tree_starts: an integer array of shape (ntrees,) of the position of each tree's first leaf
+        '''
+        nleaves = np.array([bounds.shape[0] for bounds in self.leaf_bounds], dtype=int)
+        tree_starts = np.cumsum(nleaves) - nleaves
+        return np.concatenate(self.leaf_bounds), np.concatenate(self.leaf_values), tree_starts
+
+    def certify_rects(self, rects: np.ndarray, label: int, leaf_arrays: tuple[np.ndarray, np.ndarray, np.ndarray]) -> np.ndarray:
+        '''
+        Checks whether the ensemble classifies every point in each of the given regions as label. As the trees split with x <= threshold, a region overlaps a leaf when each is above the other's lower edge along every axis. For hard voting a tree is certain of the label in a region when every leaf the region overlaps predicts the label, and the region is certified when a majority of the trees are certain. For soft voting and gradient boosting the region is certified when the label wins the vote even if each tree contributes its least favorable overlapped leaf
+
+        Parameters
+        ----------
+        rects: an array of shape (nrects, nfeatures, 2) of the regions to certify
+        label: the class the regions should be
+        leaf_arrays: the ensemble's leaves as returned by leaf_arrays
+
+        Returns
+        -------
+        certified: a boolean array of shape (nrects,), true iff the corresponding region is entirely of class label
+        '''
+        leaf_bounds, leaf_values, tree_starts = leaf_arrays
+        # skip the leaves outside the bounding box of all the regions, the leaves of each tree partition the space so every tree keeps at least one
+        hull_lower = rects[:, :, LOWER].min(axis=0)
+        hull_upper = rects[:, :, UPPER].max(axis=0)
+        near = ((leaf_bounds[:, :, LOWER] <= hull_upper) & (hull_lower <= leaf_bounds[:, :, UPPER])).all(axis=1)
+        leaf_trees = np.searchsorted(tree_starts, np.flatnonzero(near), side="right") - 1
+        near_starts = np.searchsorted(leaf_trees, np.arange(self.ntrees))
+        leaf_bounds = leaf_bounds[near]
+        leaf_values = leaf_values[near]
+
+        # overlaps[i, j] is true iff region i overlaps leaf j, shape (nrects, nleaves)
+        overlaps = ((leaf_bounds[np.newaxis, :, :, LOWER] < rects[:, np.newaxis, :, UPPER])
+                    & (rects[:, np.newaxis, :, LOWER] < leaf_bounds[np.newaxis, :, :, UPPER])).all(axis=2)
+        if self.model_type == "RandomForest" and self.rf_hardvoting:
+            other_class = leaf_values.argmax(axis=1) != label
+            uncertain = np.logical_or.reduceat(overlaps & other_class, near_starts, axis=1)
+            return (~uncertain).sum(axis=1) >= self.majority_size
+        elif self.model_type == "RandomForest":
+            worst_probs = np.minimum.reduceat(np.where(overlaps, leaf_values[:, label], np.inf), near_starts, axis=1)
+            return worst_probs.sum(axis=1) / self.ntrees > 0.5
+        elif self.model_type == "GradientBoostingClassifier":
+            # odds > 0 correspond to class one, odds < 0 correspond to class zero
+            if label == 1:
+                worst_vals = np.minimum.reduceat(np.where(overlaps, leaf_values, np.inf), near_starts, axis=1)
+            else:
+                worst_vals = np.maximum.reduceat(np.where(overlaps, leaf_values, -np.inf), near_starts, axis=1)
+            odds = self.manager.model.init_value + self.manager.model.lr * worst_vals.sum(axis=1)
+            return odds > 0 if label == 1 else odds < 0
+
+    def set_tracing(self, enabled: bool) -> None:
+        '''
+        Switches the per query search trace of the bit vector indexes on or off at runtime, see BitVectorIndex._point_query_batch
+        '''
+        for rbv in self.rbvs:
+            rbv.tracing = enabled
+
+    def search_trace(self) -> list[dict]:
+        '''
+        Returns the search trace of each point query explain has made with tracing enabled, annotated with the index in x of the explained instance (x_idx) and the counterfactual class searched (cf_class)
+        '''
+        return self.trace_log
 
     def prepare_dataset(self, x: np.ndarray, y: np.ndarray, ds_info: DataInfo) -> None:
         # create a copy of the DataInfo object
@@ -90,6 +287,8 @@ class FACET(Explainer):
         for i in range(self.ds_info.ncols):
             if self.ds_info.possible_vals[i] != []:
                 self.ds_info.possible_vals[i] = np.array(self.ds_info.possible_vals[i])
+        # group the columns by how fit_to_rectangles adjusts them
+        self.compile_fit_plan()
         # compute smart weights if needed for handling unscaled data
         if self.use_smart_weight:
             self.equal_weights = self.get_equal_weights()
@@ -176,6 +375,19 @@ class FACET(Explainer):
                 return False
         return True
 
+    def one_hot_valid_batch(self, rects: np.ndarray) -> np.ndarray:
+        '''
+        Vectorized one_hot_valid, returns a boolean array of shape (nrects,) which is true iff the corresponding rect of rects of shape (nrects, nfeatures, 2) is valid
+        '''
+        valid = np.ones(shape=(rects.shape[0],), dtype=bool)
+        for cat_column_name, sub_col_idxs in self.ds_info.one_hot_schema.items():
+            # requires more than one one-hot high
+            n_set_high = (rects[:, sub_col_idxs, LOWER] > 0).sum(axis=1)
+            # requires all one-hot low
+            n_set_low = (rects[:, sub_col_idxs, UPPER] < 1).sum(axis=1)
+            valid &= (n_set_high <= 1) & (n_set_low != len(sub_col_idxs))
+        return valid
+
     def check_rects_one_hot_valid(self) -> bool:
         invalid_count = 0
         for class_id in [0, 1]:
@@ -269,33 +481,90 @@ class FACET(Explainer):
             i += 1
         return covered
 
-    def leaves_to_rects(self, all_paths: list[list[np.ndarray]], leaf_vals: list[list[np.ndarray]]) -> list[dict]:
+    def build_leaf_tables(self, trees: list[tree.DecisionTreeClassifier]) -> None:
         '''
-        For each path in the ensemble, identifies the leaf node of that path and builds the corresponding hyper-rectangle
+        Tabulates the leaves of each tree in the ensemble, ordered by scikit node id. Stores for each tree i
+
+        leaf_ids[i]: an integer array of shape (nleaves,) of the scikit node id of each leaf
+        leaf_rows[i]: an integer array of shape (nnodes,) mapping each scikit node id to the row of its leaf in the tables, -1 for internal nodes
+        leaf_bounds[i]: an array of shape (nleaves, nfeatures, 2) of the hyper-rectangle of each leaf
+        leaf_values[i]: for random forest an array of shape (nleaves, nclasses) of the class probabilities of each leaf, for gradient boosting classifier an array of shape (nleaves,) of the log odds of each leaf
+        leaf_classes[i]: for random forest an integer array of shape (nleaves,) of the class of each leaf, None for gradient boosting classifier
+        '''
+        self.leaf_ids: list[np.ndarray] = []
+        self.leaf_rows: list[np.ndarray] = []
+        self.leaf_bounds: list[np.ndarray] = []
+        self.leaf_values: list[np.ndarray] = []
+        self.leaf_classes: list[np.ndarray] = []
+        for t in trees:
+            leaf_ids, node_bounds = self.tree_node_bounds(t)
+            leaf_rows = np.full(shape=(t.tree_.node_count,), fill_value=-1, dtype=int)
+            leaf_rows[leaf_ids] = np.arange(leaf_ids.shape[0])
+            self.leaf_ids.append(leaf_ids)
+            self.leaf_rows.append(leaf_rows)
+            self.leaf_bounds.append(node_bounds[leaf_ids])
+            leaf_vals = t.tree_.value[leaf_ids]  # shape (nleaves, noutputs, nclasses)
+            if self.model_type == "RandomForest":
+                samps_per_class = leaf_vals[:, 0, :]
+                self.leaf_values.append(samps_per_class / samps_per_class.sum(axis=1, keepdims=True))
+                self.leaf_classes.append(np.argmax(samps_per_class, axis=1))
+            elif self.model_type == "GradientBoostingClassifier":
+                self.leaf_values.append(leaf_vals[:, 0, 0])
+                self.leaf_classes.append(None)
+
+    def tree_node_bounds(self, t) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Computes the hyper-rectangle of every node of a decision tree from scikit's tree_ arrays. Walks the tree one level at a time, each child taking its parent's bounds narrowed by the parent's split, the max threshold along each axis for right (>) children and the min for left (<=) children as in leaf_rect
 
         Parameters
         ----------
-        The enumerated paths from build_paths, a ragged list of (ntrees, npaths_i)
+        t: the decision tree to walk
+
+        Returns
+        -------
+        leaf_ids: an integer array of the scikit node ids of the tree's leaves in ascending order
+        node_bounds: an array of shape (nnodes, nfeatures, 2) of the hyper-rectangle of each node
+        '''
+        feature = t.tree_.feature
+        threshold = t.tree_.threshold
+        children_left = t.tree_.children_left
+        children_right = t.tree_.children_right
+        # initialize the root as unbounded on both side of all axes
+        node_bounds = np.zeros((t.tree_.node_count, self.nfeatures, 2))
+        node_bounds[0, :, LOWER] = -np.inf
+        node_bounds[0, :, UPPER] = np.inf
+
+        level = np.array([0])
+        while level.shape[0] > 0:
+            parents = level[feature[level] >= 0]  # the internal nodes of the level
+            split_features = feature[parents]
+            split_thresholds = threshold[parents]
+            left = children_left[parents]
+            right = children_right[parents]
+            node_bounds[left] = node_bounds[parents]
+            node_bounds[left, split_features, UPPER] = np.minimum(split_thresholds, node_bounds[parents, split_features, UPPER])
+            node_bounds[right] = node_bounds[parents]
+            node_bounds[right, split_features, LOWER] = np.maximum(split_thresholds, node_bounds[parents, split_features, LOWER])
+            level = np.concatenate([left, right])
+        return np.flatnonzero(feature < 0), node_bounds
+
+    def leaves_to_rects(self) -> list[dict]:
+        '''
+        For each leaf in the ensemble, looks up its class and hyper-rectangle in the leaf tables, see build_leaf_tables
 
         Returns
         -------
-        leaf_rects: a list of dictionarys where leaft_rects[i][j] returns the (leaf_class, rect) corresponding to the path ending in scikit node id j from tree i
+        leaf_rects: a list of dictionarys where leaft_rects[i][j] returns the (leaf_class, rect, leaf_val) of the leaf with scikit node id j from tree i, for gradient boosting classifier leaf_class is the leaf's log odds
         '''
         leaf_rects = [{} for _ in range(self.ntrees)]
         for tid in range(self.ntrees):
-            for path, val in zip(all_paths[tid], leaf_vals[tid]):
-                # get the scikit node id of the leaf and its class
-                leaf_node_id = int(path[-1, 0])
-                # build and save the hyper-rectangle that corresponds to this leaf
-                rect = self.leaf_rect(path)
+            for row, leaf_node_id in enumerate(self.leaf_ids[tid].tolist()):
+                rect = self.leaf_bounds[tid][row]
+                val = self.leaf_values[tid][row]
                 if self.model_type == "RandomForest":
-                    leaf_class = int(path[-1, -1])
-                    # save the class and the hyper-rectangle
-                    leaf_rects[tid][leaf_node_id] = (leaf_class, rect, val)
+                    leaf_rects[tid][leaf_node_id] = (int(self.leaf_classes[tid][row]), rect, val)
                 elif self.model_type == "GradientBoostingClassifier":
-                    leaf_val = path[-1, -1]
-                    # save the class and the hyper-rectangle
-                    leaf_rects[tid][leaf_node_id] = (leaf_val, rect, val)
+                    leaf_rects[tid][leaf_node_id] = (val, rect, val)
         return leaf_rects
 
     def index_rectangles(self, data: np.ndarray):
@@ -307,16 +576,102 @@ class FACET(Explainer):
         # get the leaves that each sample ends up in
         all_leaves = model.apply(data).reshape(data.shape[0], self.ntrees)  # shape (nsamples in xtrain, ntrees)
 
+        # samples which fall in the same leaf of every tree have the same prediction and hyper-rectangle, enumerate only the first of each
+        _, first_ids = np.unique(all_leaves, axis=0, return_index=True)
+        first_ids = np.sort(first_ids)
+        self.nsamples_enumerated += data.shape[0]
+        self.nsamples_collapsed += data.shape[0] - first_ids.shape[0]
+        if self.verbose:
+            print("collapsed {} of {} samples with duplicate leaves".format(data.shape[0] - first_ids.shape[0], data.shape[0]))
+        all_leaves = all_leaves[first_ids]
+        preds = preds[first_ids]
+
+        if self.pool is not None and all_leaves.shape[0] >= self.nworkers:
+            # enumerate contiguous chunks of the instances in the pool of worker processes
+            chunks = np.array_split(np.arange(all_leaves.shape[0]), self.nworkers)
+            worker_explainer = self.worker_copy()
+            results = self.pool.starmap(enumerate_worker, [(worker_explainer, all_leaves[ids], preds[ids]) for ids in chunks])
+        else:
+            results = [self.enumerate_chunk(all_leaves, preds)]
+
+        # merge the chunks' rectangles in order, so that the index is the same for any number of workers
         visited_rects = [{} for _ in range(self.nclasses)]  # a hashmap to store which rectangles we have visited
-        # for each instance in the training set
-        for instance, label, leaf_ids in zip(data, preds, all_leaves):
-            rect, paths_used = self.enumerate_rectangle(leaf_ids, label)
-            key = hash(tuple(paths_used))  # hash the path list to get a unique key corresponding to this HR
-            if key not in visited_rects[label]:  # if we haven't visited this hyper-rectangle before
-                if self.one_hot_valid(rect):
+        new_rects = [[] for _ in range(self.nclasses)]  # the rectangles added to the index by this call
+        for chunk_rects in results:
+            for label, key, rect in chunk_rects:
+                if key not in visited_rects[label]:  # if we haven't visited this hyper-rectangle before
                     self.add_to_index(label, rect)  # add it to the index
+                    new_rects[label].append(rect)
                     visited_rects[label][key] = True  # remember that we've indexed it
 
+        # if the search indexes have already been built, grow them rather than rebuilding. the bit vector and sharded indexes append the new rects' bits in place, while the R-trees are bulk loaded again
+        for search_indexes in [self.rbvs, self.rtrees]:
+            if search_indexes is not None:
+                for label in range(self.nclasses):
+                    search_indexes[label].insert(new_rects[label])
+
+    def enumerate_chunk(self, all_leaves: np.ndarray, preds: np.ndarray) -> list[tuple]:
+        '''
+        Enumerates the hyper-rectangle of each of a chunk of instances and keeps the first valid rectangle of each class with each unique key, the leaves used in the intersection. Rectangles which aren't one-hot valid are never kept
+
+        Parameters
+        ----------
+        all_leaves: an integer array of shape (ninstances, ntrees) of the scikit learn leaf ids selected for each instance
+        preds: an integer array of shape (ninstances,) of the model's prediction for each instance
+
+        Returns
+        -------
+        chunk_rects: a list of tuples (label, key, rect) in the order of the instances
+        '''
+        if self.model_type == "RandomForest" and (self.rf_hardvoting or self.intersect_order == "Probability"):
+            # enumerate the rectangles of all the instances at once
+            rects, used = self.enumerate_rectangles(all_leaves, preds)
+            valid = self.one_hot_valid_batch(rects)
+            # the leaves used identify the HR, unused trees are marked with leaf -1
+            keys = [row.tobytes() for row in np.where(used, all_leaves, -1)]
+        else:
+            rects, keys, valid = [], [], []
+            for label, leaf_ids in zip(preds, all_leaves):
+                rect, paths_used = self.enumerate_rectangle(leaf_ids, label)
+                rects.append(rect)
+                keys.append(hash(tuple(paths_used)))  # hash the path list to get a unique key corresponding to this HR
+                valid.append(self.one_hot_valid(rect))
+
+        visited_rects = [set() for _ in range(self.nclasses)]
+        chunk_rects = []
+        for label, key, rect, is_valid in zip(preds, keys, rects, valid):
+            if is_valid and key not in visited_rects[label]:
+                visited_rects[label].add(key)
+                chunk_rects.append((label, key, rect.copy()))
+        return chunk_rects
+
+    def worker_copy(self) -> FACET:
+        '''
+        Returns a shallow copy of the explainer without its indexes or leaf tables, to send to the worker processes which enumerate rectangles. The leaf tables are much larger than the trees they are built from, so each worker rebuilds them
+        '''
+        worker_explainer = copy.copy(self)
+        # the manager refers back to this explainer
+        worker_explainer.manager = copy.copy(self.manager)
+        worker_explainer.manager.explainer = None
+        worker_explainer.index = None
+        worker_explainer.rbvs = None
+        worker_explainer.rtrees = None
+        worker_explainer.pool = None
+        worker_explainer.leaf_rects = None
+        worker_explainer.built_paths = None
+        for table in ["leaf_ids", "leaf_rows", "leaf_bounds", "leaf_values", "leaf_classes"]:
+            setattr(worker_explainer, table, None)
+        return worker_explainer
+
+    def search_copy(self) -> FACET:
+        '''
+        Returns a copy of the explainer with only what fitting instances to rectangles and measuring distances need, to send to the worker processes which search the shards of a ShardedBitVectorIndex. Unlike a worker_copy it also drops the model and its trees, which the searches never use
+        '''
+        search_explainer = self.worker_copy()
+        search_explainer.manager = None
+        search_explainer.trees = None
+        return search_explainer
+
     def add_to_index(self, label: int, rectangle: np.ndarray) -> None:
         '''
         Add the rectangle to the index
@@ -328,6 +683,11 @@ class FACET(Explainer):
         Creates an empty index to store the hyper-rectangles. Functionized to allow for multiple indexing options
         '''
         self.index = [[] for _ in range(self.nclasses)]
+        self.rbvs: list[BitVectorIndex] = None
+        self.rtrees: list[RTreeIndex] = None
+        # the number of samples index_rectangles was given, and how many were skipped as their leaves duplicated an earlier sample's
+        self.nsamples_enumerated = 0
+        self.nsamples_collapsed = 0
 
     def enumerate_rectangle(self, leaf_ids: list[int], label: int) -> np.ndarray:
         '''
@@ -349,8 +709,11 @@ class FACET(Explainer):
         paths: list[(int, int)] = []  # list of tree_id, leaf_id included in all_bounds
         path_probs: list[np.ndarray] = []  # list of class probs for the given leaves, dims (nclasses,)
         for tree_id in range(self.ntrees):
-            leaf_class, leaf_rect, class_probs = self.leaf_rects[tree_id][leaf_ids[tree_id]]
+            row = self.leaf_rows[tree_id][int(leaf_ids[tree_id])]
+            leaf_rect = self.leaf_bounds[tree_id][row]
+            class_probs = self.leaf_values[tree_id][row]
             if self.model_type == "RandomForest":
+                leaf_class = self.leaf_classes[tree_id][row]
                 # for hard voting take only the hyper-rectangles which predict the given label
                 # for soft voting the probability of all classes for all leaves contributes to the final classfication
                 # e.g. several leaves predict class 1 with probs [0.49, 0.51], we may need them to make class 0 pred
@@ -367,6 +730,88 @@ class FACET(Explainer):
         rect, paths_used = self.select_intersection(all_bounds, paths, path_probs, label)
         return rect, paths_used
 
+    def enumerate_rectangles(self, all_leaves: np.ndarray, labels: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        A batched enumerate_rectangle for random forests with hard voting, or soft voting with the Probability intersection order, which constructs the same majority size hyper-rectangles using array operations. The leaf hyper-rectangles of a chunk of instances are gathered into a block of shape (ninstances, ntrees, nfeatures, 2), the leaves to intersect are chosen by ordering each instance's leaves and applying the majority or probability cutoff, and the chosen leaves are intersected by taking the max of their lower and the min of their upper bounds
+
+        Parameters
+        ----------
+        all_leaves: an integer array of shape (ninstances, ntrees), where all_leaves[i][j] is the scikit learn id of the leaf node selected by tree j for instance i
+        labels: an integer array of shape (ninstances,) of the class of the hyper-rectangle to construct for each instance
+
+        Returns
+        -------
+        rects: an array of shape (ninstances, nfeatures, 2) of the majority size hyper-rectangle of each instance
+        used: a boolean array of shape (ninstances, ntrees), true iff the instance's leaf of the tree forms part of the intersection
+        '''
+        ninstances = all_leaves.shape[0]
+        rects = np.empty(shape=(ninstances, self.nfeatures, 2))
+        used = np.zeros(shape=(ninstances, self.ntrees), dtype=bool)
+        # the row of each instance's leaf in each tree's leaf tables, shape (ninstances, ntrees)
+        leaf_rows = np.stack([self.leaf_rows[t][all_leaves[:, t].astype(int)] for t in range(self.ntrees)], axis=1)
+        if self.rf_hardvoting and self.intersect_order == "Size":
+            leaf_widths = [np.array([self.rect_width(rect).mean() for rect in self.leaf_bounds[t]]) for t in range(self.ntrees)]
+
+        # bound the size of the block of leaf hyper-rectangles to 2**21 floats
+        chunk_size = max(1, 2**21 // (self.ntrees * self.nfeatures * 2))
+        for start in range(0, ninstances, chunk_size):
+            rows = leaf_rows[start:start + chunk_size]
+            chunk_labels = labels[start:start + chunk_size]
+            chunk_used = used[start:start + chunk_size]
+            bounds = np.stack([self.leaf_bounds[t][rows[:, t]] for t in range(self.ntrees)], axis=1)
+            label_probs = np.stack([self.leaf_values[t][rows[:, t], chunk_labels] for t in range(self.ntrees)], axis=1)
+
+            if self.rf_hardvoting:
+                # take only the leaves which predict the given label, ordered as in select_hard_intersection
+                classes = np.stack([self.leaf_classes[t][rows[:, t]] for t in range(self.ntrees)], axis=1)
+                candidates = classes == chunk_labels[:, np.newaxis]
+                if self.intersect_order == "Axes":
+                    keys = np.isfinite(bounds).sum(axis=(2, 3))
+                elif self.intersect_order == "Size":
+                    keys = np.stack([leaf_widths[t][rows[:, t]] for t in range(self.ntrees)], axis=1)
+                else:
+                    keys = label_probs
+                self.select_leaves(chunk_used, candidates, keys, self.majority_size)
+            else:
+                # take leaves in order of largest probability until the label has the majority probability
+                order = label_probs.argsort(axis=1)[:, ::-1]
+                accumulated_prob = np.cumsum((1 / self.ntrees) * np.take_along_axis(label_probs, order, axis=1), axis=1)
+                # the accumulated probability never decreases, so the leaves are taken up to and including the first to pass 0.5
+                ntaken = np.minimum((accumulated_prob <= 0.5).sum(axis=1) + 1, self.ntrees)
+                taken = np.arange(self.ntrees)[np.newaxis, :] < ntaken[:, np.newaxis]
+                np.put_along_axis(chunk_used, order, taken, axis=1)
+
+            rects[start:start + chunk_size, :, LOWER] = np.where(chunk_used[:, :, np.newaxis], bounds[:, :, :, LOWER], -np.inf).max(axis=1)
+            rects[start:start + chunk_size, :, UPPER] = np.where(chunk_used[:, :, np.newaxis], bounds[:, :, :, UPPER], np.inf).min(axis=1)
+        return rects, used
+
+    def select_leaves(self, used: np.ndarray, candidates: np.ndarray, keys: np.ndarray, n: int) -> None:
+        '''
+        Marks the first n candidate leaves of each instance in the intersection order as used. The candidates of the instances with the same number of candidates are sorted together, so that ties are ordered as argsort orders them for a single instance in select_hard_intersection
+
+        Parameters
+        ----------
+        used: the boolean output array of shape (ninstances, ntrees)
+        candidates: a boolean array of shape (ninstances, ntrees), true iff the instance's leaf of the tree may be intersected
+        keys: an array of shape (ninstances, ntrees) of the sort key of each leaf, ignored for the Ensemble order
+        n: the number of leaves to use
+        '''
+        ncandidates = candidates.sum(axis=1)
+        for count in np.unique(ncandidates):
+            if count == 0:
+                continue
+            group = np.flatnonzero(ncandidates == count)
+            # the candidate trees of each instance in the group in ensemble order, shape (ngroup, count)
+            trees = np.nonzero(candidates[group])[1].reshape(group.shape[0], count)
+            if self.intersect_order == "Ensemble":
+                chosen = trees[:, :n]
+            else:
+                order = np.take_along_axis(keys[group], trees, axis=1).argsort(axis=1)
+                if self.intersect_order == "Probability":
+                    order = order[:, ::-1]
+                chosen = np.take_along_axis(trees, order[:, :n], axis=1)
+            used[group[:, np.newaxis], chosen] = True
+
     def select_hard_intersection(self, all_bounds: list[np.ndarray], paths: list[tuple[int]], path_probs: np.ndarray, label: int) -> np.ndarray:
         '''
         ensemble is using majority vote take the intersection of the first nmajority hyper-rectangles, we should only receive leaf hyper-rectangles of class `label`
@@ -422,15 +867,7 @@ class FACET(Explainer):
     def find_leaf_extremes(self) -> list[tuple[float, float]]:
         worst_values = []
         for tree_id in range(self.ntrees):
-            lowest_val = np.inf
-            highest_val = -np.inf
-            for path_id in range(len(self.all_paths[tree_id])):
-                val = self.all_paths[tree_id][path_id][-1, -1]
-                if val < lowest_val:
-                    lowest_val = val
-                if val > highest_val:
-                    highest_val = val
-            worst_values.append([lowest_val, highest_val])
+            worst_values.append([self.leaf_values[tree_id].min(), self.leaf_values[tree_id].max()])
         return worst_values
 
     def gbc_accumulate_odds(self, leaf_vals: np.ndarray) -> float:
@@ -590,7 +1027,7 @@ class FACET(Explainer):
 
         Parameters
         ---------
-        path : a numpy array representing the path as constructed by __in_order_path
+        path : a numpy array representing the path as constructed by build_paths
 
         Returns
         -------
@@ -611,26 +1048,18 @@ class FACET(Explainer):
                 feature_bounds[feature][0] = max(threshold, feature_bounds[feature][0])
         return feature_bounds
 
-    def build_paths(self, trees: list[tree.DecisionTreeClassifier]) -> list[list[np.ndarray]]:
+    @property
+    def all_paths(self) -> list[list[np.ndarray]]:
         '''
-        Walks each tree and extracts each path from root to leaf into a data structure. Each tree is represented as a list of paths, with each path stored into an array
-
-        Returns
-        -------
-        all_paths: a list of length ntrees, where all_paths[i] contains a list of the paths in tree i each represented by a numpy array as generated by in_order_path
-        path_class_vals: the value of the leaf for each path. for random forest this is a list of class probabilities (nclasses,), for gradient boosting classifier its the logodds of the leaf
+        The root to leaf paths of each tree as generated by build_paths. Only the graph based methods use the paths, so they are built on first use
         '''
-        ntrees = len(trees)
-        all_paths = [[] for _ in range(ntrees)]
-        path_class_vals = [[] for _ in range(ntrees)]
-        for i in range(ntrees):
-            all_paths[i], path_class_vals[i] = self.__in_order_path(t=trees[i], built_paths=[], leaf_vals=[])
-
-        return all_paths, path_class_vals
+        if self.built_paths is None:
+            self.built_paths, _ = self.build_paths(self.trees)
+        return self.built_paths
 
-    def __in_order_path(self, t, built_paths: list[np.ndarray] = [], leaf_vals: list[np.ndarray] = [], node_id=0, path: list = []):
+    def build_paths(self, trees: list[tree.DecisionTreeClassifier]) -> list[list[np.ndarray]]:
         '''
-        An algorithm for pre-order binary tree traversal. This walks through the entire tree enumerating each paths the root node to a leaf.
+        Walks each tree in pre-order and extracts each path from root to leaf into a data structure. Each tree is represented as a list of paths, with each path stored into an array. The leaves are looked up in the leaf tables, see build_leaf_tables
 
         Each path is represented by an array of nodes
         Each node is reprsented by a tuple
@@ -638,58 +1067,37 @@ class FACET(Explainer):
                 [node_id, feature, cond, threshold]
             While for leaf nodes this is
                 [node_id, -1, -1, class_id]
-            Where cond is 0 for (<= )and 1 for (>)
-        The tree is reprsented as a list of these arrays
-
-        Parameters
-        ----------
-        t           : the decision tree classifier to travers
-        built_paths : the return values, a list of tuples (`class_id` = integer class ID, `path=[f, g, h, i, j]`)
-        node_id     : the `node_id` to start traversal at, defaults to root node of tree (`node_id=0`)
-        path        : the starting path up to by not including the node referenced by `node_id`, defaults to empty
+            Where cond is 0 for (<= )and 1 for (>), for gradient boosting classifier the leaf's class_id is its log odds
 
         Returns
         -------
-        None : see the output parameter `built_paths`
+        all_paths: a list of length ntrees, where all_paths[i] contains a list of the paths in tree i each represented by a numpy array
+        path_class_vals: the value of the leaf for each path. for random forest this is a list of class probabilities (nclasses,), for gradient boosting classifier its the logodds of the leaf
         '''
+        ntrees = len(trees)
+        all_paths = [[] for _ in range(ntrees)]
+        path_class_vals = [[] for _ in range(ntrees)]
+        for i in range(ntrees):
+            t = trees[i]
+            # a stack of nodes and the paths up to but not including them, pushing the right child first visits the left child first
+            stack = [(0, [])]
+            while len(stack) > 0:
+                node_id, path = stack.pop()
+                feature = t.tree_.feature[node_id]
+                if feature >= 0:  # this is an internal node
+                    threshold = t.tree_.threshold[node_id]
+                    stack.append((t.tree_.children_right[node_id], path + [[node_id, feature, 1, threshold]]))
+                    stack.append((t.tree_.children_left[node_id], path + [[node_id, feature, 0, threshold]]))
+                else:  # this is a leaf node
+                    row = self.leaf_rows[i][node_id]
+                    if self.model_type == "RandomForest":
+                        leaf_node = [node_id, -1, -1, self.leaf_classes[i][row]]
+                    elif self.model_type == "GradientBoostingClassifier":
+                        leaf_node = [node_id, -1, -1, self.leaf_values[i][row]]
+                    all_paths[i].append(np.array(path + [leaf_node]))
+                    path_class_vals[i].append(self.leaf_values[i][row])
 
-        # process current node
-        feature = t.tree_.feature[node_id]
-        if feature >= 0:  # this is an internal node
-            threshold = t.tree_.threshold[node_id]
-
-            # process left child, conditioned (<=)
-            left_path = path.copy()
-            left_path.append([node_id, feature, 0, threshold])
-            self.__in_order_path(t, built_paths, leaf_vals, node_id=t.tree_.children_left[node_id], path=left_path)
-
-            # process right node, conditioned (>)
-            right_path = path.copy()
-            right_path.append([node_id, feature, 1, threshold])
-            self.__in_order_path(t, built_paths, leaf_vals, node_id=t.tree_.children_right[node_id], path=right_path)
-
-            return built_paths, leaf_vals
-
-        else:  # this is a leaf node
-            leaf_val: np.ndarray = t.tree_.value[node_id]
-            path = path.copy()
-            # get the class probabilities for this leaf
-            if self.model_type == "RandomForest":
-                samps_per_class = leaf_val
-                class_id = np.argmax(samps_per_class)
-                path.append([node_id, -1, -1, class_id])
-                class_probs: np.ndarray = (samps_per_class / samps_per_class.sum()).squeeze()
-                leaf_vals.append(class_probs)
-            elif self.model_type == "GradientBoostingClassifier":
-                leaf_odds = leaf_val[0, 0]
-                path.append([node_id, -1, -1, leaf_odds])
-                leaf_vals.append(leaf_odds)
-
-            # store the completed path and exit
-            finished_path = np.array(path)
-            built_paths.append(finished_path)
-
-            return built_paths, leaf_vals
+        return all_paths, path_class_vals
 
     def is_inside(self, x: np.ndarray, rect: np.ndarray) -> bool:
         '''
@@ -715,8 +1123,6 @@ class FACET(Explainer):
         # if we're using unscaled values, we may have very large values with large float. pt. error
 
         xprime = x.copy()
-        binary_required_high = set()
-        binary_required_low = set()
         if self.ds_info.all_numeric:  # if all features are numeric, do a quick fit using array operations
             # determine which values need to adjusted to be smaller, and which need to be larger
             low_values = xprime <= (rect[:, LOWER] + self.EPSILONS)
@@ -735,86 +1141,11 @@ class FACET(Explainer):
             xprime[high_values] = rect[high_values, UPPER] - self.offsets[high_values]
             # for oversteped bounds use the average between min and max
             xprime[idx_overstep] = rect[idx_overstep, LOWER] + rect_width[idx_overstep] / 2
-        else:  # if there are non-numeric features, handle them directly
-            i = 0
-            while i < self.ds_info.ncols:
-                # determine if the value is too low, too high, and if an overstep will occur
-                is_low = (xprime[i] <= (rect[i, LOWER] + self.EPSILONS[i]))
-                is_high = (xprime[i] >= (rect[i, UPPER] - self.EPSILONS[i]))
-                rect_width_i = (rect[i, UPPER] - rect[i, LOWER])
-                is_overstep = (rect_width_i <= self.offsets[i])
-
-                # for numeric features do a simple step if needed with overstep checking
-                if self.ds_info.col_types[i] == FeatureType.Numeric:
-                    if is_overstep:
-                        xprime[i] = rect[i, LOWER] + rect_width_i / 2
-                    elif is_low:
-                        xprime[i] = rect[i, LOWER] + self.offsets[i]
-                    elif is_high:
-                        xprime[i] = rect[i, UPPER] - self.offsets[i]
-                # for binary features flip the value if needed
-                elif self.ds_info.col_types[i] == FeatureType.Binary:
-                    if rect[i, UPPER] < 1.0:
-                        binary_required_low.add(i)
-                    if rect[i, LOWER] > 0.0:
-                        binary_required_high.add(i)
-                    if is_low:
-                        # since some binary columns are from one-hot encoding of categorical features
-                        # we need to enfore the one-hot property for these features
-                        if i in self.ds_info.reverse_one_hot_schema:  # if this column is for a one-hot encoding
-                            # determine which feature it encodes
-                            feat_name = self.ds_info.reverse_one_hot_schema[i]
-                            # clear the other columns for this feature
-                            xprime[self.ds_info.one_hot_schema[feat_name]] = 0.0
-                        # set the current column value if needed
-                        xprime[i] = 1.0
-                    elif is_high:
-                        # set the feature low
-                        xprime[i] = 0.0
-                        binary_required_low.add(i)
-                        if i in self.ds_info.reverse_one_hot_schema:  # if this column is for a one-hot encoding
-                            # determine which feature it encodes
-                            feat_name = self.ds_info.reverse_one_hot_schema[i]
-                            # check which other columns are set
-                            feature_columns = np.array(self.ds_info.one_hot_schema[feat_name])
-                            n_set_cols = sum(xprime[feature_columns])
-                            if n_set_cols == 0:  # if this was the only col set, we need to set one
-                                rect_allowed_high = feature_columns[rect[feature_columns, UPPER] >= 1.0]
-                                xprime[np.random.choice(rect_allowed_high, 1)] = 1.0
-
-                # for discrete values find the next largest or next smallest value as needed
-                elif self.ds_info.col_types[i] == FeatureType.Discrete:
-                    if is_low:  # if low, choose the next largest value
-                        differences = (self.ds_info.possible_vals[i] - rect[i, LOWER])
-                        differences[differences < 0] = np.inf
-                        idx_next_larger = np.argmin(differences)
-                        # if we're in danger of floating point innacuracy
-                        if (self.ds_info.possible_vals[i][idx_next_larger] - rect[i, LOWER]) < self.EPSILONS[i]:
-                            if idx_next_larger < len(self.ds_info.possible_vals[i]) - 1:  # and we can step up, do it
-                                idx_next_larger += 1
-                            else:  # if we can't this is an invalid explanation
-                                return None
-                        xprime[i] = self.ds_info.possible_vals[i][idx_next_larger]
-                        if xprime[i] > rect[i, UPPER] - self.EPSILONS[i]:  # if the next step up is out of the rect
-                            return None
-                    elif is_high:  # if high, choose the next smalles value
-                        differences = (self.ds_info.possible_vals[i] - rect[i, UPPER])
-                        differences[differences > 0] = -np.inf
-                        idx_next_lower = np.argmax(differences)
-                        # if we're in danger of floating point innacuracy
-                        if (rect[i, UPPER] - self.ds_info.possible_vals[i][idx_next_lower]) < self.EPSILONS[i]:
-                            if idx_next_lower > 1:  # and we can step down, do it
-                                idx_next_lower -= 1
-                            else:  # if we can't this is an invalid explanation
-                                return None
-                        xprime[i] = self.ds_info.possible_vals[i][idx_next_lower]
-                        if xprime[i] < rect[i, LOWER] + self.EPSILONS[i]:  # if the next step down is out of the rect
-                            return None
-                # handle categorical one-hot encoded values, making sure only one column is hot for categorical feature
-                elif self.ds_info.col_types[i] == FeatureType.Categorical:
-                    print("How'd you get here? Categorical features should be one-hot encoded")
-                    print("If for some reason you don't want to one-hot encode please consider marking as discrete instead")
-                i += 1
+        else:  # if there are non-numeric features, fit using the compiled plan
+            xprimes, valid = self.fit_mixed_types(xprime[np.newaxis], rect[np.newaxis])
+            if not valid[0]:
+                return None
+            xprime = xprimes[0]
         # !DEBUG START
         # if not self.ds_info.check_valid([xprime]):
         #     print("CRITICAL ERROR - FACET GENERATED AN INVALID EXPLANATION")
@@ -824,6 +1155,200 @@ class FACET(Explainer):
 
         return xprime
 
+    def fit_to_rectangles(self, x: np.ndarray, rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Computes an adjusted copy of x that falls within the bounds of each of the given rectangles. Equivalent to calling fit_to_rectangle once per rectangle, but performed with array operations over the whole block of rectangles
+
+        Parameters
+        ----------
+        x: an instance array of shape (nfeatures,), or an array of shape (nrects, nfeatures) with one instance per rectangle
+        rects: a numpy array of shape (nrects, nfeatures, 2) of hyper-rectangles as constructed by enumerate_rectangle
+
+        Returns
+        -------
+        xprimes: an array of shape (nrects, nfeatures) where xprimes[i] is x adjusted to fall in rects[i]
+        valid: a boolean array of shape (nrects,), false where no valid adjustment of x exists for rects[i] in which case the corresponding row of xprimes is meaningless
+        '''
+        xprimes = np.broadcast_to(x, rects.shape[:-1]).copy()
+        valid = np.ones(shape=(rects.shape[0],), dtype=bool)
+        if self.ds_info.all_numeric:  # if all features are numeric, fit all rects at once with the same rules
+            lower_bounds = rects[:, :, LOWER]
+            upper_bounds = rects[:, :, UPPER]
+            # determine which values need to adjusted to be smaller, and which need to be larger
+            low_values = xprimes <= (lower_bounds + self.EPSILONS)
+            high_values = xprimes >= (upper_bounds - self.EPSILONS)
+            # identify features which need to be adjusted and will overstep the min or max value
+            rect_widths = (upper_bounds - lower_bounds)
+            idx_overstep = np.logical_and(rect_widths <= self.offsets, np.logical_or(low_values, high_values))
+            # apply the adjustments in the same precedence as fit_to_rectangle: low, then high, then overstep
+            xprimes = np.where(low_values, lower_bounds + self.offsets, xprimes)
+            xprimes = np.where(high_values, upper_bounds - self.offsets, xprimes)
+            with np.errstate(invalid="ignore"):  # unbounded axes give inf-inf, these are never selected as overstep
+                xprimes = np.where(idx_overstep, lower_bounds + rect_widths / 2, xprimes)
+        else:  # if there are non-numeric features, fit all rects at once using the compiled plan
+            xprimes, valid = self.fit_mixed_types(xprimes, rects)
+        return xprimes, valid
+
+    def compile_fit_plan(self) -> None:
+        '''
+        Groups the columns of the dataset by how fit_mixed_types adjusts them. Stores
+
+        fit_numeric: an integer array of the numeric columns
+        fit_binary: an integer array of the binary columns which aren't part of a one-hot encoding
+        fit_one_hot: a list with an integer array of the columns of each one-hot encoded feature, in the order of the one-hot schema
+        fit_discrete: an integer array of the discrete columns
+        fit_discrete_vals: a list with the sorted possible values of each discrete column
+        fit_categorical: true iff any column is categorical, which fitting doesn't support
+        '''
+        col_types = self.ds_info.col_types
+        ncols = self.ds_info.ncols
+        one_hot_cols = set(self.ds_info.reverse_one_hot_schema.keys())
+        self.fit_numeric = np.array([i for i in range(ncols) if col_types[i] == FeatureType.Numeric], dtype=int)
+        self.fit_binary = np.array([i for i in range(ncols) if col_types[i] == FeatureType.Binary and i not in one_hot_cols], dtype=int)
+        self.fit_one_hot = [np.array(sub_col_idxs, dtype=int) for sub_col_idxs in self.ds_info.one_hot_schema.values()]
+        self.fit_discrete = np.array([i for i in range(ncols) if col_types[i] == FeatureType.Discrete], dtype=int)
+        self.fit_discrete_vals = [np.unique(self.ds_info.possible_vals[i]) for i in self.fit_discrete]
+        self.fit_categorical = any([col_types[i] == FeatureType.Categorical for i in range(ncols)])
+
+    def fit_mixed_types(self, xprimes: np.ndarray, rects: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Fits instances to rectangles for datasets with non-numeric features using the plan compiled by compile_fit_plan, with array operations over all the rectangles. Numeric features step inside the bounds as in fit_to_rectangle, binary features flip, and discrete features move to the next possible value inside the bounds, found with searchsorted. The columns of each one-hot encoded feature are adjusted in column order, setting a required column high clears the others, and clearing the only high column sets a random allowed column high. The random columns are drawn in the order of the rects then the columns, exactly as if fitting one rect at a time
+
+        Parameters
+        ----------
+        xprimes: an array of shape (nrects, nfeatures) of the instance to fit to each rectangle, adjusted in place
+        rects: a numpy array of shape (nrects, nfeatures, 2) of hyper-rectangles
+
+        Returns
+        -------
+        xprimes: an array of shape (nrects, nfeatures) where xprimes[i] is the instance adjusted to fall in rects[i]
+        valid: a boolean array of shape (nrects,), false where there is no possible value of a discrete feature inside rects[i]
+        '''
+        nrects = rects.shape[0]
+        ncols = self.ds_info.ncols
+        lower_bounds = rects[:, :, LOWER]
+        upper_bounds = rects[:, :, UPPER]
+        # determine which values are too low, and which are too high
+        low_values = xprimes <= (lower_bounds + self.EPSILONS)
+        high_values = xprimes >= (upper_bounds - self.EPSILONS)
+
+        # for numeric features do a simple step if needed, the midpoint of the range takes precedence over stepping up from the min which takes precedence over stepping down from the max
+        cols = self.fit_numeric
+        rect_widths = upper_bounds[:, cols] - lower_bounds[:, cols]
+        adjusted = np.where(high_values[:, cols], upper_bounds[:, cols] - self.offsets[cols], xprimes[:, cols])
+        adjusted = np.where(low_values[:, cols], lower_bounds[:, cols] + self.offsets[cols], adjusted)
+        with np.errstate(invalid="ignore"):  # unbounded axes give inf-inf, these are never oversteps
+            adjusted = np.where(rect_widths <= self.offsets[cols], lower_bounds[:, cols] + rect_widths / 2, adjusted)
+        xprimes[:, cols] = adjusted
+
+        # for binary features flip the value if needed
+        cols = self.fit_binary
+        xprimes[:, cols] = np.where(low_values[:, cols], 1.0, np.where(high_values[:, cols], 0.0, xprimes[:, cols]))
+
+        # for discrete values find the next largest or next smallest value as needed, fit_to_rectangle gives up on a rect at the first column with no such value
+        first_failure = np.full(shape=(nrects,), fill_value=ncols)
+        for col, vals in zip(self.fit_discrete, self.fit_discrete_vals):
+            lower, upper, eps = lower_bounds[:, col], upper_bounds[:, col], self.EPSILONS[col]
+            is_low = low_values[:, col]
+            is_high = high_values[:, col] & ~is_low
+            # if low, choose the smallest value at or above the min, or the first value if there's none
+            idx_next_larger = np.searchsorted(vals, lower, side="left")
+            idx_next_larger[idx_next_larger == vals.shape[0]] = 0
+            # if we're in danger of floating point innacuracy step up if we can
+            step_up = (vals[idx_next_larger] - lower) < eps
+            failed_up = step_up & (idx_next_larger >= vals.shape[0] - 1)
+            idx_next_larger[step_up & ~failed_up] += 1
+            failed_up |= vals[idx_next_larger] > upper - eps  # if the next step up is out of the rect
+            # if high, choose the largest value at or below the max, or the first value if there's none
+            idx_next_lower = np.searchsorted(vals, upper, side="right") - 1
+            idx_next_lower[idx_next_lower < 0] = 0
+            # if we're in danger of floating point innacuracy step down if we can
+            step_down = (upper - vals[idx_next_lower]) < eps
+            failed_down = step_down & (idx_next_lower <= 1)
+            idx_next_lower[step_down & ~failed_down] -= 1
+            failed_down |= vals[idx_next_lower] < lower + eps  # if the next step down is out of the rect
+
+            xprimes[:, col] = np.where(is_low, vals[idx_next_larger], np.where(is_high, vals[idx_next_lower], xprimes[:, col]))
+            failed = (is_low & failed_up) | (is_high & failed_down)
+            first_failure = np.minimum(first_failure, np.where(failed, col, ncols))
+
+        # handle one-hot encoded values, making sure only one column is hot for each categorical feature
+        original = xprimes.copy()
+        draws = []  # the rect ids, column, feature, and whether a later column cleared it, of each random column set
+        replay = np.zeros(shape=(nrects,), dtype=bool)  # rects which need to be fit one column at a time, see below
+        for feature_id, feature_columns in enumerate(self.fit_one_hot):
+            order = np.sort(feature_columns)
+            state = xprimes[:, order]
+            # the random column is left low in state until drawn. if it may be found high by a later column of the feature, then the outcome depends on which column is drawn and the rect is replayed
+            upper_group = upper_bounds[:, order]
+            may_be_high = np.any((upper_group >= 1.0) & (upper_group - self.EPSILONS[order] <= 1.0), axis=1)
+            drawn_at = np.full(shape=(nrects,), fill_value=-1)  # the column at which a random column was set
+            for j, col in enumerate(order):
+                # check the current values, as earlier columns of the feature may have changed this one
+                is_low = state[:, j] <= (lower_bounds[:, col] + self.EPSILONS[col])
+                is_high = ~is_low & (state[:, j] >= (upper_bounds[:, col] - self.EPSILONS[col]))
+                # set the column high and clear the other columns for this feature, including any random column
+                state[is_low] = 0.0
+                state[is_low, j] = 1.0
+                cleared = is_low & (drawn_at >= 0)
+                draws.extend([(rect_id, drawn_at[rect_id], feature_id, True) for rect_id in np.flatnonzero(cleared)])
+                drawn_at[cleared] = -1
+                # set the column low, if this was the only column set we need to set one
+                state[is_high, j] = 0.0
+                draw = is_high & (drawn_at < 0) & (state.sum(axis=1) == 0)
+                drawn_at[draw] = col
+                replay |= draw & may_be_high
+            draws.extend([(rect_id, drawn_at[rect_id], feature_id, False) for rect_id in np.flatnonzero(drawn_at >= 0)])
+            xprimes[:, order] = state
+
+        # draw the random columns in the same order as fitting each rect separately, by rect then by column, skipping those after a failed discrete feature
+        draws = [draw for draw in draws if draw[1] < first_failure[draw[0]] and not replay[draw[0]]]
+        draws.extend([(rect_id, -1, None, False) for rect_id in np.flatnonzero(replay)])
+        one_hot_cols = np.sort(np.concatenate(self.fit_one_hot)) if len(self.fit_one_hot) > 0 else np.array([], dtype=int)
+        for rect_id, col, feature_id, cleared in sorted(draws, key=lambda draw: (draw[0], draw[1])):
+            if feature_id is not None:
+                feature_columns = self.fit_one_hot[feature_id]
+                rect_allowed_high = feature_columns[rects[rect_id, feature_columns, UPPER] >= 1.0]
+                drawn = np.random.choice(rect_allowed_high, 1)
+                if not cleared:
+                    xprimes[rect_id, drawn] = 1.0
+                continue
+            # replay the one-hot columns of the rect one at a time
+            xprime, rect = original[rect_id], rects[rect_id]
+            for col in one_hot_cols[one_hot_cols < first_failure[rect_id]]:
+                feature_columns = np.array(self.ds_info.one_hot_schema[self.ds_info.reverse_one_hot_schema[col]])
+                if xprime[col] <= (rect[col, LOWER] + self.EPSILONS[col]):
+                    xprime[feature_columns] = 0.0
+                    xprime[col] = 1.0
+                elif xprime[col] >= (rect[col, UPPER] - self.EPSILONS[col]):
+                    xprime[col] = 0.0
+                    if sum(xprime[feature_columns]) == 0:
+                        rect_allowed_high = feature_columns[rect[feature_columns, UPPER] >= 1.0]
+                        xprime[np.random.choice(rect_allowed_high, 1)] = 1.0
+            xprimes[rect_id, one_hot_cols] = xprime[one_hot_cols]
+
+        if self.fit_categorical:
+            print("How'd you get here? Categorical features should be one-hot encoded")
+            print("If for some reason you don't want to one-hot encode please consider marking as discrete instead")
+        return xprimes, first_failure == ncols
+
+    def distance_lower_bounds(self, x: np.ndarray, rects: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+        '''
+        Computes a lower bound on the distance from x to its fit in each of the given rectangles, the distance from x to the nearest point of each rectangle. For numeric features fit_to_rectangle moves each value at least as far as clamping it into the rectangle does, so the bound holds when all features are numeric. Costs two array operations rather than a full fit
+
+        Parameters
+        ----------
+        x: an instance array of shape (nfeatures,), or an array of shape (nrects, nfeatures) with one instance per rectangle
+        rects: a numpy array of shape (nrects, nfeatures, 2) of hyper-rectangles
+        weights: a numpy array of shape (nfeatures,) of the feature weights to measure distance with
+
+        Returns
+        -------
+        bounds: a numpy array of shape (nrects,) where bounds[i] <= distance_fn(x, fit_to_rectangle(x, rects[i]))
+        '''
+        closest_points = np.clip(x, rects[:, :, LOWER], rects[:, :, UPPER])
+        return self.distance_fn(x, closest_points, weights)
+
     def rect_center(self, rect: np.ndarray) -> np.ndarray:
         '''
         Returns the center point of the given rectangle, assuming bounds of +-inf are 1.0 and 0.0 respectively
@@ -904,19 +1429,44 @@ class FACET(Explainer):
                     explanation = self.fit_to_rectangle(x[i], nearest_rect)
                 xprime.append(explanation)
 
-        elif self.search_type == "BitVector":
+        elif self.search_type in ["BitVector", "BestFirst", "RTree"]:
+            # query the index of each counterfactual class for batches of instances at a time
+            results = [None for _ in range(x.shape[0])]
             progress = tqdm(total=x.shape[0], desc="FACET", leave=False)
+            for cf_class in np.unique(counterfactual_classes):
+                class_idxs = np.flatnonzero(counterfactual_classes == cf_class)
+                for start in range(0, class_idxs.shape[0], self.batch_size):
+                    batch_idxs = class_idxs[start:start + self.batch_size]
+                    if self.search_type == "RTree":
+                        # traverse the R-tree best first
+                        query_batch = self.rtrees[cf_class].point_query_batch
+                    elif self.search_type == "BestFirst":
+                        # visit the index's interval cells in order of their distance to each instance
+                        query_batch = self.rbvs[cf_class].best_first_query_batch
+                    else:
+                        # search an expanding radius around each instance
+                        query_batch = self.rbvs[cf_class].point_query_batch
+                        ntraced = len(self.rbvs[cf_class].trace_log)
+                    batch_results = query_batch(
+                        instances=x[batch_idxs],
+                        constraints=constraints,
+                        weights=weights,
+                        k=k,
+                        max_dist=max_dist,
+                        min_robust=min_robust,
+                        min_widths=min_widths
+                    )
+                    for i, result in zip(batch_idxs, batch_results):
+                        results[i] = result
+                    if self.search_type == "BitVector" and self.rbvs[cf_class].tracing:
+                        for row in self.rbvs[cf_class].trace_log[ntraced:]:
+                            self.trace_log.append(dict(row, x_idx=int(batch_idxs[row["instance"]]), cf_class=int(cf_class)))
+                    progress.update(batch_idxs.shape[0])
+            progress.close()
+
             for i in range(x.shape[0]):  # for each instance
                 nearest_rect = None
-                result = self.rbvs[counterfactual_classes[i]].point_query(
-                    instance=x[i],
-                    constraints=constraints,
-                    weights=weights,
-                    k=k,
-                    max_dist=max_dist,
-                    min_robust=min_robust,
-                    min_widths=min_widths
-                )
+                result = results[i]
                 if k == 1 and result is not None:
                     nearest_rect = result
                     if opt_robust:
@@ -948,8 +1498,6 @@ class FACET(Explainer):
                         regions.append(nearest_rect)
 
                 xprime.append(explanation)
-                progress.update()
-            progress.close()
 
         # swap np.inf (no explanatio found) for zeros to allow for prediction on xprime
         xprime = np.array(xprime)
@@ -1120,6 +1668,12 @@ class FACET(Explainer):
         self.standard_dev = self.parse_param("facet_sd", 0.1)
         self.intersect_order = self.parse_param("facet_intersect_order", "Probability")
         self.gbc_intersect_order = self.parse_param("gbc_intersection", "MinimalWorstGuess")
+        self.batch_size = self.parse_param("facet_batch_size", 64)
+        self.rbv_shards = self.parse_param("rbv_shards", 1)
+        self.nworkers = self.parse_param("facet_workers", 1)
+        self.prune_contained = self.parse_param("facet_prune_contained", False)
+        self.merge_rects = self.parse_param("facet_merge_rects", False)
+        self.merge_candidates = self.parse_param("facet_merge_candidates", 16)
 
         if self.params.get("facet_smart_weight") is None:
             print("no facet_smart_weight, usinge True")
@@ -1127,3 +1681,18 @@ class FACET(Explainer):
         else:
             self.use_smart_weight = self.params.get("facet_smart_weight")
             self.equal_weights = None  # default equal weights to None, will be set later if needed
+
+
+def enumerate_worker(explainer: FACET, all_leaves: np.ndarray, preds: np.ndarray) -> list[tuple]:
+    '''
+    Enumerates a chunk of instances in a worker process of FACET.index_rectangles, see FACET.enumerate_chunk. The explainer is a FACET.worker_copy, whose leaf tables are rebuilt first
+    '''
+    explainer.build_leaf_tables(explainer.trees)
+    return explainer.enumerate_chunk(all_leaves, preds)
+
+
+def build_index_worker(rects: list[np.ndarray], hyperparameters: dict) -> BitVectorIndex:
+    '''
+    Builds the BitVectorIndex of one class in a worker process of FACET.build_bitvectorindex. The index is built without an explainer, which the caller sets
+    '''
+    return BitVectorIndex(rects=rects, explainer=None, hyperparameters=hyperparameters)
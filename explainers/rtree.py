@@ -0,0 +1,269 @@
+# handle circular imports that result from typehinting
+from __future__ import annotations
+
+import heapq
+import math
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from explainers.bit_vector import LOWER, UPPER, TopK, have_intersections, top_k_rects
+
+if TYPE_CHECKING:  # circular import avoidance
+    from explainers.facet import FACET
+
+
+class RTreeIndex():
+    '''
+    A hierarchical bounding box index of hyper-rectangles, bulk loaded using Sort-Tile-Recursive packing. Designed as an alternative to the BitVectorIndex for low dimensional data which finds the nearest hyperrectangle to a point subject to an optional set of constraints along each axis by a best-first traversal of the tree.
+
+    Based on "STR: A Simple and Efficient Algorithm for R-Tree Packing" by Scott Leutenegger, Mario Lopez, Jeffrey Edgington. 1997 ICDE
+    '''
+
+    def __init__(self, rects: list[np.ndarray], explainer: FACET, hyperparameters: dict):
+        '''
+        Parameters
+        ----------
+        rects: the list of hyperrectangle records to index, all records should be of the same class
+        explainer: the FACET explainer to use for fitting points to rectangles
+        hyperparameters: the hyperparameters controlling the tree, see parse_hyperparameters
+        '''
+        self.parse_hyperparameters(hyperparameters)
+        self.explainer = explainer
+        # combine the list of hyperrectangles into one array of shape (nrects, ndim, 2)
+        self.rects: np.ndarray = np.stack(rects, axis=0)
+        self.nrects = self.rects.shape[0]
+        self.ndimensions = self.rects.shape[1]
+        self.levels = self.bulk_load(self.rects)
+        if self.verbose:
+            print("RTree levels:", len(self.levels))
+        self.search_log = []  # for experiments store the # of rects search for each sample explained
+
+    def insert(self, rects: list[np.ndarray]) -> np.ndarray:
+        '''
+        Adds the given hyper-rectangles to the index. STR packs the tree from all of its rects at once, so the new rects are appended after the existing ones and the tree is bulk loaded again, keeping the ids of the existing rects
+
+        Parameters
+        ----------
+        rects: the list of hyperrectangle records to add, each of shape (ndim, 2)
+
+        Returns
+        -------
+        rect_ids: an array of the ids assigned to the new rectangles
+        '''
+        if len(rects) == 0:
+            return np.zeros(shape=(0,), dtype=int)
+        rect_ids = np.arange(self.nrects, self.nrects + len(rects))
+        self.rects = np.concatenate([self.rects, np.stack(rects, axis=0)], axis=0)
+        self.nrects = self.rects.shape[0]
+        self.levels = self.bulk_load(self.rects)
+        return rect_ids
+
+    def bulk_load(self, rects: np.ndarray) -> list[tuple[np.ndarray, list[np.ndarray]]]:
+        '''
+        Builds the tree bottom up, at each level packing the boxes of the level below into nodes of node_size boxes using STR
+
+        Parameters
+        ----------
+        rects: a numpy array of shape (nrects, ndim, 2) of the rects to index
+
+        Returns
+        -------
+        levels: a list of (boxes, children) pairs from the leaves up to the root. boxes is an array of shape (nnodes, ndim, 2) of the bounding box of each node on the level and children[i] is an array of the ids of node i's children, which are rect ids for the leaf level and node ids of the level below otherwise
+        '''
+        levels = []
+        boxes = rects
+        while len(levels) == 0 or boxes.shape[0] > 1:
+            order = self.str_order(boxes)
+            starts = np.arange(0, order.shape[0], self.node_size)
+            children = np.split(order, starts[1:])
+            node_boxes = np.zeros(shape=(starts.shape[0], self.ndimensions, 2))
+            node_boxes[:, :, LOWER] = np.minimum.reduceat(boxes[order, :, LOWER], starts, axis=0)
+            node_boxes[:, :, UPPER] = np.maximum.reduceat(boxes[order, :, UPPER], starts, axis=0)
+            levels.append((node_boxes, children))
+            boxes = node_boxes
+        return levels
+
+    def str_order(self, boxes: np.ndarray) -> np.ndarray:
+        '''
+        Orders the boxes using Sort-Tile-Recursive packing, such that each consecutive group of node_size boxes forms a node. The boxes are sorted into slabs by their center along the axis with the most spread, each slab is tiled recursively along the next axis, and so on
+
+        Parameters
+        ----------
+        boxes: a numpy array of shape (nboxes, ndim, 2)
+
+        Returns
+        -------
+        order: a permutation of the box ids
+        '''
+        # replace infinite bounds with values just outside the finite bounds so that every box has a finite center
+        finite_bounds = boxes[np.isfinite(boxes)]
+        if finite_bounds.shape[0] > 0:
+            fill_low, fill_high = finite_bounds.min() - 1, finite_bounds.max() + 1
+        else:
+            fill_low, fill_high = -1, 1
+        centers = np.clip(boxes, fill_low, fill_high).mean(axis=2)
+        dim_order = np.argsort(-centers.std(axis=0), kind="stable")
+
+        def tile(box_ids: np.ndarray, level: int) -> np.ndarray:
+            box_ids = box_ids[np.argsort(centers[box_ids, dim_order[level]], kind="stable")]
+            if box_ids.shape[0] <= self.node_size or level == self.ndimensions - 1:
+                return box_ids
+            # split the nodes evenly into slabs, the number of slabs along each remaining axis is the (ndim - level)th root of the number of nodes
+            nnodes = math.ceil(box_ids.shape[0] / self.node_size)
+            nslabs = math.ceil(nnodes ** (1 / (self.ndimensions - level)))
+            slab_size = self.node_size * math.ceil(nnodes / nslabs)  # a multiple of node_size, so nodes never span slabs
+            return np.concatenate([tile(box_ids[start:start + slab_size], level + 1)
+                                   for start in range(0, box_ids.shape[0], slab_size)])
+
+        return tile(np.arange(boxes.shape[0]), 0)
+
+    def point_query(self, instance: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None):
+        '''
+        Finds the nearest hyper-rectangle(s) to the given point subject to user considerations. Nodes are visited in order of the distance from the point to their bounding box, so once the next node is further away than the best rectangle(s) found so far the result is exact
+
+        Parameters
+        ----------
+        instance: a numpy array of shape (ndim,) to search around
+        `constraints`: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis
+        `weights`: a numpy array of shape (ndim) representing the user's willingness to change each feature with higher weight indicating more willing to change
+        `k`: the number of hyper-rectangles to find, if None find all rects within max_dist
+        `max_dist`: a float value indicating the maximum weighted radial distance to search s.t. d(x,x') <= max_dist
+        `min_robust`      : the minimum radial robustness an explanation must meet, applied to all features
+        `min_widths`      : array of shape (features,) where min_widths[i] is the min required robustness of xprime[i]
+
+        Returns
+        -------
+        `result`: for k=1 the nearest hyper-rectangle of shape (ndim, 2) or None, otherwise a list of the nearest hyper-rectangles
+        '''
+        single = (k == 1)
+        # construct the minimum robustness for each featuer if provided
+        if min_robust is not None and min_widths is None:
+            min_widths = np.tile(min_robust, self.ndimensions)
+        elif min_robust is not None and min_widths is not None:
+            min_widths = np.maximum(min_robust, min_widths)
+
+        closest_rect = None
+        closest_dist = np.inf
+        top_k = TopK(k, max_dist)
+        nrects_searched = 0
+
+        def search_threshold() -> float:
+            # the distance beyond which a rect can no longer improve the result
+            if single:
+                return min(closest_dist, max_dist)
+            else:
+                return top_k.bound()
+
+        # a priority queue of (distance to node, level, node id) starting from the root
+        root_level = len(self.levels) - 1
+        root_dist = self.box_distances(instance, self.levels[root_level][0], constraints, weights)[0]
+        node_queue = [(root_dist, root_level, 0)]
+        while len(node_queue) > 0 and node_queue[0][0] <= search_threshold():
+            _, level, node_id = heapq.heappop(node_queue)
+            children = self.levels[level][1][node_id]
+            if level == 0:
+                # check the rects in the leaf, in order of rect id
+                new_rect_ids, new_rects, new_dists = self.evaluate_rects(instance, np.sort(children), constraints, weights, min_widths, search_threshold())
+                nrects_searched += children.shape[0]
+                if single:
+                    if new_dists.shape[0] > 0:
+                        nearest = np.argmin(new_dists)
+                        if new_dists[nearest] < closest_dist:
+                            closest_rect = new_rects[nearest]
+                            closest_dist = new_dists[nearest]
+                else:
+                    top_k.push(new_dists, new_rect_ids)
+            else:
+                child_dists = self.box_distances(instance, self.levels[level - 1][0][children], constraints, weights)
+                for child_id, child_dist in zip(children, child_dists):
+                    if child_dist <= search_threshold():
+                        heapq.heappush(node_queue, (child_dist, level - 1, child_id))
+
+        # Experiment logging
+        self.search_log.append(nrects_searched)
+        if self.verbose:
+            print(nrects_searched)
+
+        if single:
+            return closest_rect if closest_dist <= max_dist else None
+        else:
+            return list(top_k_rects(self.rects, top_k, constraints)[1])
+
+    def point_query_batch(self, instances: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None) -> list:
+        '''
+        Runs point_query for each of the given instances, taking the same arguments and returning results in the same format as BitVectorIndex.point_query_batch
+        '''
+        return [self.point_query(instance, constraints, weights, k, max_dist, min_robust, min_widths) for instance in instances]
+
+    def box_distances(self, instance: np.ndarray, boxes: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None) -> np.ndarray:
+        '''
+        Computes the distance from the instance to the nearest point of each box which falls in the constraints, a lower bound on the distance to any rectangle inside the box
+
+        Parameters
+        ----------
+        instance: a numpy array of shape (ndim,)
+        boxes: a numpy array of shape (nboxes, ndim, 2)
+        constraints: a numpy array of shape (ndim, 2) representing the user's min/max allowed values along each axis
+        weights: a numpy array of shape (ndim) of the feature weights to measure distance with
+
+        Returns
+        -------
+        dists: a numpy array of shape (nboxes,), inf for boxes which don't intersect the constraints
+        '''
+        lowers = boxes[:, :, LOWER]
+        uppers = boxes[:, :, UPPER]
+        if constraints is not None:
+            lowers = np.maximum(lowers, constraints[:, LOWER])
+            uppers = np.minimum(uppers, constraints[:, UPPER])
+        empty = (lowers > uppers).any(axis=1)
+        closest_points = np.minimum(np.maximum(instance, lowers), uppers)
+        dists = self.explainer.distance_fn(instance, closest_points, weights)
+        dists[empty] = np.inf
+        return dists
+
+    def evaluate_rects(self, instance: np.ndarray, rect_ids: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, min_widths: np.ndarray = None, max_dist: float = np.inf) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        Checks the given hyper-rectangles against the user considerations and computes the distance from the instance to each of the valid ones. When all features are numeric, rects whose distance lower bound exceeds max_dist can't improve the result and are left out without being fit
+
+        Returns
+        -------
+        (rect_ids, rects, dists): the ids of the rects which satisfy the user considerations, copies of them trimmed to fit in the constraints if provided, and the distance from the instance to each of them
+        '''
+        rects = self.rects[rect_ids]  # advanced indexing, always a copy of self.rects
+        keep = np.ones(shape=(rect_ids.shape[0],), dtype=bool)
+        # if applicable only consider the rectangles which fall within the constraints
+        if constraints is not None:
+            keep &= have_intersections(rects, constraints)
+            # take only part of each rect which falls in constraints
+            rects[:, :, LOWER] = np.maximum(rects[:, :, LOWER], constraints[:, LOWER])  # raise lower bounds
+            rects[:, :, UPPER] = np.minimum(rects[:, :, UPPER], constraints[:, UPPER])  # lower upper bounds
+        # check that the found rectangles are larger than the robustness requirements
+        if min_widths is not None:
+            keep &= ((rects[:, :, UPPER] - rects[:, :, LOWER]) >= min_widths).all(axis=1)
+        # skip fitting the rects which are too far from the instance to improve the result
+        if np.isfinite(max_dist) and self.explainer.ds_info.all_numeric:
+            keep &= self.explainer.distance_lower_bounds(instance, rects, weights) <= max_dist
+        rect_ids = rect_ids[keep]
+        rects = rects[keep]
+        # fit the instance into each remaining rectangle and compute the distances
+        xprimes, fit_valid = self.explainer.fit_to_rectangles(instance, rects)
+        dists = self.explainer.distance_fn(instance, xprimes[fit_valid], weights)
+        return rect_ids[fit_valid], rects[fit_valid], dists
+
+    def parse_hyperparameters(self, hyperparameters: dict) -> None:
+        self.hyperparameters = hyperparameters
+        params: dict = hyperparameters.get("FACET")
+
+        # Node capacity
+        if params.get("rtree_node_size") is None:
+            print("No rtree_node_size provided, using 16")
+            self.node_size = 16
+        else:
+            self.node_size = params.get("rtree_node_size")
+
+        # print messages
+        if params.get("facet_verbose") is None:
+            self.verbose = False
+        else:
+            self.verbose = params.get("facet_verbose")
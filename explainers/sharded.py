@@ -0,0 +1,256 @@
+# handle circular imports that result from typehinting
+from __future__ import annotations
+
+import multiprocessing as mp
+import weakref
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+from explainers.bit_vector import BitVectorIndex, TopK, top_k_rects
+
+if TYPE_CHECKING:  # circular import avoidance
+    from explainers.facet import FACET
+
+# the seconds to wait for each worker process to exit once asked before terminating it
+WORKER_EXIT_TIMEOUT = 5.0
+
+
+class ShardedBitVectorIndex():
+    '''
+    A BitVectorIndex partitioned into shards of contiguous rect ids, each with its own bit vectors, which are built and searched in parallel by a persistent pool of worker processes, one per shard. While a batch is searched the shards share a bound on each instance's k-th nearest distance through shared memory, so a shard stops growing its search radius once the shards together have found k rects nearer, and the partial results of the shards are merged into the exact nearest k. Supports the radius search point queries and adding rects, the shards can't have rects deleted, be saved, or best first searched
+    '''
+
+    def __init__(self, rects: list[np.ndarray], explainer: FACET, hyperparameters: dict):
+        '''
+        Parameters
+        ----------
+        rects: the list of hyperrectangle records to index, all records should be of the same class
+        explainer: the FACET explainer to use for fitting points to rectangles, a FACET.search_copy of it is sent to each worker process
+        hyperparameters: the hyperparameters of the index, see BitVectorIndex.parse_hyperparameters and parse_hyperparameters
+        '''
+        self.parse_hyperparameters(hyperparameters)
+        self.explainer = explainer
+        # combine the list of hyperrectangles into one array of shape (nrects, ndim, 2)
+        self.rects: np.ndarray = np.stack(rects, axis=0)
+        self.nrects = self.rects.shape[0]
+        self.ndimensions = self.rects.shape[1]
+
+        # split the rects into nshards contiguous ranges of ids
+        shard_ids = np.array_split(np.arange(self.nrects), min(self.nshards, self.nrects))
+        self.shard_starts = np.array([ids[0] for ids in shard_ids])
+        # the shared bound of each instance in the batch being searched
+        ctx = mp.get_context("spawn")
+        self.shared_bounds = ctx.RawArray("d", self.batch_size)
+        self.connections = []
+        self.workers = []
+        # the workers only fit instances to rects and measure distances, so they're sent a copy without the explainer's model and indexes
+        search_explainer = explainer.search_copy()
+        for ids in shard_ids:
+            parent_conn, worker_conn = ctx.Pipe()
+            worker = ctx.Process(target=shard_worker, args=(worker_conn, self.rects[ids], search_explainer, hyperparameters, self.shared_bounds), daemon=True)
+            worker.start()
+            worker_conn.close()
+            self.connections.append(parent_conn)
+            self.workers.append(worker)
+        # stop the workers once the index is closed or garbage collected
+        self.finalizer = weakref.finalize(self, stop_workers, self.connections, self.workers)
+        # wait for every shard to build its bit vectors, the workers take the tracing setting from their hyperparameters
+        self.tracing = all([conn.recv() for conn in self.connections])
+        if self.verbose:
+            print("Shards:", len(self.workers))
+        self.search_log = []  # for experiments store the # of rects search for each sample explained
+        self.trace_log = []  # when tracing, the search statistics of each shard's point queries, see BitVectorIndex._point_query_batch
+
+    def __getstate__(self) -> dict:
+        # the explainer is copied to the worker processes along with its indexes, which have no use for the other indexes' workers
+        state = self.__dict__.copy()
+        state["connections"] = []
+        state["workers"] = []
+        state["shared_bounds"] = None
+        state["finalizer"] = None
+        return state
+
+    def point_query(self, instance: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None):
+        '''
+        Finds the nearest hyper-rectangle(s) to the given point subject to user considerations, see BitVectorIndex.point_query
+        '''
+        return self.point_query_batch(instance[np.newaxis, :], constraints, weights, k, max_dist, min_robust, min_widths)[0]
+
+    def point_query_batch(self, instances: np.ndarray, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None) -> list:
+        '''
+        Searches every shard for the nearest hyper-rectangle(s) to each of the given points in parallel and merges their results, taking the same arguments and returning results in the same format as BitVectorIndex.point_query_batch
+        '''
+        results = []
+        for start in range(0, instances.shape[0], self.batch_size):
+            results.extend(self.query_shards(instances[start:start + self.batch_size], start, constraints, weights, k, max_dist, min_robust, min_widths))
+        return results
+
+    def query_shards(self, instances: np.ndarray, offset: int, constraints: np.ndarray = None, weights: np.ndarray = None, k: int = 1, max_dist: float = np.inf, min_robust: float = None, min_widths: np.ndarray = None) -> list:
+        '''
+        Implements point_query_batch for at most batch_size instances, the number which fit in the shared bounds. offset is the position of the first instance in the batch passed to point_query_batch, used to number the traces
+        '''
+        ninstances = instances.shape[0]
+        np.frombuffer(self.shared_bounds, dtype=np.float64)[:ninstances] = max_dist
+        request = (instances, constraints, weights, k, max_dist, min_robust, min_widths, self.tracing)
+        for conn in self.connections:
+            conn.send(("query", request))
+        replies = [conn.recv() for conn in self.connections]
+
+        results = []
+        for i in range(ninstances):
+            # the ids of each shard's rects are offset by the start of its range, so ties are broken by id as in a single index
+            top_k = TopK(k, max_dist)
+            for shard_start, (scored, _, _) in zip(self.shard_starts, replies):
+                rect_ids, dists = scored[i]
+                top_k.push(dists, rect_ids + shard_start)
+            _, closest = top_k_rects(self.rects, top_k, constraints)
+            if k == 1:
+                results.append(closest[0] if closest.shape[0] > 0 else None)
+            else:
+                results.append(list(closest))
+
+        # Experiment logging
+        self.search_log.extend(np.sum([searched for _, searched, _ in replies], axis=0).tolist())
+        for shard, (_, _, traces) in enumerate(replies):
+            for row in traces:
+                self.trace_log.append(dict(row, instance=row["instance"] + offset, shard=shard))
+        return results
+
+    def calibrate_radius(self, points: np.ndarray, weights: np.ndarray = None) -> None:
+        '''
+        Chooses the initial radius and step of the "Auto" radius growth of every shard from the distances between a sample of points and their nearest rectangle in any shard, see BitVectorIndex.calibrate_radius
+        '''
+        # evenly subsample the points so that calibration time is bounded
+        if points.shape[0] > self.auto_samples:
+            points = points[np.linspace(0, points.shape[0] - 1, self.auto_samples).astype(int)]
+        for conn in self.connections:
+            conn.send(("nearest", (points, weights)))
+        nn_dists = np.min([conn.recv() for conn in self.connections], axis=0)
+        for conn in self.connections:
+            conn.send(("auto_radius", (nn_dists,)))
+        for conn in self.connections:
+            conn.recv()
+
+    def insert(self, rects: list[np.ndarray]) -> np.ndarray:
+        '''
+        Adds the given hyper-rectangles to the last shard, whose range of ids ends at the last rect, so the new rects take the next ids as in a single index. See BitVectorIndex.insert
+
+        Parameters
+        ----------
+        rects: the list of hyperrectangle records to add, each of shape (ndim, 2)
+
+        Returns
+        -------
+        rect_ids: an array of the ids assigned to the new rectangles
+        '''
+        if len(rects) == 0:
+            return np.zeros(shape=(0,), dtype=int)
+        self.connections[-1].send(("insert", (rects,)))
+        rect_ids = self.connections[-1].recv() + self.shard_starts[-1]
+        self.rects = np.concatenate([self.rects, np.stack(rects, axis=0)], axis=0)
+        self.nrects = self.rects.shape[0]
+        return rect_ids
+
+    def close(self) -> None:
+        '''
+        Stops the worker processes, the index can't be queried afterwards
+        '''
+        self.finalizer()
+        self.connections = []
+        self.workers = []
+
+    def parse_hyperparameters(self, hyperparameters: dict) -> None:
+        self.hyperparameters = hyperparameters
+        params: dict = hyperparameters.get("FACET")
+
+        # Number of shards, each searched by its own worker process
+        if params.get("rbv_shards") is None:
+            self.nshards = 1
+        else:
+            self.nshards = params.get("rbv_shards")
+
+        # Largest number of instances searched by the shards at once
+        if params.get("facet_batch_size") is None:
+            self.batch_size = 64
+        else:
+            self.batch_size = params.get("facet_batch_size")
+
+        # Radius Growth Method
+        if params.get("rbv_radius_growth") is None:
+            self.radius_growth = "Linear"
+        else:
+            self.radius_growth = params.get("rbv_radius_growth")
+
+        # Number of sample points used to calibrate the Auto radius growth
+        if params.get("rbv_auto_samples") is None:
+            self.auto_samples = 100
+        else:
+            self.auto_samples = params.get("rbv_auto_samples")
+
+        # print messages
+        if params.get("facet_verbose") is None:
+            self.verbose = False
+        else:
+            self.verbose = params.get("facet_verbose")
+
+
+def stop_workers(connections: list, workers: list) -> None:
+    '''
+    Asks each of the given worker processes of a ShardedBitVectorIndex to exit and waits for them. Runs as the index's finalizer, so it never raises: a worker which has died can't be asked, and a worker which doesn't exit in time is terminated, or killed if it doesn't exit then
+    '''
+    for conn in connections:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass  # the worker has already exited
+        finally:
+            conn.close()
+    for worker in workers:
+        worker.join(WORKER_EXIT_TIMEOUT)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join(WORKER_EXIT_TIMEOUT)
+        if worker.is_alive():  # a stopped process doesn't handle the terminate signal
+            worker.kill()
+            worker.join()
+
+
+def shard_worker(conn, rects: np.ndarray, explainer: FACET, hyperparameters: dict, shared_bounds) -> None:
+    '''
+    The loop run by each worker process of a ShardedBitVectorIndex. Builds the BitVectorIndex of the shard's rects, then answers the requests received over conn until it receives None
+
+    Parameters
+    ----------
+    conn: the worker's end of a pipe to the ShardedBitVectorIndex
+    rects: a numpy array of shape (nrects, ndim, 2) of the shard's rects
+    explainer: a FACET.search_copy of the explainer to use for fitting points to rectangles
+    hyperparameters: the hyperparameters of the index
+    shared_bounds: a shared array of doubles holding the bound of each instance in the batch being searched, see BitVectorIndex._point_query_batch
+    '''
+    index = BitVectorIndex(rects=rects, explainer=explainer, hyperparameters=hyperparameters)
+    conn.send(index.tracing)
+    bounds = np.frombuffer(shared_bounds, dtype=np.float64)
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        command, args = request
+        if command == "query":
+            instances, constraints, weights, k, max_dist, min_robust, min_widths, tracing = args
+            index.tracing = tracing
+            found = index._point_query_batch(instances, constraints, weights, k, max_dist, min_robust, min_widths,
+                                             return_ids=True, shared_bounds=bounds[:instances.shape[0]], return_dists=True)
+            # the ids and distances of the shard's nearest rects, as scored by its search, are merged with the other shards'
+            scored = [(rect_ids, dists) for rect_ids, _, dists in found]
+            conn.send((scored, index.search_log, index.trace_log))
+            index.search_log = []
+            index.trace_log = []
+        elif command == "nearest":
+            conn.send(index.nearest_rect_distances(*args))
+        elif command == "insert":
+            conn.send(index.insert(*args))
+        elif command == "auto_radius":
+            index.set_auto_radius(*args)
+            conn.send(True)
+    conn.close()
@@ -5,6 +5,8 @@ import re
 
 from experiments.compare_methods import compare_methods
 from experiments.experiments import DEFAULT_PARAMS, FACET_TUNED_M, TUNED_FACET_SD, execute_run
+from experiments.index_benchmarks import (bench_bitmap_backends, bench_build_bit_vectors, bench_grow_index, bench_insert,
+                                          bench_search_types, bench_shards)
 from experiments.perturbations import perturb_explanations
 from experiments.runall_paper import runall
 from experiments.vary_enum import vary_enum
@@ -94,7 +96,8 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Run FACET Experiments')
     expr_types = ["simple", "ntrees", "nrects", "eps", "sigma", "enum", "compare",
-                  "k", "rinit", "rstep", "m", "nconstraints", "perturb", "widths", "minrobust"]
+                  "k", "rinit", "rstep", "m", "nconstraints", "perturb", "widths", "minrobust", "bench_build",
+                  "bench_backend", "bench_search", "bench_shards", "bench_grow", "bench_insert"]
     parser.add_argument("--expr", choices=expr_types, default="simple")
     parser.add_argument("--ds", type=str, nargs="+", default=["vertebral"])
     parser.add_argument("--method", type=str, nargs="+", choices=all_explaiers, default=["FACET"])
@@ -207,3 +210,52 @@ if __name__ == "__main__":
             print("using default values")
             vary_min_robustness(ds_names=args.ds, iterations=args.it, fmod=args.fmod,
                                 ntrees=args.ntrees, max_depth=args.maxdepth)
+
+    # benchmark the construction time of FACET's bit vector index, values are the number of rectangles
+    elif args.expr == "bench_build":
+        if args.values is not None:
+            nrects = [int(_) for _ in args.values]
+            bench_build_bit_vectors(nrects=nrects, iterations=args.it, fmod=args.fmod)
+        else:
+            bench_build_bit_vectors(iterations=args.it, fmod=args.fmod)
+
+    # benchmark the bitmap stage of FACET's bit vector index queries by backend, values are the number of rectangles
+    elif args.expr == "bench_backend":
+        if args.values is not None:
+            nrects = [int(_) for _ in args.values]
+            bench_bitmap_backends(nrects=nrects, iterations=args.it, fmod=args.fmod)
+        else:
+            bench_bitmap_backends(iterations=args.it, fmod=args.fmod)
+
+    # benchmark adding rectangles to a built bit vector index by backend and check it matches a fresh build, values are the number of rectangles
+    elif args.expr == "bench_insert":
+        if args.values is not None:
+            nrects = [int(_) for _ in args.values]
+            bench_insert(nrects=nrects, iterations=args.it, fmod=args.fmod)
+        else:
+            bench_insert(iterations=args.it, fmod=args.fmod)
+
+    # benchmark FACET's explanation time by search type (BitVector, RTree, ...) on the given datasets
+    elif args.expr == "bench_search":
+        bench_search_types(ds_names=args.ds, iterations=args.it, fmod=args.fmod,
+                           ntrees=args.ntrees, max_depth=args.maxdepth)
+
+    # benchmark FACET's explanation time by the number of index shards, values are the shard counts
+    elif args.expr == "bench_shards":
+        if args.values is not None:
+            nshards = [int(_) for _ in args.values]
+            bench_shards(ds_names=args.ds, nshards=nshards, iterations=args.it, fmod=args.fmod,
+                         ntrees=args.ntrees, max_depth=args.maxdepth)
+        else:
+            bench_shards(ds_names=args.ds, iterations=args.it, fmod=args.fmod,
+                         ntrees=args.ntrees, max_depth=args.maxdepth)
+
+    # benchmark growing FACET's built indexes of each search type and check they match a rebuild, values are the shard counts
+    elif args.expr == "bench_grow":
+        if args.values is not None:
+            nshards = [int(_) for _ in args.values]
+            bench_grow_index(ds_names=args.ds, nshards=nshards, iterations=args.it, fmod=args.fmod,
+                             ntrees=args.ntrees, max_depth=args.maxdepth)
+        else:
+            bench_grow_index(ds_names=args.ds, iterations=args.it, fmod=args.fmod,
+                             ntrees=args.ntrees, max_depth=args.maxdepth)
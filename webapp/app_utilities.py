@@ -70,6 +70,7 @@ def run_facet(
     params["RandomForest"]["rf_maxdepth"] = max_depth
     params["FACET"]["facet_sd"] = TUNED_FACET_SD[ds_name]
     params["FACET"]["rbv_num_interval"] = FACET_TUNED_M[ds_name]
+    params["FACET"]["rbv_cache_size"] = 1024  # users often re-request the same explanation
 
     print("dataset: " + ds_name)
 